@@ -0,0 +1,200 @@
+"""
+Generate a synthetic corpus of FHIR bundles for scale testing, using existing bundles (by default the data/ folder)
+as templates.
+
+Each generated bundle is a copy of a template (or of several, combined into one bigger bundle) with every id
+re-keyed: every UUID in the bundle (resource ids, the urn:uuid: fullUrls and references that point at them, and
+identifiers such as the medical record number, which Synthea sets to the patient's id) is swapped for a new one
+derived from the old one and the copy number. As the same old UUID always maps to the same new one within a copy,
+the references inside a bundle still line up, while no two copies share any ids, so every copy is loaded as new
+rows rather than skipped as duplicates. The references Synthea makes by identifier (e.g. Practitioner?identifier=...,
+or Location?identifier=...|<uuid>) point at shared reference data that isn't in the patient bundles, so they are
+left alone, UUIDs and all.
+
+The re-keying is deterministic, so the same arguments always generate the same corpus. Bundles are written one at
+a time and the templates are read again as they are needed, so memory use stays at around one bundle however
+large the corpus is, and it can go up to millions of resources and tens of GB.
+
+Usage (from the main directory of the repo):
+    python benchmarks/generate.py --output-dir corpus --resources 1000000
+    python benchmarks/generate.py --output-dir corpus --gigabytes 20
+    python benchmarks/generate.py --output-dir corpus --bundles 100 --patients-per-bundle 50
+"""
+
+import argparse
+from collections.abc import Iterator
+from itertools import count, islice
+import json
+from os import listdir, makedirs
+from os.path import abspath, dirname, join
+import re
+import sys
+import uuid
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+UUID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+# a reference by identifier, e.g. "Location?identifier=https://github.com/synthetichealth/synthea|<uuid>",
+# which is matched as a whole (before any UUID inside it) so it can be left as it is
+IDENTIFIER_REFERENCE_PATTERN = re.compile(r'"[A-Za-z]+\?identifier=[^"]*"')
+REKEY_PATTERN = re.compile(f"(?P<reference>{IDENTIFIER_REFERENCE_PATTERN.pattern})|{UUID_PATTERN.pattern}")
+
+# every re-keyed id is derived from this, along with the seed and the copy number
+NAMESPACE = uuid.UUID("5d1a4e0c-7d4e-4a52-9b86-3a0e2f1c6b7d")
+
+
+def rekey(text: str, copy: int, seed: str = "") -> str:
+    """
+    Re-key every UUID in a bundle, consistently, so it can be loaded alongside the original and any other copy.
+    The UUIDs in references by identifier are left as they are.
+
+    :param text: The bundle, as JSON text
+    :param copy: Which copy this is, each copy gets different ids
+    :param seed: Changes the ids of every copy, so that separate corpora don't overlap
+    :return: The re-keyed bundle, as JSON text
+    """
+    namespace = uuid.uuid5(NAMESPACE, f"{seed}:{copy}")
+    keys = {}
+
+    def _new_key(match: re.Match) -> str:
+        if match.group("reference"):
+            return match.group(0)
+        old_key = match.group(0).lower()
+        if old_key not in keys:
+            keys[old_key] = str(uuid.uuid5(namespace, old_key))
+        return keys[old_key]
+
+    return REKEY_PATTERN.sub(_new_key, text)
+
+
+def count_resources(text: str) -> int:
+    """
+    Count the resources in a bundle.
+
+    :param text: The bundle, as JSON text
+    :return: The number of entries in it
+    """
+    return len(json.loads(text).get("entry") or [])
+
+
+def combine_bundles(bundles: list[str]) -> str:
+    """
+    Combine bundles into one bigger bundle, with all of their entries.
+
+    :param bundles: The bundles, as JSON text. A single bundle is returned as it is, without being parsed
+    :return: The combined bundle, as JSON text
+    """
+    if len(bundles) == 1:
+        return bundles[0]
+    entries = []
+    for bundle in bundles:
+        entries.extend(json.loads(bundle).get("entry") or [])
+    return json.dumps({"resourceType": "Bundle", "type": "transaction", "entry": entries})
+
+
+def generate_corpus(
+        template_dir: str,
+        output_dir: str,
+        bundles: int | None = None,
+        resources: int | None = None,
+        megabytes: float | None = None,
+        patients_per_bundle: int = 1,
+        seed: str = "",
+) -> dict:
+    """
+    Generate bundles from the templates until any one of the limits is reached.
+
+    The templates are used in turn (sorted by name), starting again with the next copy number once they have all
+    been used. With no limits given, one copy of each template is generated.
+
+    :param template_dir: Directory containing the template bundles
+    :param output_dir: Where to write the generated bundles
+    :param bundles: Stop after this many bundles
+    :param resources: Stop once at least this many resources have been generated
+    :param megabytes: Stop once at least this much has been written
+    :param patients_per_bundle: How many templates to combine into each bundle, to generate bigger files
+    :param seed: See rekey
+    :return: How many bundles, resources and megabytes were generated
+    """
+    template_paths = [join(template_dir, f) for f in sorted(listdir(template_dir)) if f.endswith(".json")]
+    if not template_paths:
+        raise ValueError(f"No template bundles found in {template_dir}")
+    if bundles is None and resources is None and megabytes is None:
+        bundles = -(-len(template_paths) // patients_per_bundle)
+
+    makedirs(output_dir, exist_ok=True)
+    # counting a template's resources means parsing it, so only do that once for each
+    resource_counts = {}
+    total = {"bundles": 0, "resources": 0, "bytes": 0}
+
+    def _templates_used() -> Iterator[tuple[int, str]]:
+        for index in count():
+            copy, position = divmod(index, len(template_paths))
+            yield copy, template_paths[position]
+
+    used = _templates_used()
+    while (
+        (bundles is None or total["bundles"] < bundles)
+        and (resources is None or total["resources"] < resources)
+        and (megabytes is None or total["bytes"] < megabytes * 1024 * 1024)
+    ):
+        rekeyed = []
+        for copy, template_path in islice(used, patients_per_bundle):
+            with open(template_path, "r") as template_file:
+                template = template_file.read()
+            if template_path not in resource_counts:
+                resource_counts[template_path] = count_resources(template)
+            total["resources"] += resource_counts[template_path]
+            rekeyed.append(rekey(template, copy, seed))
+
+        bundle = combine_bundles(rekeyed).encode()
+        with open(join(output_dir, f"bundle_{total['bundles']:07d}.json"), "wb") as output_file:
+            output_file.write(bundle)
+        total["bundles"] += 1
+        total["bytes"] += len(bundle)
+
+    return {
+        "bundles": total["bundles"],
+        "resources": total["resources"],
+        "megabytes": round(total["bytes"] / 1024 / 1024, 3),
+    }
+
+
+def main(args: list[str] | None = None) -> int:
+    """
+    Generate a corpus from the command line.
+
+    :param args: Command line arguments, defaults to sys.argv
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic FHIR bundles from template bundles")
+    parser.add_argument("--template-dir", default=f"{REPO_DIR}/data", help="directory of bundles to use as templates")
+    parser.add_argument("--output-dir", required=True, help="where to write the generated bundles")
+    parser.add_argument("--bundles", type=int, help="stop after N bundles")
+    parser.add_argument("--resources", type=int, help="stop once N resources have been generated")
+    parser.add_argument("--gigabytes", type=float, help="stop once this much has been written")
+    parser.add_argument(
+        "--patients-per-bundle", type=int, default=1, help="combine N template bundles into each bundle (default 1)"
+    )
+    parser.add_argument("--seed", default="", help="generate different ids, for a corpus that doesn't overlap another")
+    parsed_args = parser.parse_args(args)
+
+    results = generate_corpus(
+        parsed_args.template_dir,
+        parsed_args.output_dir,
+        bundles=parsed_args.bundles,
+        resources=parsed_args.resources,
+        megabytes=parsed_args.gigabytes * 1024 if parsed_args.gigabytes is not None else None,
+        patients_per_bundle=parsed_args.patients_per_bundle,
+        seed=parsed_args.seed,
+    )
+    print(
+        f"Generated {results['bundles']} bundles, {results['resources']} resources, "
+        f"{results['megabytes']} MB in {parsed_args.output_dir}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
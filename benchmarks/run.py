@@ -0,0 +1,272 @@
+"""
+Benchmark each stage of the pipeline over a directory of FHIR bundles (by default the data/ folder).
+
+The stages are timed separately so that a slowdown can be pinned on one of them:
+
+- parse: reading and parsing the JSON file (reader.read_entries), with the JSON decoder picked by --decoder
+- load: validating each resource with its fhir.resources model (loader.load_json)
+- transform: extracting the data from each model (extract.transform_json), or from the raw JSON a batch at a time
+  for BATCHED_RESOURCE_TYPES (extract.transform_columns), also broken down by resource type
+- write: sending the rows to the database (db.send_objects and db.send_column_batches), against a fresh sqlite database
+
+The results are written to a JSON file so runs can be compared. If a baseline results file is given,
+any stage whose throughput has dropped by more than the threshold is reported as a regression and the
+script exits with an error.
+
+Usage (from the main directory of the repo):
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline results.json
+    python benchmarks/run.py --decoder json --output json_results.json
+"""
+
+import argparse
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+import io
+import json
+from os import listdir
+from os.path import abspath, dirname, getsize, join
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+# fix imports for the pipeline (normally it will be running in a container)
+REPO_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{REPO_DIR}/pipeline")
+
+import db
+from constants import RESOURCE_TYPES, BATCHED_RESOURCE_TYPES, JSON_DECODER
+from extract import transform_json, transform_columns
+from loader import load_json
+from reader import read_entries, JSON_DECODERS
+
+STAGES = ("parse", "load", "transform", "write")
+
+
+def _percentile(values: list[float], percentile: int) -> float:
+    """
+    Get a percentile of a list of values.
+
+    :param values: The values to use
+    :param percentile: Which percentile to get, from 1 to 99
+    :return: The value at that percentile
+    """
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def benchmark_file(file_path: str, timings: dict, decoder: str = JSON_DECODER) -> Counter:
+    """
+    Run one file through every stage of the pipeline, adding the time spent in each stage onto timings.
+
+    :param file_path: Path to the bundle file
+    :param timings: Running totals of seconds spent in each stage (and each resource type for transform)
+    :param decoder: JSON decoder to parse the file with, see reader.read_entries
+    :return: The number of resources of each type processed from this file
+    """
+    started = time.perf_counter()
+    entries = read_entries(file_path, decoder)
+    timings["parse"] += time.perf_counter() - started
+
+    resources = [
+        entry["resource"] for entry in entries
+        if entry["resource"]["resourceType"] in RESOURCE_TYPES
+    ]
+
+    started = time.perf_counter()
+    loaded_resources = [load_json(resource) for resource in resources]
+    timings["load"] += time.perf_counter() - started
+
+    fhir_objects = []
+    batched_resources = defaultdict(list)
+    for resource, loaded_resource in zip(resources, loaded_resources):
+        resource_type = resource["resourceType"]
+        if resource_type in BATCHED_RESOURCE_TYPES:
+            batched_resources[resource_type].append(resource)
+            continue
+        started = time.perf_counter()
+        transformed_data = transform_json(resource_type, loaded_resource)
+        elapsed = time.perf_counter() - started
+        timings["transform"] += elapsed
+        timings["transform_by_type"][resource_type] += elapsed
+        fhir_objects.append({"table": resource_type, "data": transformed_data})
+
+    # the high volume types are extracted a batch at a time, straight into columns
+    column_batches = {}
+    for resource_type, batch in batched_resources.items():
+        started = time.perf_counter()
+        column_batches.update(transform_columns(resource_type, batch))
+        elapsed = time.perf_counter() - started
+        timings["transform"] += elapsed
+        timings["transform_by_type"][resource_type] += elapsed
+
+    started = time.perf_counter()
+    # send_objects logs the counts for every table, which isn't useful here
+    with redirect_stdout(io.StringIO()):
+        db.send_objects(fhir_objects)
+        db.send_column_batches(column_batches)
+    timings["write"] += time.perf_counter() - started
+
+    return Counter(resource["resourceType"] for resource in resources)
+
+
+def run_benchmark(data_dir: str, limit: int | None = None, decoder: str = JSON_DECODER) -> dict:
+    """
+    Benchmark every stage of the pipeline over all of the bundles in a directory.
+
+    :param data_dir: Directory containing the bundle files
+    :param limit: Only use the first this many files (sorted by name)
+    :param decoder: JSON decoder to parse the files with, see reader.read_entries
+    :return: The results, ready to be written out as JSON
+    """
+    files = sorted(f for f in listdir(data_dir) if f.endswith(".json"))[:limit]
+
+    timings = {stage: 0.0 for stage in STAGES}
+    timings["transform_by_type"] = defaultdict(float)
+    resource_counts = Counter()
+    file_latencies = []
+    total_bytes = 0
+
+    get_db_engine = db.get_db_engine
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # write to a fresh sqlite database, so every row is a real insert rather than a skip
+        engine = create_engine(f"sqlite:///{temp_dir}/benchmark.db")
+        db.get_db_engine = lambda: engine
+        try:
+            for file_name in files:
+                file_path = join(data_dir, file_name)
+                before = sum(timings[stage] for stage in STAGES)
+                resource_counts += benchmark_file(file_path, timings, decoder)
+                file_latencies.append(sum(timings[stage] for stage in STAGES) - before)
+                total_bytes += getsize(file_path)
+        finally:
+            db.get_db_engine = get_db_engine
+            engine.dispose()
+
+    total_resources = sum(resource_counts.values())
+
+    megabytes = total_bytes / 1024 / 1024
+    results = {
+        "files": len(files),
+        "decoder": decoder,
+        "megabytes": round(megabytes, 3),
+        "resources": total_resources,
+        "stages": {},
+        "transform_by_type": {},
+        "file_latency_ms": {
+            "p50": round(_percentile(file_latencies, 50) * 1000, 3),
+            "p95": round(_percentile(file_latencies, 95) * 1000, 3),
+        },
+    }
+    for stage in STAGES:
+        results["stages"][stage] = {
+            "seconds": round(timings[stage], 4),
+            "resources_per_second": round(total_resources / timings[stage], 1),
+            "megabytes_per_second": round(megabytes / timings[stage], 3),
+        }
+    for resource_type, seconds in sorted(timings["transform_by_type"].items()):
+        results["transform_by_type"][resource_type] = {
+            "seconds": round(seconds, 4),
+            "resources_per_second": round(resource_counts[resource_type] / seconds, 1),
+        }
+    total_seconds = sum(timings[stage] for stage in STAGES)
+    results["total"] = {
+        "seconds": round(total_seconds, 4),
+        "resources_per_second": round(total_resources / total_seconds, 1),
+        "megabytes_per_second": round(megabytes / total_seconds, 3),
+    }
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Compare results against a baseline and find any stages that have got slower.
+
+    :param results: Results from run_benchmark
+    :param baseline: Results from an earlier run of run_benchmark
+    :param threshold: How much throughput is allowed to drop before it counts as a regression, e.g. 0.1 for 10%
+    :return: A description of each regression found
+    """
+    regressions = []
+    compared = {f"stage {stage}": (results["stages"], baseline["stages"], stage) for stage in STAGES}
+    compared["total"] = ({"total": results["total"]}, {"total": baseline["total"]}, "total")
+    for resource_type in results["transform_by_type"]:
+        compared[f"transform {resource_type}"] = (results["transform_by_type"], baseline["transform_by_type"], resource_type)
+
+    for name, (current, previous, key) in compared.items():
+        if key not in previous:
+            continue
+        now = current[key]["resources_per_second"]
+        before = previous[key]["resources_per_second"]
+        if now < before * (1 - threshold):
+            regressions.append(f"{name}: {before} -> {now} resources/s ({(now / before - 1) * 100:.1f}%)")
+    return regressions
+
+
+def print_results(results: dict):
+    """
+    Print a readable summary of the results.
+
+    :param results: Results from run_benchmark
+    """
+    print(
+        f"{results['files']} files, {results['megabytes']} MB, {results['resources']} resources, "
+        f"parsed with {results['decoder']}"
+    )
+    for stage, stage_results in {**results["stages"], "total": results["total"]}.items():
+        print(
+            f"  {stage:<10} {stage_results['seconds']:9.3f} s "
+            f"{stage_results['resources_per_second']:11.1f} resources/s "
+            f"{stage_results['megabytes_per_second']:9.3f} MB/s"
+        )
+    for resource_type, type_results in results["transform_by_type"].items():
+        print(f"  transform {resource_type:<18} {type_results['resources_per_second']:11.1f} resources/s")
+    print(f"  per file latency: p50 {results['file_latency_ms']['p50']} ms, p95 {results['file_latency_ms']['p95']} ms")
+
+
+def main(args: list[str] | None = None) -> int:
+    """
+    Run the benchmark from the command line.
+
+    :param args: Command line arguments, defaults to sys.argv
+    :return: Exit code, 1 if any regressions were found against the baseline
+    """
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the pipeline")
+    parser.add_argument("--data-dir", default=f"{REPO_DIR}/data", help="directory of bundles to benchmark with")
+    parser.add_argument("--limit", type=int, help="only use the first N files")
+    parser.add_argument(
+        "--decoder", choices=JSON_DECODERS, default=JSON_DECODER, help=f"JSON decoder to parse with (default {JSON_DECODER})"
+    )
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="fractional drop in throughput that counts as a regression (default 0.1)"
+    )
+    parsed_args = parser.parse_args(args)
+
+    results = run_benchmark(parsed_args.data_dir, parsed_args.limit, parsed_args.decoder)
+    print_results(results)
+
+    with open(parsed_args.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Results written to {parsed_args.output}")
+
+    if parsed_args.baseline:
+        with open(parsed_args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if regressions := find_regressions(results, baseline, parsed_args.threshold):
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
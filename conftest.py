@@ -6,6 +6,9 @@ import pytest
 import json
 import sys
 
+from datetime import date, datetime
+from decimal import Decimal
+
 from os.path import abspath, dirname
 
 from sqlalchemy import create_engine, text
@@ -15,6 +18,8 @@ from sqlalchemy import create_engine, text
 TEST_DIR = dirname(abspath(__file__))
 sys.path.insert(0, dirname(abspath(__file__)) + '/pipeline')
 
+from pipeline.rows import ROW_TYPES, column_types
+
 # create an in-memory sqlite db for testing with to replace the postgres db
 ENGINE = create_engine("sqlite://")
 
@@ -39,6 +44,34 @@ def load_json_fixture():
     return _load
 
 
+@pytest.fixture
+def load_transformed_fixture(load_json_fixture):
+    """
+    Pytest fixture to load transformed data from transformed_json, with the values that JSON can only hold as
+    strings (dates and times, money) turned back into the types the extract functions give.
+
+    The file is either one row, named after its table (e.g. claim.json), or the columns for
+    several tables (e.g. observation.json).
+    """
+    parsers = {datetime: datetime.fromisoformat, date: date.fromisoformat, Decimal: Decimal}
+
+    def _native(table, column, value):
+        python_type = column_types(ROW_TYPES[table])[column]
+        return parsers[python_type](value) if value is not None and python_type in parsers else value
+
+    def _load(file_name):
+        data = load_json_fixture(f"transformed_json/{file_name}")
+        if all(isinstance(value, dict) for value in data.values()):
+            return {
+                table: {column: [_native(table, column, value) for value in values] for column, values in columns.items()}
+                for table, columns in data.items()
+            }
+        table = {table.lower(): table for table in ROW_TYPES}[file_name.removesuffix(".json")]
+        return {column: _native(table, column, value) for column, value in data.items()}
+
+    return _load
+
+
 @pytest.fixture
 def check_table_exists(test_db_engine):
     """Pytest fixture to check if a table exists in the database"""
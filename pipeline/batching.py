@@ -0,0 +1,94 @@
+"""
+Adaptive batch sizing, driven by how long the sinks take to write each batch (see ADAPTIVE_BATCH_SIZE in constants.py).
+
+A fixed batch size is wrong one way or the other: a database under pressure (e.g. vacuuming or checkpointing)
+copes better with smaller batches, while an idle one can take much bigger ones, with less overhead per row.
+Instead, the time taken to write each batch is measured, and the size of the next batches is adjusted to keep
+that close to a target time, within a minimum and maximum size.
+
+The time per entry is smoothed across batches, so one slow batch doesn't throw the size out on its own, and the
+size can at most halve or double from one batch to the next. As a batch's write time includes some fixed cost
+(round trips, the commit) as well as a cost per entry, sizing it from the average time per entry settles on the
+size where the whole batch takes the target time.
+
+If a batch takes much longer than the target, the database is falling behind, and the async pipeline stops reading
+ahead until the batches already waiting have been written (see pipelined.py), so memory stays bounded.
+"""
+
+from constants import BATCH_SIZE_MIN, BATCH_SIZE_MAX, BATCH_TARGET_SECONDS
+from metrics import METRICS
+
+# how much weight the latest batch has in the smoothed time per entry
+SMOOTHING = 0.3
+
+# a batch that takes this many times the target means the database is falling behind
+BEHIND_FACTOR = 2
+
+
+class AdaptiveBatchSize:
+    """
+    A batch size that adapts to how long each batch takes to write.
+
+    Call it to get the current size (so it can be passed straight to reader.batches), and record
+    how long each batch took to write once it has been written.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_seconds: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.size = min(max(initial, minimum), maximum)
+        # smoothed seconds to write each entry, None until the first batch has been written
+        self.seconds_per_entry = None
+        self.last_seconds = 0.0
+
+    def __call__(self) -> int:
+        return self.size
+
+    @property
+    def behind(self) -> bool:
+        """
+        Whether the last batch took so much longer than the target that the database is falling behind.
+        """
+        return self.last_seconds > self.target_seconds * BEHIND_FACTOR
+
+    def record(self, entries: int, seconds: float):
+        """
+        Record how long a batch took to write, and adjust the size of the next batches.
+
+        :param entries: Number of entries in the batch
+        :param seconds: Time taken to write it
+        """
+        if entries <= 0:
+            return
+        self.last_seconds = seconds
+        if self.seconds_per_entry is None:
+            self.seconds_per_entry = seconds / entries
+        else:
+            self.seconds_per_entry = SMOOTHING * seconds / entries + (1 - SMOOTHING) * self.seconds_per_entry
+
+        if self.seconds_per_entry > 0:
+            ideal = self.target_seconds / self.seconds_per_entry
+            # move towards it gradually, so it doesn't swing back and forth
+            ideal = min(max(ideal, self.size / 2), self.size * 2)
+            self.size = int(min(max(ideal, self.minimum), self.maximum))
+
+        METRICS.set_gauge("pipeline_batch_size", self.size)
+        METRICS.observe("pipeline_batch_write_seconds", seconds)
+
+
+_shared_batch_size = None
+
+
+def shared_batch_size(initial: int) -> AdaptiveBatchSize:
+    """
+    Get the adaptive batch size for this process, so that what has been learned about the database carries on
+    from one file to the next.
+
+    :param initial: The size to start at, the first time this is called
+    :return: The adaptive batch size
+    """
+    global _shared_batch_size
+    if _shared_batch_size is None:
+        _shared_batch_size = AdaptiveBatchSize(initial, BATCH_SIZE_MIN, BATCH_SIZE_MAX, BATCH_TARGET_SECONDS)
+    return _shared_batch_size
@@ -0,0 +1,185 @@
+"""
+Claiming files from an input directory that is shared by several pipeline instances, e.g. containers on
+different nodes with the same volume mounted (see SHARED_INBOX in constants.py).
+
+Each instance has its own directory, processing/<instance id>/, inside the input directory. A file is claimed
+by renaming it into there, which is atomic, so when several instances try to claim the same file only one of
+them succeeds and the others just find it has gone. The file is then processed from that directory, and moved
+to finished/ or failed/ from there as usual.
+
+An instance only has up to max_claimed files claimed at a time (e.g. one for each of its workers), and leaves the
+rest in the input directory for the other instances, so a large drop of files is shared out between all of them
+rather than taken by whichever one happened to look first. It claims more once it has finished with those.
+
+Each instance holds a lease on its directory, which it keeps alive by touching a heartbeat file in it every
+heartbeat_seconds from a background thread. If an instance dies, its heartbeat stops, and once it is more than
+lease_seconds old any other instance renames the files it had claimed back into the input directory, where they
+are picked up again like any new file. A file that was committed before the instance died is then skipped by the
+manifest (or its rows by the database), and one that was part way through starts again (or carries on from its
+checkpoint, see CHECKPOINT_SIZE).
+
+The heartbeats are compared with this machine's clock, so lease_seconds needs to be comfortably longer than both
+heartbeat_seconds and any difference between the clocks of the machines sharing the directory.
+"""
+
+from os import listdir, makedirs, remove, rename, rmdir, utime
+from os.path import join, getmtime, exists
+import threading
+import time
+
+from metrics import METRICS, log_event
+
+HEARTBEAT_FILE = ".heartbeat"
+
+
+class SharedInbox:
+    """
+    Claims files from a shared input directory for one pipeline instance, holding a lease on the files it has claimed.
+    """
+
+    def __init__(
+        self,
+        file_dir: str,
+        instance_id: str,
+        lease_seconds: float = 60,
+        heartbeat_seconds: float = 10,
+        max_claimed: int = 1,
+    ):
+        self.file_dir = file_dir
+        self.instance_id = instance_id
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_claimed = max_claimed
+        self.processing_dir = join(file_dir, "processing")
+        # where this instance's claimed files are processed from
+        self.claim_dir = join(self.processing_dir, instance_id)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _heartbeat(self):
+        """
+        Renew the lease on our claimed files, recreating our directory if another instance took it away
+        (e.g. if we were stalled for longer than the lease).
+        """
+        heartbeat_path = join(self.claim_dir, HEARTBEAT_FILE)
+        try:
+            utime(heartbeat_path)
+        except FileNotFoundError:
+            makedirs(self.claim_dir, exist_ok=True)
+            open(heartbeat_path, "a").close()
+
+    def start(self):
+        """
+        Take out the lease on our directory and start keeping it alive.
+        """
+        self._heartbeat()
+
+        def _heartbeat_forever():
+            while not self._stopped.wait(self.heartbeat_seconds):
+                try:
+                    self._heartbeat()
+                except OSError as exc:
+                    log_event("heartbeat_failed", f"Could not renew the lease on {self.claim_dir}: {exc}")
+
+        self._thread = threading.Thread(target=_heartbeat_forever, name="heartbeat", daemon=True)
+        self._thread.start()
+
+    def claimed_files(self) -> list[str]:
+        """
+        Get the files we have already claimed, e.g. ones left over from before a restart with the same instance id.
+
+        :return: Names of the files in our directory
+        """
+        return sorted(f for f in listdir(self.claim_dir) if f.endswith(".json"))
+
+    def unclaimed_files(self) -> list[str]:
+        """
+        Get the files in the input directory that nobody has claimed yet.
+
+        :return: Names of the files inside the input directory
+        """
+        return sorted(f for f in listdir(self.file_dir) if f.endswith(".json"))
+
+    def claim(self, files: list[str]) -> list[str]:
+        """
+        Claim files from the input directory by moving them into our directory, until we have max_claimed of them.
+
+        :param files: Names of the files inside the input directory
+        :return: Names of the files we managed to claim. Of the rest, some have already been claimed by
+            another instance, and any others are left for another instance (or for us once we have finished these)
+        """
+        claimed = []
+        room = self.max_claimed - len(self.claimed_files())
+        for input_file in files:
+            if len(claimed) >= room:
+                break
+            try:
+                rename(join(self.file_dir, input_file), join(self.claim_dir, input_file))
+            except FileNotFoundError:
+                continue
+            claimed.append(input_file)
+        METRICS.inc("pipeline_files_claimed_total", len(claimed))
+        return claimed
+
+    def reclaim_expired(self) -> list[str]:
+        """
+        Move the files claimed by any instance whose lease has expired back into the input directory.
+
+        :return: Names of the files that were moved back
+        """
+        reclaimed = []
+        now = time.time()
+        for instance_id in listdir(self.processing_dir):
+            if instance_id == self.instance_id:
+                continue
+            instance_dir = join(self.processing_dir, instance_id)
+            heartbeat_path = join(instance_dir, HEARTBEAT_FILE)
+            try:
+                # an instance that died before its first heartbeat is judged by when its directory was made
+                last_heartbeat = getmtime(heartbeat_path if exists(heartbeat_path) else instance_dir)
+            except FileNotFoundError:
+                # reclaimed by someone else in the meantime
+                continue
+            if now - last_heartbeat < self.lease_seconds:
+                continue
+
+            files = []
+            for input_file in listdir(instance_dir) if exists(instance_dir) else []:
+                if input_file == HEARTBEAT_FILE:
+                    continue
+                try:
+                    rename(join(instance_dir, input_file), join(self.file_dir, input_file))
+                except FileNotFoundError:
+                    continue
+                files.append(input_file)
+            try:
+                remove(heartbeat_path)
+                rmdir(instance_dir)
+            except OSError:
+                # another instance is reclaiming it too, or it has come back to life
+                pass
+
+            if files:
+                METRICS.inc("pipeline_files_reclaimed_total", len(files))
+                log_event(
+                    "files_reclaimed",
+                    f"Lease on {instance_dir} expired, moved {len(files)} files back to the input directory",
+                    instance=instance_id,
+                    files=files,
+                )
+            reclaimed.extend(files)
+        return reclaimed
+
+    def close(self):
+        """
+        Stop renewing the lease, and give it up straight away if we have no claimed files left.
+        """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        if not self.claimed_files():
+            try:
+                remove(join(self.claim_dir, HEARTBEAT_FILE))
+                rmdir(self.claim_dir)
+            except OSError:
+                pass
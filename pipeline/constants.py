@@ -2,6 +2,10 @@
 Constant values used in the pipeline that are shared between multiple files
 """
 
+import os
+from os.path import abspath, dirname
+import socket
+
 # A mapping of resource type to extraction function
 # This is used in extract.py
 # The keys in this are also used to import all the necessary modules in
@@ -16,4 +20,146 @@ RESOURCE_TYPES = [
     "Immunization",
     "MedicationRequest",
     "Medication",
+    "Observation",
+    "DiagnosticReport",
+]
+
+# The resource types in RESOURCE_TYPES that are extracted a whole file (or streaming batch) at a time,
+# straight into columns, rather than one resource at a time. These are the high volume ones.
+# See extract.transform_columns
+BATCHED_RESOURCE_TYPES = [
+    "Observation",
+    "DiagnosticReport",
 ]
+
+# Number of worker processes used to ingest files in parallel.
+# 1 processes everything in the main process, 0 uses one worker per CPU core.
+WORKERS = int(os.getenv("PIPELINE_WORKERS", "1"))
+
+# Whether the input directory is shared by several pipeline instances (e.g. containers on different nodes using
+# the same volume). Each instance claims a file before processing it by moving it into its own
+# processing/<INSTANCE_ID> directory, and keeps a lease on the files it has claimed by touching a heartbeat file every
+# HEARTBEAT_SECONDS. Once an instance's heartbeat is more than LEASE_SECONDS old, another instance moves its files
+# back to be processed again. INSTANCE_ID must be different for each instance, and defaults to the host name and
+# process id. See claims.py.
+SHARED_INBOX = os.getenv("PIPELINE_SHARED_INBOX", "false").lower() == "true"
+INSTANCE_ID = os.getenv("PIPELINE_INSTANCE_ID", "") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_SECONDS = float(os.getenv("PIPELINE_LEASE_SECONDS", "60"))
+HEARTBEAT_SECONDS = float(os.getenv("PIPELINE_HEARTBEAT_SECONDS", "10"))
+# How many files each instance claims at a time, leaving the rest for the others. 0 claims one for each worker.
+CLAIM_FILES = int(os.getenv("PIPELINE_CLAIM_FILES", "0"))
+
+# Whether to stream each file's entries with an incremental JSON parser rather than loading the whole
+# file at once. In streaming mode the transformed rows are sent to the database in batches of
+# BATCH_SIZE, so memory use depends on the batch size rather than the size of the file.
+# The batches for a file are still all committed together once the whole file has been processed.
+STREAMING = os.getenv("PIPELINE_STREAMING", "false").lower() == "true"
+BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", "1000"))
+
+# Whether the batch size (for streaming and the async pipeline) adapts to how long each batch takes to write.
+# It starts at BATCH_SIZE and is adjusted after every batch, between BATCH_SIZE_MIN and BATCH_SIZE_MAX, to keep
+# each write close to BATCH_TARGET_SECONDS. When a write takes more than twice that, the async pipeline also
+# stops reading ahead until the batches already waiting have been written. See batching.py.
+ADAPTIVE_BATCH_SIZE = os.getenv("PIPELINE_ADAPTIVE_BATCH_SIZE", "false").lower() == "true"
+BATCH_SIZE_MIN = int(os.getenv("PIPELINE_BATCH_SIZE_MIN", "100"))
+BATCH_SIZE_MAX = int(os.getenv("PIPELINE_BATCH_SIZE_MAX", "20000"))
+BATCH_TARGET_SECONDS = float(os.getenv("PIPELINE_BATCH_TARGET_SECONDS", "0.5"))
+
+# How many entries of a file to commit at a time. After each chunk a checkpoint of how far through the file
+# it has got is committed with it (see manifest.py), so a file that is interrupted (e.g. the container is killed)
+# carries on from its last checkpoint the next time it is processed, rather than starting again.
+# The entries before the checkpoint are still read, but not validated or written again.
+# 0 commits each file in a single transaction, so a file that fails leaves nothing behind.
+CHECKPOINT_SIZE = int(os.getenv("PIPELINE_CHECKPOINT_SIZE", "0"))
+
+# Which JSON decoder reads whole files (when not streaming), "orjson" or "json" (the standard library).
+# orjson is used by default, but the json module is used instead if orjson isn't installed. See reader.read_entries
+JSON_DECODER = os.getenv("PIPELINE_JSON_DECODER", "orjson")
+
+# Whether to process files with reading, transforming and writing running at the same time, as stages of an
+# asyncio pipeline connected by queues that hold at most ASYNC_QUEUE_SIZE batches (of BATCH_SIZE entries) each.
+# This is used instead of the worker pool. See pipelined.py.
+ASYNC_PIPELINE = os.getenv("PIPELINE_ASYNC", "false").lower() == "true"
+ASYNC_QUEUE_SIZE = int(os.getenv("PIPELINE_ASYNC_QUEUE_SIZE", "4"))
+
+# Size of the database connection pool in each process. A process only writes one file at a time, and every
+# write for a file goes through a single connection in a single transaction, so one is all it normally needs.
+# DB_MAX_OVERFLOW extra connections can be opened for short bursts (e.g. the async pipeline checks the
+# manifest for the next file while the current one is being written). Pooled connections are checked
+# with a cheap ping before they are used, so one the database has dropped is replaced rather than failing a file.
+DB_POOL_SIZE = int(os.getenv("PIPELINE_DB_POOL_SIZE", "1"))
+DB_MAX_OVERFLOW = int(os.getenv("PIPELINE_DB_MAX_OVERFLOW", "2"))
+
+# Whether to keep the patient_timeline table up to date as the other tables are written, with a row for every
+# encounter, condition, claim, procedure, immunization and medication request, so a patient's whole history in time
+# order can be read from one index (see timeline.py and queries.py).
+PATIENT_TIMELINE = os.getenv("PIPELINE_PATIENT_TIMELINE", "true").lower() == "true"
+
+# Whether to keep an index in memory of the ids already committed to each table, so that rows which are already in
+# the database are left out before they are sent, rather than sent and then skipped by the database. It is filled
+# from the database when the pipeline starts and added to after every commit, until it takes up KNOWN_IDS_MB.
+# Rows deleted from the database by anything else while the pipeline is running aren't noticed, so they won't be
+# loaded again until it is restarted. See known_ids.py.
+KNOWN_ID_INDEX = os.getenv("PIPELINE_KNOWN_ID_INDEX", "false").lower() == "true"
+KNOWN_IDS_MB = float(os.getenv("PIPELINE_KNOWN_IDS_MB", "64"))
+
+# Whether to skip data that has already been ingested, using the content hashes in the manifest tables
+# (see manifest.py). "off" processes everything, "files" skips any file that is byte for byte the same as
+# one already ingested, and "resources" also skips the individual resources in a file that haven't changed.
+MANIFEST_MODE = os.getenv("PIPELINE_MANIFEST", "files")
+
+# How thoroughly to validate each resource with its fhir.resources model before extracting data from it.
+# "full" validates everything, "sampled" validates 1 in every VALIDATION_SAMPLE_RATE resources of each type
+# (plus anything that doesn't look the way we expect) and "raw" skips validation completely.
+# See loader.transform_entry.
+VALIDATION_MODE = os.getenv("PIPELINE_VALIDATION_MODE", "full")
+VALIDATION_SAMPLE_RATE = int(os.getenv("PIPELINE_VALIDATION_SAMPLE_RATE", "100"))
+
+# Whether a resource that fails to validate or transform is quarantined (written to the quarantine directory
+# with its error) while the rest of its file carries on being loaded. If this is off, one bad resource fails
+# the whole file. Quarantined resources can be loaded again with start.py --replay-quarantine, see quarantine.py.
+QUARANTINE = os.getenv("PIPELINE_QUARANTINE", "true").lower() == "true"
+
+# How long the pipeline is allowed to take to start up, in milliseconds.
+# This is checked by running start.py with --startup-profile.
+STARTUP_BUDGET_MS = float(os.getenv("PIPELINE_STARTUP_BUDGET_MS", "1500"))
+
+# Profiling of individual files as they are processed, e.g. to find out why some bundles are slow (see profiling.py).
+# PROFILE is a comma separated list of "cpu" (cProfile) and/or "memory" (tracemalloc), and is off if it's empty.
+# Only the next PROFILE_FILES files are profiled (0 for no limit), and only a PROFILE_SAMPLE_RATE fraction of them.
+# The results go in the profiles directory inside the input directory. These are only where profiling starts from:
+# it can be changed while the pipeline is running by putting a file called .profile in the input directory,
+# e.g. containing "profilers=cpu,memory files=5" (see profiling.FileProfiler.check_control_file).
+# Files aren't profiled with the async pipeline, as it works on several files at once.
+PROFILE = os.getenv("PIPELINE_PROFILE", "")
+PROFILE_FILES = int(os.getenv("PIPELINE_PROFILE_FILES", "0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PIPELINE_PROFILE_SAMPLE_RATE", "1"))
+
+# How to watch the input directory for new files: "inotify" (falls back to polling if it isn't available)
+# or "poll". A file is only picked up once it has had no activity for WATCH_DEBOUNCE_MS milliseconds.
+# inotify events can be lost, so the directory is also listed if nothing has turned up for WATCH_RESCAN_SECONDS.
+WATCH_MODE = os.getenv("PIPELINE_WATCH_MODE", "inotify")
+WATCH_DEBOUNCE_MS = float(os.getenv("PIPELINE_WATCH_DEBOUNCE_MS", "50"))
+WATCH_RESCAN_SECONDS = float(os.getenv("PIPELINE_WATCH_RESCAN_SECONDS", "60"))
+
+# Where to expose metrics (see metrics.py). If METRICS_PORT is set they are served for Prometheus on
+# http://<host>:<port>/metrics, and if METRICS_FILE is set they are written to that file every
+# METRICS_FILE_INTERVAL seconds. Both are off by default.
+METRICS_PORT = int(os.getenv("PIPELINE_METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("PIPELINE_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.getenv("PIPELINE_METRICS_FILE_INTERVAL", "10"))
+
+# Where to write the transformed data, a comma separated list of "postgres" and/or "parquet" (see sinks.py).
+# Parquet files go in PARQUET_DIR, with a row group every PARQUET_ROW_GROUP_SIZE rows, and a new file
+# is started once one reaches PARQUET_MAX_FILE_MB.
+SINKS = os.getenv("PIPELINE_SINKS", "postgres")
+PARQUET_DIR = os.getenv("PIPELINE_PARQUET_DIR", f"{dirname(abspath(__file__))}/parquet")
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PIPELINE_PARQUET_ROW_GROUP_SIZE", "100000"))
+PARQUET_MAX_FILE_MB = float(os.getenv("PIPELINE_PARQUET_MAX_FILE_MB", "256"))
+PARQUET_COMPRESSION = os.getenv("PIPELINE_PARQUET_COMPRESSION", "zstd")
+
+# The manifest and the checkpoints are kept in the database (see manifest.py), so without the database
+# there is nowhere to keep them, and every file is processed in full.
+if "postgres" not in [sink.strip() for sink in SINKS.split(",")]:
+    MANIFEST_MODE = "off"
+    CHECKPOINT_SIZE = 0
@@ -1,15 +1,31 @@
 """
 Utility code for using and accessing the database
+
+Every write for a file goes through one connection in one transaction (see transaction below),
+so the file's rows are only committed if the whole file was processed successfully.
 """
 
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import lru_cache
+import io
+import time
+from weakref import WeakKeyDictionary
 
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
-from sqlalchemy.exc import ProgrammingError, OperationalError
+from sqlalchemy import (
+    create_engine, event, inspect, select, text, bindparam,
+    MetaData, Table, Column, BigInteger, Boolean, Float, String, Text,
+)
+from sqlalchemy.engine import Connection, Engine
 
-from pandas import json_normalize
+from constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, KNOWN_ID_INDEX
+from known_ids import KNOWN_IDS
+from metrics import METRICS, log_event
+from schema import TABLES, MANIFEST_TABLES
+from timeline import TIMELINE_TABLE, TIMELINE_SOURCES, timeline_rows
 
 
 # this function is AI generated as it's essentially just boilerplate code
@@ -31,48 +47,521 @@ def get_db_engine() -> Engine:
 
     db_url = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
 
-    engine = create_engine(db_url)
+    # see DB_POOL_SIZE in constants.py
+    engine = create_engine(db_url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
     return engine
 
 
-def send_object(fhir_object: dict[str, str]):
+def dispose_inherited_engine():
     """
-    Upload JSON representing the FHIR object to the database
+    Drop any pooled connections inherited from a parent process.
 
-    :param fhir_object: JSON representing the transformed FHIR data
+    A forked worker process shares its parent's sockets, which must not be used by both,
+    so this throws the pool away (without closing the parent's connections) and the worker
+    opens its own the next time it needs one.
+    """
+    get_db_engine().dispose(close=False)
+
+
+# the connection for the transaction currently open in this thread (or task), if there is one
+_current_connection: ContextVar[Connection | None] = ContextVar("current_connection", default=None)
+
+# the ids written in that transaction, keyed by table, to go in the index of known ids once they are committed
+_pending_ids: ContextVar[dict[str, list] | None] = ContextVar("pending_ids", default=None)
+
+# the tables created (or found to exist) in that transaction, to go in _existing_tables once they are committed
+_pending_tables: ContextVar[set[str] | None] = ContextVar("pending_tables", default=None)
+
+# the tables known to exist in each database, so they aren't looked up again every time rows are sent to them.
+# Only tables that have been committed go in here, as creating a table is rolled back along with everything else
+_existing_tables: WeakKeyDictionary[Engine, set[str]] = WeakKeyDictionary()
+
+
+@contextmanager
+def transaction() -> Iterator[Connection]:
+    """
+    Run every write inside this block on one pooled connection, in a single transaction.
+
+    The transaction is committed when the block finishes, and rolled back if it raises,
+    so nothing written inside it is left behind in the database if a file fails part way through.
+    Nesting this just carries on using the outer transaction.
+
+    :return: The open connection
     """
+    if (connection := _current_connection.get()) is not None:
+        yield connection
+        return
 
-    if fhir_object["data"]:
-        engine = get_db_engine()
-        # turn into a pandas dataframe, set up the column names properly
-        entry = json_normalize(fhir_object["data"])
-        entry.columns = entry.columns.str.replace('resource.', '')
+    pending_ids = defaultdict(list)
+    pending_tables = set()
+    engine = get_db_engine()
+    with engine.begin() as connection:
+        token = _current_connection.set(connection)
+        ids_token = _pending_ids.set(pending_ids)
+        tables_token = _pending_tables.set(pending_tables)
         try:
-            # check if this id already exists in the database
-            with engine.connect() as connection:
-                exists = bool(connection.execute(
-                    text(f'SELECT id FROM "{fhir_object["table"]}" WHERE id = :id'),
-                    {'id': fhir_object["data"]["id"]}
-                ).scalar())
-        except (ProgrammingError, OperationalError):
-            # allow tables not to be defined, if it doesn't exist here it gets created below
-            # (this also means the ID doesn't exist!)
-            exists = False
-        if exists:
-            print(
-                f"ID {fhir_object['data']['id']} "
-                f"already exists in table {fhir_object['table']}, skipping.")
-            return
-        
-        # put this section of the data into the database
-        # this is a super easy, perhaps somewhat hacky way, to create tables on the fly.
-        # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.DataFrame.to_sql.html
-        # in a production environment it would be more sensible to
-        # create defined schemas for the tables, but for a simple ETL app
-        # like this it works well, with the bonus of being faster to set up.
-        entry.to_sql(
-            name=fhir_object["table"],
-            con=engine,
-            if_exists="append",
-            index=False
+            yield connection
+        finally:
+            _current_connection.reset(token)
+            _pending_ids.reset(ids_token)
+            _pending_tables.reset(tables_token)
+
+    # only now they have been committed can the rows (and tables) be relied on to be there (see known_ids.py)
+    if pending_tables:
+        _existing_tables.setdefault(engine, set()).update(pending_tables)
+    for table_name, ids in pending_ids.items():
+        KNOWN_IDS.add(table_name, ids)
+
+
+# count every statement sent to any database, and how long we spend waiting for it.
+# the key includes the module name as the tests import this module twice (as db and pipeline.db),
+# which registers these listeners twice
+_STATEMENT_STARTED = f"{__name__}.statement_started"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info[_STATEMENT_STARTED] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    METRICS.inc("pipeline_db_round_trips_total")
+    METRICS.inc("pipeline_db_seconds_total", time.perf_counter() - connection.info.pop(_STATEMENT_STARTED))
+
+
+def _column_type(values: Iterable):
+    """
+    Work out the type of a column from the values in it, for a table that isn't declared in schema.py.
+
+    This mirrors what pandas' to_sql used to do for us: text, apart from booleans and numbers which keep their type.
+
+    :param values: Every value in the column
+    :return: The sqlalchemy type to use
+    """
+    for value in values:
+        # bool first, as it's a subclass of int
+        if isinstance(value, bool):
+            return Boolean
+        if isinstance(value, int):
+            return BigInteger
+        if isinstance(value, float):
+            return Float
+        if value is not None:
+            return Text
+    return Text
+
+
+def _create_table(connection: Connection, table_name: str, columns: list[str], rows: list[tuple]):
+    """
+    Create the table for these rows if it doesn't already exist.
+
+    Every table the pipeline writes is declared in schema.py, with its primary key and indexes.
+    Any other table has its column types worked out from the rows, and a unique index on id.
+
+    Once a table is known to exist (e.g. every declared table, after migrate) this doesn't go to the database.
+
+    :param connection: Open connection to the database
+    :param table_name: Name of the table, this is the FHIR resource type
+    :param columns: The names of the columns, in the same order as the values in each row
+    :param rows: The transformed rows that will be written to the table
+    """
+    if table_name in _existing_tables.get(connection.engine, ()):
+        return
+    _pending_tables.get().add(table_name)
+    if table_name in TABLES:
+        TABLES[table_name].create(connection, checkfirst=True)
+        return
+
+    table = Table(
+        table_name,
+        MetaData(),
+        *[Column(column, _column_type(row[index] for row in rows)) for index, column in enumerate(columns)]
+    )
+    table.create(connection, checkfirst=True)
+    _create_id_index(connection, table_name)
+
+
+def _create_id_index(connection: Connection, table_name: str):
+    """
+    Make sure there is a unique index on the id column of a table.
+
+    This is what lets the database skip rows that already exist with ON CONFLICT,
+    rather than us having to check each id ourselves first.
+
+    :param connection: Open connection to the database
+    :param table_name: Name of the table to index
+    """
+    connection.execute(text(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_id_key" ON "{table_name}" (id)'
+    ))
+
+
+# how to convert the columns of a table made before there was a declared schema (when every column was
+# TEXT) where the old text doesn't cast straight to the new type, keyed by (table, column).
+# The total cost used to hold the amount and currency together, e.g. "123.45USD"
+_LEGACY_CONVERSIONS = {
+    ("Claim", "total_cost"): """NULLIF(substring("total_cost" from '^-?[0-9.]+'), '')""",
+}
+
+# how to fill in a column that is new in the declared schema from the columns that were already there
+_LEGACY_BACKFILLS = {
+    ("Claim", "currency"): """substring("total_cost" from '[A-Za-z]+$')""",
+}
+
+
+def _migrate_table(connection: Connection, table: Table):
+    """
+    Bring a table that already exists up to its declared schema.
+
+    Any missing columns and indexes are added. On Postgres, TEXT columns which are declared as something else
+    are converted to it, and id is made the primary key. sqlite can't change either of those for an existing
+    table, and doesn't need to, so it just gets a unique index on id (as tables used to have) instead.
+
+    :param connection: Open connection to the database
+    :param table: The declared table, from schema.py
+    """
+    postgres = connection.dialect.name == "postgresql"
+    inspector = inspect(connection)
+    existing_columns = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+    changes = []
+
+    for column in table.columns:
+        if column.name not in existing_columns:
+            column_type = column.type.compile(connection.dialect)
+            connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            if postgres and (backfill := _LEGACY_BACKFILLS.get((table.name, column.name))):
+                connection.execute(text(f'UPDATE "{table.name}" SET "{column.name}" = {backfill}'))
+            changes.append(f"added {column.name}")
+
+    for column in table.columns:
+        old_type = existing_columns.get(column.name)
+        if postgres and isinstance(old_type, String) and not isinstance(column.type, String):
+            column_type = column.type.compile(connection.dialect)
+            old_value = _LEGACY_CONVERSIONS.get((table.name, column.name), f"""NULLIF("{column.name}", '')""")
+            connection.execute(text(
+                f'ALTER TABLE "{table.name}" ALTER COLUMN "{column.name}" TYPE {column_type} '
+                f"USING CAST({old_value} AS {column_type})"
+            ))
+            changes.append(f"converted {column.name} to {column_type}")
+
+    if not inspector.get_pk_constraint(table.name)["constrained_columns"]:
+        if postgres:
+            connection.execute(text(f'ALTER TABLE "{table.name}" ADD PRIMARY KEY (id)'))
+            # the primary key does the same job as the unique index the table used to have
+            connection.execute(text(f'DROP INDEX IF EXISTS "{table.name}_id_key"'))
+            changes.append("added primary key on id")
+        else:
+            _create_id_index(connection, table.name)
+
+    existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing_indexes:
+            index.create(connection)
+            changes.append(f"added index {index.name}")
+
+    if changes:
+        log_event(
+            "table_migrated", f"Table {table.name}: {', '.join(changes)}.", table=table.name, changes=changes
+        )
+
+
+def _backfill_timeline(connection: Connection):
+    """
+    Fill a newly created patient timeline from the tables it is made from (see timeline.py).
+
+    After this it is kept up to date as rows are written, so this only happens once.
+
+    :param connection: Open connection to the database
+    """
+    inspector = inspect(connection)
+    columns = list(TABLES[TIMELINE_TABLE].columns.keys())
+    events = 0
+    for table_name in TIMELINE_SOURCES:
+        if not inspector.has_table(table_name):
+            continue
+        result = connection.execution_options(stream_results=True, yield_per=10000).execute(
+            select(TABLES[table_name])
         )
+        try:
+            for partition in result.partitions():
+                if rows := timeline_rows(table_name, partition):
+                    events += _insert_rows(connection, TIMELINE_TABLE, columns, rows)
+        except (TypeError, ValueError) as exc:
+            # an old sqlite table still holding text that can't be read as its declared type (only Postgres
+            # converts them, see _migrate_table). Nothing has gone wrong in the database, so carry on without it
+            result.close()
+            log_event(
+                "timeline_backfill_skipped",
+                f"Could not add the existing {table_name} rows to the patient timeline: {exc}",
+                table=table_name,
+                error=str(exc),
+            )
+    if events:
+        log_event("timeline_backfilled", f"Added {events} existing events to the patient timeline.", events=events)
+
+
+def migrate():
+    """
+    Bring the database up to the declared schema in schema.py, creating any tables that don't exist yet.
+
+    This is run once when the pipeline starts, before any files are processed (or the worker pool is started),
+    in a single transaction. The manifest tables (see manifest.py) are made here too, so nothing else needs to
+    check they are there.
+    """
+    with transaction() as connection:
+        for table in MANIFEST_TABLES.values():
+            table.create(connection, checkfirst=True)
+        inspector = inspect(connection)
+        # the timeline comes after the tables it is made from, so they are up to date before it is filled
+        for table in TABLES.values():
+            if inspector.has_table(table.name):
+                _migrate_table(connection, table)
+            else:
+                table.create(connection)
+                if table.name == TIMELINE_TABLE:
+                    _backfill_timeline(connection)
+        _pending_tables.get().update(TABLES)
+
+
+def prewarm_known_ids():
+    """
+    Fill the index of known ids (see known_ids.py) with the ids of every row already in the declared tables.
+    """
+    with transaction() as connection:
+        KNOWN_IDS.prewarm(connection, TABLES)
+
+
+def _copy_value(value) -> str:
+    """
+    Format a single value for Postgres' COPY text format.
+
+    :param value: A value from a transformed row
+    :return: The escaped string representation, with \\N for NULL
+    """
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_rows(connection: Connection, table_name: str, columns: list[str], rows: list[tuple]):
+    """
+    Stream rows into a Postgres table with COPY ... FROM STDIN.
+
+    This is a single round trip for the whole batch, rather than one INSERT per row.
+
+    :param connection: Open connection to a Postgres database
+    :param table_name: Name of the table to load into
+    :param columns: The columns to load, in the order they are written
+    :param rows: The transformed rows to load, with their values in the same order as columns
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    # COPY isn't exposed through sqlalchemy so drop down to the psycopg2 cursor,
+    # this is still inside the same transaction as the rest of the connection
+    # (which also means the statement counting above doesn't see it, so count it here)
+    started = time.perf_counter()
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY "{table_name}" ({column_list}) FROM STDIN', buffer)
+    METRICS.inc("pipeline_db_round_trips_total")
+    METRICS.inc("pipeline_db_seconds_total", time.perf_counter() - started)
+
+
+def _insert_rows(
+    connection: Connection, table_name: str, columns: list[str], rows: list[tuple], update: bool = False
+) -> int:
+    """
+    Insert rows into a table, skipping any whose id is already in there (or overwriting them, with update).
+
+    On Postgres the rows are COPYed into a temporary staging table and then moved across
+    in one INSERT ... SELECT ... ON CONFLICT (id) DO NOTHING. Anywhere else (e.g. the sqlite
+    database used in the tests) it falls back to a single multi-row executemany INSERT
+    with the same ON CONFLICT clause.
+
+    :param connection: Open connection to the database
+    :param table_name: Name of the table to insert into
+    :param columns: The columns to insert, in order
+    :param rows: The transformed rows to insert, with their values in the same order as columns
+    :param update: Overwrite the rows already in the table with ON CONFLICT (id) DO UPDATE instead,
+        e.g. for resources that have changed since they were last ingested
+    :return: The number of rows that were actually inserted (or updated)
+    """
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    on_conflict = "ON CONFLICT (id) DO NOTHING"
+    if update:
+        on_conflict = "ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+            f'"{column}" = excluded."{column}"' for column in columns if column != "id"
+        )
+
+    if connection.dialect.name == "postgresql":
+        staging_table = f"{table_name}_staging"
+        connection.execute(text(
+            f'CREATE TEMPORARY TABLE "{staging_table}" '
+            f'(LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP'
+        ))
+        _copy_rows(connection, staging_table, columns, rows)
+        # Postgres won't update the same row twice in one statement, so only one row for each id
+        distinct = "DISTINCT ON (id) " if update else ""
+        result = connection.execute(text(
+            f'INSERT INTO "{table_name}" ({column_list}) '
+            f'SELECT {distinct}{column_list} FROM "{staging_table}" '
+            f"{on_conflict}"
+        ))
+        # the same table can be loaded more than once in a transaction (e.g. when streaming), so don't wait for the commit
+        connection.execute(text(f'DROP TABLE "{staging_table}"'))
+        return result.rowcount
+
+    values = ", ".join(f":{column}" for column in columns)
+    statement = text(f'INSERT INTO "{table_name}" ({column_list}) VALUES ({values}) {on_conflict}')
+    if table_name in TABLES:
+        # let sqlalchemy convert the native values to what the database takes (e.g. sqlite has no Decimal)
+        table = TABLES[table_name]
+        statement = statement.bindparams(*[bindparam(column, type_=table.c[column].type) for column in columns])
+    result = connection.execute(statement, [dict(zip(columns, row)) for row in rows])
+    return result.rowcount
+
+
+def _send_table(table_name: str, columns: list[str], rows: list[tuple], update: bool = False) -> dict[str, int]:
+    """
+    Bulk load rows for one table into the database.
+
+    This runs in the current transaction if there is one, or a transaction of its own if not.
+
+    Rows whose id already exists in the table are skipped by the database as part of the
+    insert, so this is the same number of statements whether the rows are new or not.
+    With KNOWN_ID_INDEX on, the rows already known to be in the table are left out first
+    (see known_ids.py), and nothing is sent at all if that is all of them.
+
+    With update, rows that are already in the table are overwritten instead (and counted as inserted),
+    so none of them are left out for being known.
+
+    :param table_name: Name of the table
+    :param columns: The names of the columns, in the same order as the values in each row
+    :param rows: The transformed rows for this table
+    :param update: Overwrite any rows already in the table, see _insert_rows
+    :return: Counts of the rows inserted and skipped for this table
+    """
+    total = len(rows)
+    id_index = columns.index("id") if KNOWN_ID_INDEX and "id" in columns else None
+    if id_index is not None and not update and not (rows := KNOWN_IDS.unknown_rows(table_name, rows, id_index)):
+        return {"inserted": 0, "skipped": total}
+
+    with transaction() as connection:
+        _create_table(connection, table_name, columns, rows)
+        inserted = _insert_rows(connection, table_name, columns, rows, update)
+        if id_index is not None:
+            _pending_ids.get()[table_name].extend(row[id_index] for row in rows)
+
+    return {"inserted": inserted, "skipped": total - inserted}
+
+
+def send_rows(table_name: str, rows: list[tuple] | list[dict], update: bool = False) -> dict[str, int]:
+    """
+    Bulk load transformed rows for one table into the database.
+
+    Row records from extract.py (see rows.py) are already tuples in their table's column order,
+    so they are sent as they are. Plain dictionaries are also accepted, and are lined up into
+    tuples over every column that appears in any of them.
+
+    :param table_name: Name of the table, this is the FHIR resource type
+    :param rows: The transformed rows for this table, all row records of the same type or all dictionaries
+    :param update: Overwrite any rows already in the table, see _insert_rows
+    :return: Counts of the rows inserted and skipped for this table
+    """
+    if isinstance(rows[0], tuple):
+        return _send_table(table_name, list(rows[0]._fields), rows, update)
+
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    return _send_table(table_name, columns, [tuple(row.get(column) for column in columns) for row in rows], update)
+
+
+def send_columns(table_name: str, columns: dict[str, list], update: bool = False) -> dict[str, int]:
+    """
+    Bulk load a batch of columns for one table into the database.
+
+    :param table_name: Name of the table
+    :param columns: The values of each column, keyed by column name. Every column must be the same length.
+    :param update: Overwrite any rows already in the table, see _insert_rows
+    :return: Counts of the rows inserted and skipped for this table
+    """
+    return _send_table(table_name, list(columns), list(zip(*columns.values())), update)
+
+
+def _record_counts(table_name: str, counts: dict[str, int]):
+    """
+    Record and log how many rows were inserted and skipped for a table.
+
+    :param table_name: Name of the table
+    :param counts: Counts of the rows inserted and skipped
+    """
+    for result, count in counts.items():
+        METRICS.inc("pipeline_rows_total", count, table=table_name, result=result)
+    log_event(
+        "rows_written",
+        f"Table {table_name}: {counts['inserted']} inserted, {counts['skipped']} skipped (already exist).",
+        table=table_name,
+        **counts,
+    )
+
+
+def send_objects(fhir_objects: list[dict], update: bool = False) -> dict[str, dict[str, int]]:
+    """
+    Upload all of the transformed FHIR objects for a file to the database.
+
+    The objects are grouped by table so that each table is written in one go.
+
+    :param fhir_objects: List of {"table": ..., "data": ...} dictionaries, where data is the transformed row
+    :param update: Overwrite any rows already in the tables, see _insert_rows
+    :return: Counts of the rows inserted and skipped, keyed by table
+    """
+    tables = defaultdict(list)
+    for fhir_object in fhir_objects:
+        if fhir_object["data"]:
+            tables[fhir_object["table"]].append(fhir_object["data"])
+
+    counts = {}
+    for table_name, rows in tables.items():
+        counts[table_name] = send_rows(table_name, rows, update)
+        _record_counts(table_name, counts[table_name])
+    return counts
+
+
+def send_column_batches(
+    column_batches: dict[str, dict[str, list]], update: bool = False
+) -> dict[str, dict[str, int]]:
+    """
+    Upload batches of columns (from loader.transform_batch) to the database, each table in one go.
+
+    :param column_batches: The columns for each table, keyed by table name
+    :param update: Overwrite any rows already in the tables, see _insert_rows
+    :return: Counts of the rows inserted and skipped, keyed by table
+    """
+    counts = {}
+    for table_name, columns in column_batches.items():
+        # e.g. a batch of Observations without any components
+        if not next(iter(columns.values()), None):
+            continue
+        counts[table_name] = send_columns(table_name, columns, update)
+        _record_counts(table_name, counts[table_name])
+    return counts
+
+
+def send_object(fhir_object: dict[str, str]) -> dict[str, dict[str, int]]:
+    """
+    Upload JSON representing the FHIR object to the database
+
+    :param fhir_object: JSON representing the transformed FHIR data
+    :return: Counts of the rows inserted and skipped, keyed by table
+    """
+    return send_objects([fhir_object])
@@ -12,24 +12,69 @@ directly access the JSON.
 The functions related to each fhir resource are used to create a mapping
 of resource type strint to function, so that there isn't a large if/elif statement
 calling each of the functions for each resource type (see bottom of this file)
+
+There is also a second set of functions which pull the same data straight out of the raw JSON,
+for when validation is switched off or sampled (see loader.transform_entry).
+
+Each resource is extracted into a row record for its table (see rows.py), which is a tuple,
+so it can be written out without being converted first.
+
+Observations and DiagnosticReports are extracted a batch at a time into columns rather than
+one row per resource, as there are far more of them (see the bottom of this file).
 """
 
-from datetime import datetime
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any
+
+from rows import (
+    intern,
+    PatientRow,
+    EncounterRow,
+    ConditionRow,
+    ClaimRow,
+    ProcedureRow,
+    ImmunizationRow,
+    MedicationRequestRow,
+    MedicationRow,
+    ObservationRow,
+    ObservationComponentRow,
+    DiagnosticReportRow,
+)
 
 
-def patient(patient) -> dict[str, str]:
+# money is kept to 2 decimal places
+CENTS = Decimal("0.01")
+
+
+def _timestamp(value: date | datetime) -> datetime:
+    """
+    Get a date or dateTime from a model as a datetime, for a TIMESTAMP column.
+
+    :param value: The date or datetime from the model
+    :return: The datetime, with its timezone if it has one. A date is taken as midnight.
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, time())
+    # e.g. an optional date that isn't there, which strftime used to raise for
+    raise TypeError(f"Expected a date or datetime, got {type(value).__name__}")
+
+
+def patient(patient) -> PatientRow:
     """
     Extract data from a Patient model to get it ready for database entry.
 
     :param patient: fhir.resources Patient object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    # basic entries for these values that will be overridden if they exist
-    return_dict["social_security_number"] ="N/A"
-    return_dict["drivers_license"] ="N/A"
-    return_dict["passport_number"] ="N/A"
+    # basic entries for these values that will be overridden if they exist.
+    # the id is the medical record number, or the resource's own id if it doesn't have one
+    medical_record_number = patient.id
+    social_security_number = "N/A"
+    drivers_license = "N/A"
+    passport_number = "N/A"
 
     # extract basic data
     # This section is AI generated - go through identifier section
@@ -39,209 +84,440 @@ def patient(patient) -> dict[str, str]:
         if identifier.type and identifier.type.coding:
             for coding in identifier.type.coding:
                 if coding.code == 'MR':  # Medical Record Number
-                    return_dict["id"] = identifier.value
+                    medical_record_number = identifier.value
                 elif coding.code == 'SS':  # Social Security Number
-                    return_dict["social_security_number"] = identifier.value
+                    social_security_number = identifier.value
                 elif coding.code == 'DL':  # Driver's License
-                    return_dict["drivers_license"] = identifier.value
+                    drivers_license = identifier.value
                 elif coding.code == 'PPN':  # Passport Number
-                    return_dict["passport_number"] = identifier.value
-
-    # extract name data
-    return_dict["given_name"] = patient.name[0].given[0]
-    return_dict["family_name"] = patient.name[0].family
-
-    # extract address data
-    return_dict["house"] = patient.address[0].line[0]
-    return_dict["city"] = patient.address[0].city
-    return_dict["state"] = patient.address[0].state
-    return_dict["country"] = patient.address[0].country
+                    passport_number = identifier.value
 
     # birth/death
-    return_dict["birth_date"] = datetime.strftime(patient.birthDate, "%Y-%m-%d %H:%M:%S")
     try:
-        return_dict["deceased_date"] = datetime.strftime(patient.deceasedDateTime, "%Y-%m-%d %H:%M:%S")
-        return_dict["deceased"] = True
+        deceased_date = _timestamp(patient.deceasedDateTime)
+        deceased = True
     except TypeError:
-        return_dict["deceased_date"] = None
-        return_dict["deceased"] = False
-
-    # miscellaneous
-    return_dict["gender"] = patient.gender
-    return_dict["spoken_language"] = patient.communication[0].language.text
-    return_dict["phone_number"] = patient.telecom[0].value
-    return_dict["marital_status"] = patient.maritalStatus.coding[0].code
-
-    return return_dict
-
-
-def encounter(encounter) -> dict[str, str]:
+        deceased_date = None
+        deceased = False
+
+    return PatientRow(
+        id=medical_record_number,
+        social_security_number=social_security_number,
+        drivers_license=drivers_license,
+        passport_number=passport_number,
+        # extract name data
+        given_name=patient.name[0].given[0],
+        family_name=patient.name[0].family,
+        # extract address data
+        house=patient.address[0].line[0],
+        city=intern(patient.address[0].city),
+        state=intern(patient.address[0].state),
+        country=intern(patient.address[0].country),
+        birth_date=patient.birthDate,
+        deceased_date=deceased_date,
+        deceased=deceased,
+        # miscellaneous
+        gender=intern(patient.gender),
+        spoken_language=intern(patient.communication[0].language.text),
+        phone_number=patient.telecom[0].value,
+        marital_status=intern(patient.maritalStatus.coding[0].code),
+    )
+
+
+def encounter(encounter) -> EncounterRow:
     """
     Extract data from an Encounter model to get it ready for database entry.
 
     :param patient: fhir.resources Encounter object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = encounter.id
-    return_dict["patient_id"] = encounter.subject.reference.split(":")[-1]
-    return_dict["status"] = encounter.status
-    return_dict["type"] = encounter.type[0].coding[0].display
-    return_dict["start_date"] = datetime.strftime(encounter.period.start, "%Y-%m-%d %H:%M:%S")
-    return_dict["end_date"] = datetime.strftime(encounter.period.end, "%Y-%m-%d %H:%M:%S")
-    return_dict["subject"] = encounter.subject.display
-    return_dict["participant"] = encounter.participant[0].individual.display
-    return_dict["location"] = encounter.location[0].location.display
-    return_dict["service_provider"] = encounter.serviceProvider.display
-
-    return return_dict
-
-
-def condition(condition) -> dict[str, str]:
+    return EncounterRow(
+        id=encounter.id,
+        patient_id=intern(encounter.subject.reference.split(":")[-1]),
+        status=intern(encounter.status),
+        type=intern(encounter.type[0].coding[0].display),
+        start_date=_timestamp(encounter.period.start),
+        end_date=_timestamp(encounter.period.end),
+        subject=intern(encounter.subject.display),
+        participant=intern(encounter.participant[0].individual.display),
+        location=intern(encounter.location[0].location.display),
+        service_provider=intern(encounter.serviceProvider.display),
+    )
+
+
+def condition(condition) -> ConditionRow:
     """
     Extract data from a Condition model to get it ready for database entry.
 
     :param patient: fhir.resources Condition object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = condition.id
-    return_dict["patient_id"] = condition.subject.reference.split(":")[-1]
-    return_dict["encounter_id"] = condition.encounter.reference.split(":")[-1]
-    return_dict["clinical_status"] = condition.clinicalStatus.coding[0].code
-    return_dict["verification_status"] = condition.verificationStatus.coding[0].code
-    return_dict["category"] = condition.category[0].coding[0].display
-    return_dict["onset_date"] = datetime.strftime(condition.onsetDateTime, "%Y-%m-%d %H:%M:%S")
     # not every condition has been abated
     try:
-        return_dict["abatement_date"] = datetime.strftime(condition.abatementDateTime, "%Y-%m-%d %H:%M:%S")
+        abatement_date = _timestamp(condition.abatementDateTime)
     except (KeyError, TypeError):
-        return_dict["abatement_date"] = None
-    return_dict["condition_information"] = condition.code.text
-
-    return return_dict
-
-
-def claim(claim) -> dict[str, str]:
+        abatement_date = None
+
+    return ConditionRow(
+        id=condition.id,
+        patient_id=intern(condition.subject.reference.split(":")[-1]),
+        encounter_id=intern(condition.encounter.reference.split(":")[-1]),
+        clinical_status=intern(condition.clinicalStatus.coding[0].code),
+        verification_status=intern(condition.verificationStatus.coding[0].code),
+        category=intern(condition.category[0].coding[0].display),
+        onset_date=_timestamp(condition.onsetDateTime),
+        abatement_date=abatement_date,
+        condition_information=intern(condition.code.text),
+    )
+
+
+def claim(claim) -> ClaimRow:
     """
     Extract data from a Claim model to get it ready for database entry.
 
     :param patient: fhir.resources Claim object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = claim.id
-    return_dict["patient_id"] = claim.patient.reference.split(":")[-1]
-    return_dict["encounter_id"] = claim.item[0].encounter[0].reference.split(":")[-1]
     # not every claim has a condition associated with it, for example a general exam or assessment.
     try:
-        return_dict["condition_id"] = claim.diagnosis[0].diagnosisReference.reference.split(":")[-1]
+        condition_id = claim.diagnosis[0].diagnosisReference.reference.split(":")[-1]
     except (KeyError, TypeError):
-        return_dict["condition_id"] = None
-    return_dict["status"] = claim.status
-    return_dict["billable_period_start"] = datetime.strftime(claim.billablePeriod.start, "%Y-%m-%d %H:%M:%S")
-    return_dict["billable_period_end"] = datetime.strftime(claim.billablePeriod.end, "%Y-%m-%d %H:%M:%S")
-    return_dict["provider"] = claim.provider.display
-    return_dict["priority"] = claim.priority.coding[0].code
-    return_dict["insurance_coverage"] = claim.insurance[0].coverage.display
-    return_dict["total_cost"] = f"{(claim.total.value):.2f}{claim.total.currency}"
-    
-    return return_dict
-
-
-def procedure(procedure) -> dict[str, str]:
+        condition_id = None
+
+    return ClaimRow(
+        id=claim.id,
+        patient_id=intern(claim.patient.reference.split(":")[-1]),
+        encounter_id=intern(claim.item[0].encounter[0].reference.split(":")[-1]),
+        condition_id=condition_id,
+        status=intern(claim.status),
+        billable_period_start=_timestamp(claim.billablePeriod.start),
+        billable_period_end=_timestamp(claim.billablePeriod.end),
+        provider=intern(claim.provider.display),
+        priority=intern(claim.priority.coding[0].code),
+        insurance_coverage=intern(claim.insurance[0].coverage.display),
+        total_cost=claim.total.value.quantize(CENTS),
+        currency=intern(claim.total.currency),
+    )
+
+
+def procedure(procedure) -> ProcedureRow:
     """
     Extract data from a Procedure model to get it ready for database entry.
 
     :param patient: fhir.resources Procedure object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = procedure.id
-    return_dict["patient_id"] = procedure.subject.reference.split(":")[-1]
-    return_dict["encounter_id"] = procedure.encounter.reference.split(":")[-1]
-    return_dict["status"] = procedure.status
-    return_dict["performed_period_start"] = datetime.strftime(procedure.performedPeriod.start, "%Y-%m-%d %H:%M:%S")
-    return_dict["performed_period_end"] = datetime.strftime(procedure.performedPeriod.end, "%Y-%m-%d %H:%M:%S")
-    return_dict["location"] = procedure.location.display
-
-    return return_dict
-
-
-def immunization(immunization) -> dict[str, str]:
+    return ProcedureRow(
+        id=procedure.id,
+        patient_id=intern(procedure.subject.reference.split(":")[-1]),
+        encounter_id=intern(procedure.encounter.reference.split(":")[-1]),
+        status=intern(procedure.status),
+        procedure_name=intern(procedure.code.text),
+        performed_period_start=_timestamp(procedure.performedPeriod.start),
+        performed_period_end=_timestamp(procedure.performedPeriod.end),
+        location=intern(procedure.location.display),
+    )
+
+
+def immunization(immunization) -> ImmunizationRow:
     """
     Extract data from an Immunization model to get it ready for database entry.
 
     :param patient: fhir.resources Immunization object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = immunization.id
-    return_dict["patient_id"] = immunization.patient.reference.split(":")[-1]
-    return_dict["encounter_id"] = immunization.encounter.reference.split(":")[-1]
-    return_dict["vaccine_code"] = immunization.vaccineCode.coding[0].code
-    return_dict["vaccine_type"] = immunization.vaccineCode.coding[0].display
-    return_dict["occurrence_date"] = datetime.strftime(immunization.occurrenceDateTime, "%Y-%m-%d %H:%M:%S")
-    return_dict["location"] = immunization.location.display
-
-    return return_dict
-
-
-def medicationrequest(medicationrequest) -> dict[str, str]:
+    return ImmunizationRow(
+        id=immunization.id,
+        patient_id=intern(immunization.patient.reference.split(":")[-1]),
+        encounter_id=intern(immunization.encounter.reference.split(":")[-1]),
+        vaccine_code=intern(immunization.vaccineCode.coding[0].code),
+        vaccine_type=intern(immunization.vaccineCode.coding[0].display),
+        occurrence_date=_timestamp(immunization.occurrenceDateTime),
+        location=intern(immunization.location.display),
+    )
+
+
+def medicationrequest(medicationrequest) -> MedicationRequestRow:
     """
     Extract data from a MedicationRequest model to get it ready for database entry.
 
     :param patient: fhir.resources MedicationRequest object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+    :return: Processed and sanitised data in a row ready for database entry
     """
-    return_dict = {}
-
-    return_dict["id"] = medicationrequest.id
-    return_dict["patient_id"] = medicationrequest.subject.reference.split(":")[-1]
-    return_dict["encounter_id"] = medicationrequest.encounter.reference.split(":")[-1]
     # not every request has a reason in there, for example ibuprofen does not appear to require one
     try:
-        return_dict["condition_id"] = medicationrequest.reasonReference[0].reference.split(":")[-1]
+        condition_id = medicationrequest.reasonReference[0].reference.split(":")[-1]
     except (KeyError, TypeError, ValueError, AttributeError):
-        return_dict["condition_id"] = None
-    return_dict["status"] = medicationrequest.status
-    return_dict["intent"] = medicationrequest.intent
+        condition_id = None
     # not every medication request records the medication in there,
     # sometimes it's listed as a separate Medication entry
     try:
-        return_dict["medication_code"] = medicationrequest.medicationCodeableConcept.coding[0].code
-        return_dict["medication_name"] = medicationrequest.medicationCodeableConcept.coding[0].display
-        return_dict["medication_reference_id"] = None
+        medication_code = medicationrequest.medicationCodeableConcept.coding[0].code
+        medication_name = medicationrequest.medicationCodeableConcept.coding[0].display
+        medication_reference_id = None
     except (KeyError, ValueError, AttributeError) as exc:
-        return_dict["medication_reference_id"] = medicationrequest.medicationReference.reference.split(":")[-1]
-        return_dict["medication_code"] = None
-        return_dict["medication_name"] = None
+        medication_reference_id = medicationrequest.medicationReference.reference.split(":")[-1]
+        medication_code = None
+        medication_name = None
+
+    return MedicationRequestRow(
+        id=medicationrequest.id,
+        patient_id=intern(medicationrequest.subject.reference.split(":")[-1]),
+        encounter_id=intern(medicationrequest.encounter.reference.split(":")[-1]),
+        condition_id=condition_id,
+        status=intern(medicationrequest.status),
+        intent=intern(medicationrequest.intent),
+        authored_on=_timestamp(medicationrequest.authoredOn) if medicationrequest.authoredOn else None,
+        medication_code=intern(medication_code),
+        medication_name=intern(medication_name),
+        medication_reference_id=medication_reference_id,
+        requester=intern(medicationrequest.requester.display),
+    )
+
+
+def medication(medication) -> MedicationRow:
+    """
+    Extract data from a Medication model to get it ready for database entry.
+
+    :param patient: fhir.resources Medication object
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    return MedicationRow(
+        id=medication.id,
+        medication_status=intern(medication.status),
+        medication_code=intern(medication.code.coding[0].code),
+        medication_name=intern(medication.code.coding[0].display),
+    )
+
+
+# The functions below do exactly the same job as the ones above, but work directly on the
+# raw JSON dictionaries rather than on a validated fhir.resources model.
+# This skips the cost of pydantic validation, so they're only used when the validation mode
+# is set to "raw" or "sampled" (see loader.transform_entry).
+# Their output must be identical to the model-based functions, which is checked in test_extract.py.
+# Where the model-based function would raise because of an unexpected shape, these should raise too.
+
+def _parse_timestamp(value: str) -> datetime:
+    """
+    Parse a FHIR date/dateTime string the same way the models do, into a datetime for a TIMESTAMP column.
 
-    return_dict["requester"] = medicationrequest.requester.display
+    :param value: Raw date or dateTime string from the JSON
+    :return: The datetime, with its timezone if it has one. A date is taken as midnight.
+    """
+    return datetime.fromisoformat(value)
 
-    return return_dict
 
+def _reference_id(reference: dict[str, Any]) -> str:
+    """
+    Get the id out of a reference such as {"reference": "urn:uuid:<id>"}
 
-def medication(medication) -> dict[str, str]:
+    :param reference: Raw Reference dictionary from the JSON
+    :return: The referenced id
     """
-    Extract data from a Medication model to get it ready for database entry.
+    return reference["reference"].split(":")[-1]
 
-    :param patient: fhir.resources Medication object
-    :return: Processed and sanitised data in a dictionary ready for database entry
+
+def patient_raw(patient: dict[str, Any]) -> PatientRow:
     """
-    return_dict = {}
+    Extract data from raw Patient JSON to get it ready for database entry.
 
-    return_dict["id"] = medication.id
-    return_dict["medication_status"] = medication.status
-    return_dict["medication_code"] = medication.code.coding[0].code
-    return_dict["medication_name"] = medication.code.coding[0].display
+    :param patient: Raw Patient JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    identifiers = {
+        "id": patient.get("id"),
+        "social_security_number": "N/A",
+        "drivers_license": "N/A",
+        "passport_number": "N/A",
+    }
+
+    identifier_keys = {
+        "MR": "id",
+        "SS": "social_security_number",
+        "DL": "drivers_license",
+        "PPN": "passport_number",
+    }
+    for identifier in patient.get("identifier") or []:
+        for coding in (identifier.get("type") or {}).get("coding") or []:
+            if coding.get("code") in identifier_keys:
+                identifiers[identifier_keys[coding["code"]]] = identifier.get("value")
+
+    if deceased_date := patient.get("deceasedDateTime"):
+        deceased_date = _parse_timestamp(deceased_date)
+
+    return PatientRow(
+        **identifiers,
+        given_name=patient["name"][0]["given"][0],
+        family_name=patient["name"][0].get("family"),
+        house=patient["address"][0]["line"][0],
+        city=intern(patient["address"][0].get("city")),
+        state=intern(patient["address"][0].get("state")),
+        country=intern(patient["address"][0].get("country")),
+        birth_date=date.fromisoformat(patient["birthDate"]),
+        deceased_date=deceased_date or None,
+        deceased=bool(deceased_date),
+        gender=intern(patient.get("gender")),
+        spoken_language=intern(patient["communication"][0]["language"].get("text")),
+        phone_number=patient["telecom"][0].get("value"),
+        marital_status=intern(patient["maritalStatus"]["coding"][0].get("code")),
+    )
+
+
+def encounter_raw(encounter: dict[str, Any]) -> EncounterRow:
+    """
+    Extract data from raw Encounter JSON to get it ready for database entry.
 
-    return return_dict
+    :param encounter: Raw Encounter JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    return EncounterRow(
+        id=encounter["id"],
+        patient_id=intern(_reference_id(encounter["subject"])),
+        status=intern(encounter["status"]),
+        type=intern(encounter["type"][0]["coding"][0].get("display")),
+        start_date=_parse_timestamp(encounter["period"]["start"]),
+        end_date=_parse_timestamp(encounter["period"]["end"]),
+        subject=intern(encounter["subject"].get("display")),
+        participant=intern(encounter["participant"][0]["individual"].get("display")),
+        location=intern(encounter["location"][0]["location"].get("display")),
+        service_provider=intern(encounter["serviceProvider"].get("display")),
+    )
+
+
+def condition_raw(condition: dict[str, Any]) -> ConditionRow:
+    """
+    Extract data from raw Condition JSON to get it ready for database entry.
+
+    :param condition: Raw Condition JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    abatement_date = condition.get("abatementDateTime")
+
+    return ConditionRow(
+        id=condition["id"],
+        patient_id=intern(_reference_id(condition["subject"])),
+        encounter_id=intern(_reference_id(condition["encounter"])),
+        clinical_status=intern(condition["clinicalStatus"]["coding"][0].get("code")),
+        verification_status=intern(condition["verificationStatus"]["coding"][0].get("code")),
+        category=intern(condition["category"][0]["coding"][0].get("display")),
+        onset_date=_parse_timestamp(condition["onsetDateTime"]),
+        abatement_date=_parse_timestamp(abatement_date) if abatement_date else None,
+        condition_information=intern(condition["code"].get("text")),
+    )
+
+
+def claim_raw(claim: dict[str, Any]) -> ClaimRow:
+    """
+    Extract data from raw Claim JSON to get it ready for database entry.
+
+    :param claim: Raw Claim JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    diagnosis = claim.get("diagnosis")
+
+    return ClaimRow(
+        id=claim["id"],
+        patient_id=intern(_reference_id(claim["patient"])),
+        encounter_id=intern(_reference_id(claim["item"][0]["encounter"][0])),
+        condition_id=_reference_id(diagnosis[0]["diagnosisReference"]) if diagnosis else None,
+        status=intern(claim["status"]),
+        billable_period_start=_parse_timestamp(claim["billablePeriod"]["start"]),
+        billable_period_end=_parse_timestamp(claim["billablePeriod"]["end"]),
+        provider=intern(claim["provider"].get("display")),
+        priority=intern(claim["priority"]["coding"][0].get("code")),
+        insurance_coverage=intern(claim["insurance"][0]["coverage"].get("display")),
+        # the models hold decimals as Decimal(str(value)), so do the same to round identically
+        total_cost=Decimal(str(claim["total"]["value"])).quantize(CENTS),
+        currency=intern(claim["total"].get("currency")),
+    )
+
+
+def procedure_raw(procedure: dict[str, Any]) -> ProcedureRow:
+    """
+    Extract data from raw Procedure JSON to get it ready for database entry.
+
+    :param procedure: Raw Procedure JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    return ProcedureRow(
+        id=procedure["id"],
+        patient_id=intern(_reference_id(procedure["subject"])),
+        encounter_id=intern(_reference_id(procedure["encounter"])),
+        status=intern(procedure["status"]),
+        procedure_name=intern(procedure["code"].get("text")),
+        performed_period_start=_parse_timestamp(procedure["performedPeriod"]["start"]),
+        performed_period_end=_parse_timestamp(procedure["performedPeriod"]["end"]),
+        location=intern(procedure["location"].get("display")),
+    )
+
+
+def immunization_raw(immunization: dict[str, Any]) -> ImmunizationRow:
+    """
+    Extract data from raw Immunization JSON to get it ready for database entry.
+
+    :param immunization: Raw Immunization JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    return ImmunizationRow(
+        id=immunization["id"],
+        patient_id=intern(_reference_id(immunization["patient"])),
+        encounter_id=intern(_reference_id(immunization["encounter"])),
+        vaccine_code=intern(immunization["vaccineCode"]["coding"][0].get("code")),
+        vaccine_type=intern(immunization["vaccineCode"]["coding"][0].get("display")),
+        occurrence_date=_parse_timestamp(immunization["occurrenceDateTime"]),
+        location=intern(immunization["location"].get("display")),
+    )
+
+
+def medicationrequest_raw(medicationrequest: dict[str, Any]) -> MedicationRequestRow:
+    """
+    Extract data from raw MedicationRequest JSON to get it ready for database entry.
+
+    :param medicationrequest: Raw MedicationRequest JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    try:
+        condition_id = _reference_id(medicationrequest["reasonReference"][0])
+    except (KeyError, IndexError):
+        condition_id = None
+    if medication_concept := medicationrequest.get("medicationCodeableConcept"):
+        medication_code = medication_concept["coding"][0].get("code")
+        medication_name = medication_concept["coding"][0].get("display")
+        medication_reference_id = None
+    else:
+        medication_reference_id = _reference_id(medicationrequest["medicationReference"])
+        medication_code = None
+        medication_name = None
+    authored_on = medicationrequest.get("authoredOn")
+
+    return MedicationRequestRow(
+        id=medicationrequest["id"],
+        patient_id=intern(_reference_id(medicationrequest["subject"])),
+        encounter_id=intern(_reference_id(medicationrequest["encounter"])),
+        condition_id=condition_id,
+        status=intern(medicationrequest["status"]),
+        intent=intern(medicationrequest["intent"]),
+        authored_on=_parse_timestamp(authored_on) if authored_on else None,
+        medication_code=intern(medication_code),
+        medication_name=intern(medication_name),
+        medication_reference_id=medication_reference_id,
+        requester=intern(medicationrequest["requester"].get("display")),
+    )
+
+
+def medication_raw(medication: dict[str, Any]) -> MedicationRow:
+    """
+    Extract data from raw Medication JSON to get it ready for database entry.
+
+    :param medication: Raw Medication JSON
+    :return: Processed and sanitised data in a row ready for database entry
+    """
+    return MedicationRow(
+        id=medication["id"],
+        medication_status=intern(medication.get("status")),
+        medication_code=intern(medication["code"]["coding"][0].get("code")),
+        medication_name=intern(medication["code"]["coding"][0].get("display")),
+    )
 
 
 RESOURCE_MAPPING = {
@@ -255,7 +531,7 @@ RESOURCE_MAPPING = {
     "Medication": medication,
 }
 
-def transform_json(resource_type: str, fhir_object) -> dict[str, str]:
+def transform_json(resource_type: str, fhir_object) -> tuple:
     """
     Given a resource type and a fhir.resources object, transform the data
     into a format usable for database entry.
@@ -264,3 +540,149 @@ def transform_json(resource_type: str, fhir_object) -> dict[str, str]:
     
     # return the output of the function
     return transformation_function(fhir_object)
+
+
+RAW_RESOURCE_MAPPING = {
+    "Patient": patient_raw,
+    "Encounter": encounter_raw,
+    "Condition": condition_raw,
+    "Claim": claim_raw,
+    "Procedure": procedure_raw,
+    "Immunization": immunization_raw,
+    "MedicationRequest": medicationrequest_raw,
+    "Medication": medication_raw,
+}
+
+def transform_raw(resource_type: str, json_entry: dict[str, Any]) -> tuple:
+    """
+    Given a resource type and the raw JSON for it, transform the data into a format usable
+    for database entry without validating it first.
+    """
+    return RAW_RESOURCE_MAPPING[resource_type](json_entry)
+
+
+# Observations and DiagnosticReports make up most of the data we receive (lab results and vital signs),
+# so rather than building a dictionary per resource they are extracted a whole batch at a time,
+# straight into a list per column. The columns are then handed to the sinks as they are
+# (see loader.transform_batch and sinks.write_columns_to_sinks).
+# Each function returns the columns for every table it fills in, keyed by table name.
+
+def _value_columns(resource: dict[str, Any]) -> tuple[float | None, str | None, str | None, str | None]:
+    """
+    Get the value of an Observation (or one of its components), whichever value[x] type it has.
+
+    :param resource: Raw Observation or Observation component JSON
+    :return: The numeric value and its unit (for valueQuantity), and the code and text of the value
+        (for valueCodeableConcept, or just the text for valueString)
+    """
+    if (quantity := resource.get("valueQuantity")) is not None:
+        value = quantity.get("value")
+        return (None if value is None else float(value)), quantity.get("unit"), None, None
+    if (concept := resource.get("valueCodeableConcept")) is not None:
+        coding = (concept.get("coding") or [{}])[0]
+        return None, None, coding.get("code"), concept.get("text") or coding.get("display")
+    return None, None, None, resource.get("valueString")
+
+
+def observations_columnar(observations: list[dict[str, Any]]) -> dict[str, dict[str, list]]:
+    """
+    Extract data from a batch of raw Observation JSON into columns, ready for database entry.
+
+    Components (e.g. the systolic and diastolic readings of a blood pressure) are flattened
+    into their own narrow ObservationComponent table, one row per component.
+
+    :param observations: Raw Observation JSON for every Observation in the batch
+    :return: The columns for the Observation and ObservationComponent tables
+    """
+    observation = {column: [] for column in ObservationRow._fields}
+    component = {column: [] for column in ObservationComponentRow._fields}
+
+    for resource in observations:
+        observation_id = resource["id"]
+        patient_id = intern(_reference_id(resource["subject"]))
+        code = resource["code"]["coding"][0]
+        value, unit, value_code, value_text = _value_columns(resource)
+
+        observation["id"].append(observation_id)
+        observation["patient_id"].append(patient_id)
+        observation["encounter_id"].append(
+            intern(_reference_id(resource["encounter"])) if "encounter" in resource else None
+        )
+        observation["status"].append(intern(resource["status"]))
+        observation["category"].append(
+            intern(resource["category"][0]["coding"][0].get("code")) if "category" in resource else None
+        )
+        observation["code"].append(intern(code.get("code")))
+        observation["code_display"].append(intern(code.get("display")))
+        observation["value"].append(value)
+        observation["unit"].append(intern(unit))
+        observation["value_code"].append(intern(value_code))
+        observation["value_text"].append(intern(value_text))
+        observation["effective_date"].append(
+            _parse_timestamp(resource["effectiveDateTime"]) if "effectiveDateTime" in resource else None
+        )
+        observation["issued_date"].append(_parse_timestamp(resource["issued"]) if "issued" in resource else None)
+
+        for index, resource_component in enumerate(resource.get("component") or []):
+            component_code = resource_component["code"]["coding"][0]
+            value, unit, value_code, value_text = _value_columns(resource_component)
+
+            component["id"].append(f"{observation_id}-{index}")
+            component["observation_id"].append(observation_id)
+            component["patient_id"].append(patient_id)
+            component["code"].append(intern(component_code.get("code")))
+            component["code_display"].append(intern(component_code.get("display")))
+            component["value"].append(value)
+            component["unit"].append(intern(unit))
+            component["value_code"].append(intern(value_code))
+            component["value_text"].append(intern(value_text))
+
+    return {"Observation": observation, "ObservationComponent": component}
+
+
+def diagnosticreports_columnar(diagnosticreports: list[dict[str, Any]]) -> dict[str, dict[str, list]]:
+    """
+    Extract data from a batch of raw DiagnosticReport JSON into columns, ready for database entry.
+
+    The report's results are Observations, which are in their own table, so only how many there are is kept here.
+
+    :param diagnosticreports: Raw DiagnosticReport JSON for every DiagnosticReport in the batch
+    :return: The columns for the DiagnosticReport table
+    """
+    report = {column: [] for column in DiagnosticReportRow._fields}
+
+    for resource in diagnosticreports:
+        code = resource["code"]["coding"][0]
+
+        report["id"].append(resource["id"])
+        report["patient_id"].append(intern(_reference_id(resource["subject"])))
+        report["encounter_id"].append(
+            intern(_reference_id(resource["encounter"])) if "encounter" in resource else None
+        )
+        report["status"].append(intern(resource["status"]))
+        report["category"].append(
+            intern(resource["category"][0]["coding"][0].get("code")) if "category" in resource else None
+        )
+        report["code"].append(intern(code.get("code")))
+        report["code_display"].append(intern(code.get("display")))
+        report["effective_date"].append(
+            _parse_timestamp(resource["effectiveDateTime"]) if "effectiveDateTime" in resource else None
+        )
+        report["issued_date"].append(_parse_timestamp(resource["issued"]) if "issued" in resource else None)
+        report["performer"].append(intern(resource["performer"][0].get("display")) if resource.get("performer") else None)
+        report["result_count"].append(len(resource.get("result") or []))
+
+    return {"DiagnosticReport": report}
+
+
+COLUMNAR_RESOURCE_MAPPING = {
+    "Observation": observations_columnar,
+    "DiagnosticReport": diagnosticreports_columnar,
+}
+
+def transform_columns(resource_type: str, json_entries: list[dict[str, Any]]) -> dict[str, dict[str, list]]:
+    """
+    Given a resource type and the raw JSON for a batch of resources of that type, transform the data
+    into columns usable for database entry.
+    """
+    return COLUMNAR_RESOURCE_MAPPING[resource_type](json_entries)
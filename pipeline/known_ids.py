@@ -0,0 +1,152 @@
+"""
+An index, in memory, of the ids already committed to each table (see KNOWN_ID_INDEX in constants.py).
+
+Some resources turn up again and again across files, e.g. the same Medication, or a whole bundle that has been sent
+again. Every one of those used to be sent to the database only to be skipped there by ON CONFLICT (id) DO NOTHING,
+which still means copying the row over and looking it up in the table's index. With this index, the rows whose ids
+are known to be in the database already are left out before anything is sent, so a batch of nothing but duplicates
+doesn't go to the database at all.
+
+Only ids that have been committed are added (see db.transaction), so a file that is rolled back doesn't leave ids
+behind for rows that aren't there. The index holds the ids themselves, one set for each table, so a row is never
+left out by mistake. A Bloom filter would be smaller, but every hit would then need checking against the database,
+which is the traffic this is here to avoid.
+
+The index only needs to be right about the ids that are in it: any other row is sent as before, and skipped by the
+database if it is already there. That is what keeps its memory bounded. Once it reaches its limit nothing more is
+added, and everything not already in it goes through ON CONFLICT as it always has. When the pipeline starts it is
+filled from the database, the tables with fewer rows that repeat more often first (i.e. not BATCHED_RESOURCE_TYPES,
+nor the tables made from the others such as the patient timeline).
+
+Each process has its own index. Worker processes start with a copy of the main process's, filled before the pool
+is started, and add whatever they commit to their own.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterable
+import sys
+import threading
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+
+from constants import KNOWN_IDS_MB, RESOURCE_TYPES, BATCHED_RESOURCE_TYPES
+from metrics import METRICS, log_event
+
+# how many ids to read from the database at a time when filling the index
+PREWARM_BATCH_SIZE = 10000
+
+
+class KnownIds:
+    """
+    The ids known to be committed to each table, up to a limit on how much memory they take up.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.full = False
+        self._ids = defaultdict(set)
+        # the size of the id strings themselves, the sets holding them are measured when needed
+        self._id_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._ids.values())
+
+    @property
+    def size_bytes(self) -> int:
+        """
+        Roughly how much memory the index is taking up.
+        """
+        return self._id_bytes + sum(sys.getsizeof(ids) for ids in self._ids.values())
+
+    def unknown_rows(self, table_name: str, rows: list[tuple], id_index: int) -> list[tuple]:
+        """
+        Leave out the rows whose ids are known to be in a table already.
+
+        :param table_name: Name of the table
+        :param rows: The rows to be written to it
+        :param id_index: Where the id is in each row
+        :return: The rows that might not be in the table yet
+        """
+        if not (known := self._ids.get(table_name)):
+            return rows
+        new_rows = [row for row in rows if row[id_index] not in known]
+        if skipped := len(rows) - len(new_rows):
+            METRICS.inc("pipeline_known_id_hits_total", skipped, table=table_name)
+        return new_rows
+
+    def add(self, table_name: str, ids: Iterable[str]):
+        """
+        Add ids that have been committed to a table, until the index is full.
+
+        :param table_name: Name of the table
+        :param ids: The ids of the rows that have been committed
+        """
+        with self._lock:
+            if self.full:
+                return
+            known = self._ids[table_name]
+            other_bytes = sum(sys.getsizeof(other) for name, other in self._ids.items() if name != table_name)
+            for row_id in ids:
+                if row_id is None or row_id in known:
+                    continue
+                known.add(row_id)
+                self._id_bytes += sys.getsizeof(row_id)
+                if self._id_bytes + other_bytes + sys.getsizeof(known) >= self.max_bytes:
+                    self.full = True
+                    log_event(
+                        "known_ids_full",
+                        f"The index of known ids is full at {len(self)} ids, any others are checked by the database",
+                        ids=len(self),
+                        bytes=self.size_bytes,
+                    )
+                    break
+            METRICS.set_gauge("pipeline_known_ids", len(known), table=table_name)
+            METRICS.set_gauge("pipeline_known_ids_bytes", self.size_bytes)
+
+    def prewarm(self, connection: Connection, table_names: Iterable[str]):
+        """
+        Fill the index with the ids already in the database.
+
+        :param connection: Open connection to the database
+        :param table_names: The tables to read the ids from, those that don't exist yet are skipped
+        """
+        inspector = inspect(connection)
+        # the high volume tables (and those made from the others, e.g. the timeline) last,
+        # so the index isn't filled up with them before the others
+        for table_name in sorted(
+            table_names, key=lambda name: name in BATCHED_RESOURCE_TYPES or name not in RESOURCE_TYPES
+        ):
+            if self.full:
+                break
+            if not inspector.has_table(table_name):
+                continue
+            result = connection.execution_options(stream_results=True, yield_per=PREWARM_BATCH_SIZE).execute(
+                text(f'SELECT id FROM "{table_name}"')
+            )
+            for partition in result.partitions():
+                self.add(table_name, (row[0] for row in partition))
+                if self.full:
+                    break
+            result.close()
+        log_event(
+            "known_ids_prewarmed",
+            f"Loaded {len(self)} known ids from the database ({self.size_bytes / 1024 / 1024:.1f} MB)",
+            ids=len(self),
+            bytes=self.size_bytes,
+            full=self.full,
+        )
+
+    def clear(self):
+        """
+        Forget every id, e.g. after rows have been deleted from the database.
+        """
+        with self._lock:
+            self._ids.clear()
+            self._id_bytes = 0
+            self.full = False
+
+
+# the index for this process
+KNOWN_IDS = KnownIds(int(KNOWN_IDS_MB * 1024 * 1024))
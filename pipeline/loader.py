@@ -2,17 +2,41 @@
 Utility to load raw JSON data into the appropriate fhir.resources object
 
 Use a mapping so we can take the resourceType field from the JSON to know what object to use
+
+Validation with the fhir.resources models is the slowest part of the pipeline, so transform_entry
+also supports skipping it for trusted data (see VALIDATION_MODE in constants.py):
+
+- full: validate every resource with its model, then extract the data from the model
+- sampled: validate 1 in every N resources of each type, plus any resource the raw extraction
+  can't handle, and extract the rest straight from the JSON
+- raw: never validate, always extract straight from the JSON
+
+The types in BATCHED_RESOURCE_TYPES go through transform_batch instead, which validates them in
+the same way and then extracts the whole batch straight from the JSON into columns.
+
+transform_entries can also quarantine the resources that fail to validate or transform, rather than
+letting one bad resource fail everything else with it (see QUARANTINE in constants.py, and quarantine.py).
 """
 
-from fhir_core.fhirabstractmodel import FHIRAbstractModel
+from collections import Counter, defaultdict
+from collections.abc import Iterator, Mapping
+from functools import lru_cache
 import importlib
-from typing import Any
+import time
+from typing import Any, TYPE_CHECKING
+
+from constants import RESOURCE_TYPES, BATCHED_RESOURCE_TYPES
+from extract import transform_json, transform_raw, transform_columns
+from metrics import METRICS
 
-from constants import RESOURCE_TYPES
+if TYPE_CHECKING:
+    # only needed for type hints, importing it pulls in all of pydantic
+    from fhir_core.fhirabstractmodel import FHIRAbstractModel
 
 
 # Various bits below are AI generated and then adjusted by me over time (I marked where it ends)
-def _load_resource_class(resource_name: str) -> FHIRAbstractModel:
+@lru_cache()
+def _load_resource_class(resource_name: str) -> "FHIRAbstractModel":
     """
     Import the relevant fhir.resources object, for use in a mapping of the string name to the object.
 
@@ -22,6 +46,8 @@ def _load_resource_class(resource_name: str) -> FHIRAbstractModel:
 
     Type hint for FHIRAbstractModel as this covers all of our possible resource types.
 
+    Cached so that each module is only imported the first time it is needed.
+
     :param resource_name: The name of the resource pulled from the JSON data
     :return: fhir.resources object for this resource name
     """
@@ -32,14 +58,34 @@ def _load_resource_class(resource_name: str) -> FHIRAbstractModel:
     # get the object from the module. for example, fhir.resources.patient contains the module Patient
     # the mapping in resource_types above is used for this
     return getattr(module, resource_name)
+# this is the end of the AI code
+
+
+class _LazyImportMap(Mapping):
+    """
+    Mapping of resource name to fhir.resources object, for all of the types in RESOURCE_TYPES.
+
+    Importing every fhir.resources module up front is slow, and in raw validation mode they aren't needed
+    at all, so each one is only imported the first time it is looked up.
+    """
+
+    def __getitem__(self, resource_name: str) -> "FHIRAbstractModel":
+        if resource_name not in RESOURCE_TYPES:
+            raise KeyError(resource_name)
+        return _load_resource_class(resource_name)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(RESOURCE_TYPES)
+
+    def __len__(self) -> int:
+        return len(RESOURCE_TYPES)
 
 
 # finally, create a reusable mapping containing all of the modules we need to process the example data
-IMPORT_MAP = {name: _load_resource_class(name) for name in RESOURCE_TYPES}
-# this is the end of the AI code
+IMPORT_MAP = _LazyImportMap()
 
 
-def load_json(json_entry: dict[str, Any]) -> dict[str, str]:
+def load_json(json_entry: dict[str, Any]) -> "FHIRAbstractModel":
     """
     Given a raw JSON entry from a fhir file, load it into a fhir.resources object.
 
@@ -53,3 +99,261 @@ def load_json(json_entry: dict[str, Any]) -> dict[str, str]:
     # load our raw data into the fhir.resources class to validate it
     loaded_resource = IMPORT_MAP[resource_type].model_validate(json_entry)
     return loaded_resource
+
+
+VALIDATION_MODES = ("full", "sampled", "raw")
+
+# errors the raw extraction functions raise when the JSON isn't the shape they expect
+RAW_EXTRACTION_ERRORS = (KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+# errors that mean there is something wrong with a resource itself, so it can be quarantined.
+# pydantic's ValidationError is a ValueError, so the failed validations are included too
+QUARANTINE_ERRORS = RAW_EXTRACTION_ERRORS
+
+# how many resources of each type have been seen in sampled mode, to know which ones to validate
+_sample_counts = Counter()
+
+
+def transform_entry(
+    json_entry: dict[str, Any],
+    validation_mode: str = "full",
+    sample_rate: int = 100,
+    stage_times: dict[str, float] | None = None,
+) -> tuple:
+    """
+    Given a raw JSON entry from a fhir file, (optionally) validate it and transform it ready for database entry.
+
+    Don't except any errors from validation, as start.py will handle these and cancel processing if so.
+
+    :param json_entry: JSON entry from the fhir file.
+    :param validation_mode: One of "full", "sampled" or "raw", see the top of this file
+    :param sample_rate: In sampled mode, validate 1 in every sample_rate resources of each type
+    :param stage_times: If given, the seconds spent validating and transforming are added onto
+        its "validate" and "transform" keys
+    :return: Processed and sanitised data in a row ready for database entry (see rows.py)
+    """
+    if stage_times is None:
+        stage_times = defaultdict(float)
+    resource_type = json_entry["resourceType"]
+
+    if validation_mode == "full":
+        return _validate_and_transform(resource_type, json_entry, stage_times)
+
+    if validation_mode == "raw":
+        return _transform_raw(resource_type, json_entry, stage_times)
+
+    if validation_mode == "sampled":
+        _sample_counts[resource_type] += 1
+        # validate the first one of each type, then every sample_rate-th one after that
+        if (_sample_counts[resource_type] - 1) % sample_rate:
+            try:
+                return _transform_raw(resource_type, json_entry, stage_times)
+            except RAW_EXTRACTION_ERRORS:
+                # unexpected shape, fall through and let the model validate it properly
+                pass
+        return _validate_and_transform(resource_type, json_entry, stage_times)
+
+    raise ValueError(f"Unknown validation mode {validation_mode}, expected one of {VALIDATION_MODES}")
+
+
+def _validate_and_transform(resource_type: str, json_entry: dict[str, Any], stage_times: dict[str, float]) -> tuple:
+    """
+    Validate an entry with its fhir.resources model then extract the data from the model, timing both.
+    """
+    started = time.perf_counter()
+    loaded_resource = load_json(json_entry)
+    validated = time.perf_counter()
+    transformed_data = transform_json(resource_type, loaded_resource)
+    stage_times["validate"] += validated - started
+    stage_times["transform"] += time.perf_counter() - validated
+    return transformed_data
+
+
+def _transform_raw(resource_type: str, json_entry: dict[str, Any], stage_times: dict[str, float]) -> tuple:
+    """
+    Extract the data straight from an entry's JSON, timing it.
+    """
+    started = time.perf_counter()
+    try:
+        return transform_raw(resource_type, json_entry)
+    finally:
+        stage_times["transform"] += time.perf_counter() - started
+
+
+def transform_batch(
+    resource_type: str,
+    json_entries: list[dict[str, Any]],
+    validation_mode: str = "full",
+    sample_rate: int = 100,
+    stage_times: dict[str, float] | None = None,
+) -> dict[str, dict[str, list]]:
+    """
+    Given the raw JSON entries for a batch of resources of one type, (optionally) validate them and
+    transform them into columns ready for database entry.
+
+    The columns are always extracted from the JSON, the models are only used to validate it, following
+    the same validation modes as transform_entry. In sampled mode, if the batch can't be extracted then
+    every resource in it is validated, so that the one with the unexpected shape is reported properly.
+
+    :param resource_type: The type of every resource in the batch, one of BATCHED_RESOURCE_TYPES
+    :param json_entries: JSON entries from the fhir file.
+    :param validation_mode: One of "full", "sampled" or "raw", see the top of this file
+    :param sample_rate: In sampled mode, validate 1 in every sample_rate resources of each type
+    :param stage_times: If given, the seconds spent validating and transforming are added onto
+        its "validate" and "transform" keys
+    :return: The columns for each table, keyed by table name
+    """
+    if stage_times is None:
+        stage_times = defaultdict(float)
+    if validation_mode not in VALIDATION_MODES:
+        raise ValueError(f"Unknown validation mode {validation_mode}, expected one of {VALIDATION_MODES}")
+
+    if validation_mode == "full":
+        to_validate = json_entries
+    elif validation_mode == "sampled":
+        to_validate = []
+        for json_entry in json_entries:
+            _sample_counts[resource_type] += 1
+            if not (_sample_counts[resource_type] - 1) % sample_rate:
+                to_validate.append(json_entry)
+    else:
+        to_validate = []
+
+    started = time.perf_counter()
+    for json_entry in to_validate:
+        load_json(json_entry)
+    stage_times["validate"] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        return transform_columns(resource_type, json_entries)
+    except RAW_EXTRACTION_ERRORS:
+        if validation_mode == "sampled":
+            # unexpected shape, let the models find which resource it is. If they all turn out
+            # to be valid then the extraction itself is wrong, so don't hide the error
+            for json_entry in json_entries:
+                load_json(json_entry)
+        raise
+    finally:
+        stage_times["transform"] += time.perf_counter() - started
+
+
+def _quarantine(quarantined: list[dict], resource: dict[str, Any], error: Exception):
+    """
+    Add a resource that failed to the quarantined list.
+
+    The error is kept as a message, as the list can be sent back from a worker process
+    and not every exception can be pickled.
+    """
+    quarantined.append({
+        "resource_type": resource.get("resourceType"),
+        "id": resource.get("id"),
+        "error": f"{type(error).__name__}: {error}",
+        "resource": resource,
+    })
+
+
+def _transform_batch_isolated(
+    resource_type: str,
+    json_entries: list[dict[str, Any]],
+    validation_mode: str,
+    sample_rate: int,
+    stage_times: dict[str, float],
+    quarantined: list[dict],
+) -> dict[str, dict[str, list]]:
+    """
+    Transform a batch that failed one resource at a time, so that only the resources that fail are quarantined.
+
+    In sampled mode every resource is validated, as they have already been counted towards the sample
+    when the whole batch was tried, and counting them again would shift which of the later resources are sampled.
+
+    :return: The columns for each table from the resources that didn't fail, keyed by table name
+    """
+    if validation_mode == "sampled":
+        validation_mode = "full"
+    merged = {}
+    for json_entry in json_entries:
+        try:
+            columns = transform_batch(resource_type, [json_entry], validation_mode, sample_rate, stage_times)
+        except QUARANTINE_ERRORS as exc:
+            _quarantine(quarantined, json_entry, exc)
+            continue
+        for table, table_columns in columns.items():
+            merged_columns = merged.setdefault(table, {column: [] for column in table_columns})
+            for column, values in table_columns.items():
+                merged_columns[column].extend(values)
+    return merged
+
+
+def transform_entries(
+    entries: list[dict[str, Any]],
+    validation_mode: str = "full",
+    sample_rate: int = 100,
+    stage_times: dict[str, float] | None = None,
+    quarantined: list[dict] | None = None,
+) -> tuple[list[dict], dict[str, dict[str, list]], int]:
+    """
+    Validate and transform every supported resource in a list of bundle entries (a whole file, or a batch of one).
+
+    Resources in BATCHED_RESOURCE_TYPES are transformed together into columns with transform_batch,
+    and the rest one at a time with transform_entry. Anything else is ignored.
+
+    If quarantined is given, a resource that fails to validate or transform is added to it (with its error)
+    and left out, and everything else carries on. If a batch of BATCHED_RESOURCE_TYPES fails, its resources are
+    transformed again one at a time to find which ones are at fault. Otherwise the first failure is raised.
+
+    :param entries: Entries from the fhir file, each with the resource under "resource"
+    :param validation_mode: One of "full", "sampled" or "raw", see the top of this file
+    :param sample_rate: In sampled mode, validate 1 in every sample_rate resources of each type
+    :param stage_times: If given, the seconds spent validating and transforming are added onto
+        its "validate" and "transform" keys
+    :param quarantined: If given, the resources that fail are added onto it rather than raised, as
+        {"resource_type": ..., "id": ..., "error": ..., "resource": ...} dictionaries
+    :return: List of {"table": ..., "data": ...} dictionaries, the columns for each table from the batched
+        resource types, and the number of resources that were transformed
+    """
+    if stage_times is None:
+        stage_times = defaultdict(float)
+
+    fhir_objects = []
+    # the raw JSON for the high volume resource types, which are transformed together into columns
+    batched_entries = defaultdict(list)
+    resource_count = 0
+    already_quarantined = len(quarantined) if quarantined is not None else 0
+
+    for entry in entries:
+        resource_type = entry["resource"]["resourceType"]
+        if resource_type not in RESOURCE_TYPES:
+            continue
+        METRICS.inc("pipeline_resources_total", type=resource_type)
+        resource_count += 1
+        if resource_type in BATCHED_RESOURCE_TYPES:
+            batched_entries[resource_type].append(entry["resource"])
+            continue
+        try:
+            transformed_data = transform_entry(entry["resource"], validation_mode, sample_rate, stage_times)
+        except QUARANTINE_ERRORS as exc:
+            if quarantined is None:
+                raise
+            _quarantine(quarantined, entry["resource"], exc)
+            continue
+        fhir_objects.append({
+            "table": resource_type,
+            "data": transformed_data
+        })
+
+    column_batches = {}
+    for resource_type, json_entries in batched_entries.items():
+        try:
+            columns = transform_batch(resource_type, json_entries, validation_mode, sample_rate, stage_times)
+        except QUARANTINE_ERRORS:
+            if quarantined is None:
+                raise
+            columns = _transform_batch_isolated(
+                resource_type, json_entries, validation_mode, sample_rate, stage_times, quarantined
+            )
+        column_batches.update(columns)
+
+    if quarantined is not None:
+        resource_count -= len(quarantined) - already_quarantined
+    return fhir_objects, column_batches, resource_count
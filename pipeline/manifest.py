@@ -0,0 +1,245 @@
+"""
+Manifest of what has already been ingested, so a file (or resource) that is sent again unchanged
+doesn't have to be parsed, validated and transformed all over again.
+
+There are three tables in the database:
+
+- ingest_manifest: the content hash of every file that has been ingested successfully.
+  A byte-identical file is skipped before it is even parsed.
+- resource_manifest: the content hash of every resource, keyed by resource type and id.
+  In a file that has changed, only the resources that are new or different are processed.
+- ingest_checkpoint: how far through each file the pipeline has got, keyed by the file's content hash,
+  for files that are committed a chunk at a time (see CHECKPOINT_SIZE in constants.py). A file that was
+  interrupted carries on from the last chunk that was committed, rather than starting again.
+
+The tables are declared in schema.py and made by db.migrate, so the database has to be one of the SINKS
+(see constants.py). The manifest is written in the same transaction as the file's rows (see db.transaction), so it
+only ever records files that were committed. A resource that has changed already has rows in the database from
+before, so with the resource manifest the rows of every resource that gets through are written with
+ON CONFLICT (id) DO UPDATE rather than skipped (see db._insert_rows), so its hash is only recorded along with
+the rows it was made from. How much of it is used is set by MANIFEST_MODE in constants.py.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+import hashlib
+import json
+import time
+from typing import Any
+
+from sqlalchemy import bindparam, text
+
+import db
+from metrics import METRICS
+
+def hash_file(file_path: str) -> str:
+    """
+    Hash the contents of a file.
+
+    :param file_path: Path to the file
+    :return: Hex digest of the file's bytes
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+def hash_resource(resource: dict[str, Any]) -> str:
+    """
+    Hash the contents of a resource, ignoring the order and formatting of its keys.
+
+    :param resource: Raw resource JSON
+    :return: Hex digest of the resource
+    """
+    canonical = json.dumps(resource, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def file_ingested(file_hash: str) -> bool:
+    """
+    Check whether a file with these exact contents has already been ingested.
+
+    :param file_hash: Hash of the file from hash_file
+    :return: True if it has
+    """
+    with db.transaction() as connection:
+        return connection.execute(
+            text("SELECT 1 FROM ingest_manifest WHERE file_hash = :file_hash"), {"file_hash": file_hash}
+        ).first() is not None
+
+
+def record_file(file_hash: str, file_name: str, resources: int):
+    """
+    Record that a file has been ingested.
+
+    :param file_hash: Hash of the file from hash_file
+    :param file_name: Name of the file, for reference
+    :param resources: Number of resources that were in the file
+    """
+    with db.transaction() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO ingest_manifest (file_hash, file_name, resources, ingested_at) "
+                "VALUES (:file_hash, :file_name, :resources, CURRENT_TIMESTAMP) "
+                "ON CONFLICT (file_hash) DO NOTHING"
+            ),
+            {"file_hash": file_hash, "file_name": file_name, "resources": resources},
+        )
+
+
+def _known_hashes(keys: list[tuple[str, str]]) -> dict[tuple[str, str], str]:
+    """
+    Look up the hashes recorded for some resources.
+
+    :param keys: (resource type, id) of each resource
+    :return: The recorded hash for each of them that has one
+    """
+    ids_by_type = defaultdict(set)
+    for resource_type, resource_id in keys:
+        ids_by_type[resource_type].add(resource_id)
+
+    # one query per type, filtering on both columns of the primary key so it can be used for the lookup
+    query = text(
+        "SELECT id, content_hash FROM resource_manifest WHERE resource_type = :resource_type AND id IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+    known = {}
+    with db.transaction() as connection:
+        for resource_type, ids in ids_by_type.items():
+            rows = connection.execute(query, {"resource_type": resource_type, "ids": list(ids)})
+            known.update(((resource_type, resource_id), content_hash) for resource_id, content_hash in rows)
+    return known
+
+
+def filter_unchanged(
+    entries: Iterable[dict],
+    resource_types: Iterable[str],
+    new_hashes: dict[tuple[str, str], str],
+    chunk_size: int = 1000,
+    stage_times: dict[str, float] | None = None,
+) -> Iterator[dict]:
+    """
+    Drop the entries whose resource is exactly the same as the last time it was ingested.
+
+    The entries are looked up chunk_size at a time, so this is one query per resource type in each chunk rather
+    than one per resource.
+
+    :param entries: The entries in a file
+    :param resource_types: The resource types to check, any other entries are passed straight through
+    :param new_hashes: The hashes of the new and changed resources are added to this, to be saved
+        with record_resources once the file has been ingested
+    :param chunk_size: How many entries to look up at once
+    :param stage_times: If given, the seconds spent hashing and looking up resources are added onto its "manifest" key
+    :return: Iterator over the entries that are new or have changed
+    """
+    if stage_times is None:
+        stage_times = defaultdict(float)
+    resource_types = set(resource_types)
+    chunk = []
+
+    def _changed() -> Iterator[dict]:
+        started = time.perf_counter()
+        hashes = {}
+        for entry in chunk:
+            resource = entry["resource"]
+            if resource["resourceType"] in resource_types and resource.get("id"):
+                hashes[(resource["resourceType"], resource["id"])] = hash_resource(resource)
+        known = _known_hashes(list(hashes)) if hashes else {}
+        stage_times["manifest"] += time.perf_counter() - started
+
+        for entry in chunk:
+            resource = entry["resource"]
+            key = (resource["resourceType"], resource.get("id"))
+            if key in hashes and known.get(key) == hashes[key]:
+                METRICS.inc("pipeline_manifest_skipped_total", kind="resource")
+                continue
+            if key in hashes:
+                new_hashes[key] = hashes[key]
+            yield entry
+        chunk.clear()
+
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            yield from _changed()
+    yield from _changed()
+
+
+def record_resources(hashes: dict[tuple[str, str], str]):
+    """
+    Record the hashes of resources that have been ingested, replacing any older ones.
+
+    :param hashes: Hash of each resource, keyed by (resource type, id)
+    """
+    if not hashes:
+        return
+    with db.transaction() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO resource_manifest (resource_type, id, content_hash) "
+                "VALUES (:resource_type, :id, :content_hash) "
+                "ON CONFLICT (resource_type, id) DO UPDATE SET content_hash = excluded.content_hash"
+            ),
+            [
+                {"resource_type": resource_type, "id": resource_id, "content_hash": content_hash}
+                for (resource_type, resource_id), content_hash in hashes.items()
+            ],
+        )
+
+
+def load_checkpoint(file_hash: str) -> dict[str, Any] | None:
+    """
+    Look up how far through a file the pipeline got the last time it was processed.
+
+    :param file_hash: Hash of the file from hash_file
+    :return: The offset of the first entry that hasn't been committed, how many resources were ingested
+        before it, and the resources that were quarantined before it, or None if there is no checkpoint
+    """
+    with db.transaction() as connection:
+        row = connection.execute(
+            text("SELECT entry_offset, resources, quarantined FROM ingest_checkpoint WHERE file_hash = :file_hash"),
+            {"file_hash": file_hash},
+        ).first()
+    if row is None:
+        return None
+    return {"entry_offset": row.entry_offset, "resources": row.resources, "quarantined": json.loads(row.quarantined)}
+
+
+def record_checkpoint(
+    file_hash: str, file_name: str, entry_offset: int, resources: int, quarantined: list[dict] | None
+):
+    """
+    Record how far through a file the pipeline has got, in the same transaction as the entries before it.
+
+    :param file_hash: Hash of the file from hash_file
+    :param file_name: Name of the file, for reference
+    :param entry_offset: The offset of the first entry that hasn't been processed yet
+    :param resources: Number of resources that have been ingested from the file so far
+    :param quarantined: The resources from the file that have been quarantined so far (see quarantine.py)
+    """
+    with db.transaction() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO ingest_checkpoint "
+                "(file_hash, file_name, entry_offset, resources, quarantined, checkpointed_at) "
+                "VALUES (:file_hash, :file_name, :entry_offset, :resources, :quarantined, CURRENT_TIMESTAMP) "
+                "ON CONFLICT (file_hash) DO UPDATE SET entry_offset = excluded.entry_offset, "
+                "resources = excluded.resources, quarantined = excluded.quarantined, "
+                "checkpointed_at = excluded.checkpointed_at"
+            ),
+            {
+                "file_hash": file_hash,
+                "file_name": file_name,
+                "entry_offset": entry_offset,
+                "resources": resources,
+                "quarantined": json.dumps(quarantined or []),
+            },
+        )
+
+
+def clear_checkpoint(file_hash: str):
+    """
+    Remove a file's checkpoint once the whole file has been ingested.
+
+    :param file_hash: Hash of the file from hash_file
+    """
+    with db.transaction() as connection:
+        connection.execute(text("DELETE FROM ingest_checkpoint WHERE file_hash = :file_hash"), {"file_hash": file_hash})
@@ -0,0 +1,275 @@
+"""
+Metrics and structured logging for the pipeline.
+
+Everything is recorded on the METRICS object in each process:
+
+- pipeline_files_total: files processed, by status (ok/failed)
+- pipeline_file_seconds: time taken to process each file
+- pipeline_stage_seconds_total: time spent in each stage (parse, validate, transform, write)
+- pipeline_resources_total: resources processed, by resource type
+- pipeline_rows_total: rows written to the database, by table and result (inserted/skipped)
+- pipeline_sink_rows_total: rows written to other sinks (e.g. Parquet), by sink and table
+- pipeline_db_round_trips_total / pipeline_db_seconds_total: statements sent to the database and time spent on them
+- pipeline_queue_depth: files waiting to be processed
+- pipeline_manifest_skipped_total: files and resources skipped because they were already ingested, by kind
+- pipeline_quarantined_total: resources quarantined instead of loaded, by resource type
+- pipeline_quarantine_replayed_total: quarantined resources replayed, by result (loaded/quarantined)
+- pipeline_checkpoints_total: chunks of a file committed along with a checkpoint
+- pipeline_checkpoint_resumed_total: files carried on from their last checkpoint
+- pipeline_files_claimed_total / pipeline_files_reclaimed_total: files claimed from a shared input directory,
+  and files moved back to it from instances whose lease had expired (see claims.py)
+- pipeline_batch_size / pipeline_batch_write_seconds: the current batch size, and the time taken to write each batch
+  (see batching.py)
+- pipeline_backpressure_seconds_total: time the async pipeline spent holding back reading while the database caught up
+- pipeline_known_id_hits_total: rows left out before being sent as their ids were known to be in the database, by table
+- pipeline_known_ids / pipeline_known_ids_bytes: ids in the index of known ids, by table, and the memory it takes up
+- pipeline_files_profiled_total: files profiled with cProfile and/or tracemalloc (see profiling.py)
+
+They can be exposed in the Prometheus text format on an HTTP port, and/or written to a stats file
+(in the same format, so it can be picked up by node_exporter's textfile collector) every few seconds.
+
+Worker processes have their own METRICS object, so they drain it after each file and send the
+values back to the main process to be merged in (see start.py). Counters (and summaries, which are a pair of
+counters) are added onto the main process's, and gauges replace its values with the worker's latest ones.
+
+log_event prints a single JSON object per line, so the logs can be parsed as well as read.
+"""
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+# type and description of each metric, used when rendering them for Prometheus
+METRIC_HELP = {
+    "pipeline_files_total": ("counter", "Files processed, by status"),
+    "pipeline_file_seconds": ("summary", "Time taken to process each file"),
+    "pipeline_stage_seconds_total": ("counter", "Time spent in each stage of processing"),
+    "pipeline_resources_total": ("counter", "FHIR resources processed, by resource type"),
+    "pipeline_rows_total": ("counter", "Rows written to the database, by table and result"),
+    "pipeline_sink_rows_total": ("counter", "Rows written to sinks other than the database, by sink and table"),
+    "pipeline_db_round_trips_total": ("counter", "Statements sent to the database"),
+    "pipeline_db_seconds_total": ("counter", "Time spent waiting on the database"),
+    "pipeline_queue_depth": ("gauge", "Files waiting to be processed"),
+    "pipeline_manifest_skipped_total": ("counter", "Files and resources skipped as they were already ingested, by kind"),
+    "pipeline_quarantined_total": ("counter", "Resources quarantined instead of loaded, by resource type"),
+    "pipeline_quarantine_replayed_total": ("counter", "Quarantined resources replayed, by result"),
+    "pipeline_checkpoints_total": ("counter", "Chunks of files committed along with a checkpoint"),
+    "pipeline_checkpoint_resumed_total": ("counter", "Files carried on from their last checkpoint"),
+    "pipeline_files_claimed_total": ("counter", "Files claimed from a shared input directory"),
+    "pipeline_files_reclaimed_total": ("counter", "Files taken back from instances whose lease had expired"),
+    "pipeline_batch_size": ("gauge", "Entries in each batch, as adapted to how long batches take to write"),
+    "pipeline_batch_write_seconds": ("summary", "Time taken to write each batch"),
+    "pipeline_backpressure_seconds_total": ("counter", "Time spent holding back reading for the database to catch up"),
+    "pipeline_known_id_hits_total": ("counter", "Rows not sent as their ids were known to be in the database, by table"),
+    "pipeline_known_ids": ("gauge", "Ids in the index of known ids, by table"),
+    "pipeline_known_ids_bytes": ("gauge", "Memory taken up by the index of known ids"),
+    "pipeline_files_profiled_total": ("counter", "Files profiled with cProfile and/or tracemalloc"),
+}
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    """
+    Format a set of labels the way Prometheus expects, e.g. {table="Patient",result="inserted"}
+
+    :param labels: Sorted (name, value) pairs
+    :return: The formatted labels, or an empty string if there aren't any
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    Thread safe store of counters and gauges, each identified by a name and a set of labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increase a counter.
+
+        :param name: Name of the metric
+        :param value: How much to increase it by
+        :param labels: Labels identifying which series of the metric to increase
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Record one observation of a summary metric, e.g. how long a file took.
+
+        :param name: Name of the metric
+        :param value: The value observed
+        :param labels: Labels identifying which series of the metric this is for
+        """
+        self.inc(f"{name}_sum", value, **labels)
+        self.inc(f"{name}_count", 1, **labels)
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """
+        Set a gauge to a value.
+
+        :param name: Name of the metric
+        :param value: The current value
+        :param labels: Labels identifying which series of the metric to set
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def get(self, name: str, **labels) -> float:
+        """
+        Get the current value of a counter or gauge.
+
+        :param name: Name of the metric
+        :param labels: Labels identifying which series of the metric to get
+        :return: The current value, 0 if it has never been set
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._gauges.get(key, self._counters.get(key, 0))
+
+    def drain(self) -> dict:
+        """
+        Take all of the counters and gauges, resetting them.
+
+        Used by worker processes to send their metrics back to the main process.
+
+        :return: The counters (including the sums and counts of summaries) and the gauges set since the last drain,
+            which can be passed to merge
+        """
+        with self._lock:
+            drained = {"counters": dict(self._counters), "gauges": dict(self._gauges)}
+            self._counters.clear()
+            self._gauges.clear()
+        return drained
+
+    def merge(self, drained: dict):
+        """
+        Add metrics from somewhere else (e.g. a worker process) onto these ones.
+
+        Counters are added together, and gauges are set to their values from there.
+
+        :param drained: Metrics returned from drain
+        """
+        with self._lock:
+            for key, value in drained["counters"].items():
+                self._counters[key] += value
+            self._gauges.update(drained["gauges"])
+
+    def render_prometheus(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        :return: The metrics, one line per series
+        """
+        with self._lock:
+            values = list(self._counters.items()) + list(self._gauges.items())
+
+        series = defaultdict(list)
+        for (name, labels), value in sorted(values):
+            # summaries are stored as <name>_sum and <name>_count
+            base_name = name.removesuffix("_sum").removesuffix("_count") if name not in METRIC_HELP else name
+            series[base_name].append(f"{name}{_format_labels(labels)} {value:g}")
+
+        lines = []
+        for base_name, series_lines in series.items():
+            if base_name in METRIC_HELP:
+                metric_type, description = METRIC_HELP[base_name]
+                lines.append(f"# HELP {base_name} {description}")
+                lines.append(f"# TYPE {base_name} {metric_type}")
+            lines.extend(series_lines)
+        return "\n".join(lines) + "\n"
+
+
+# the metrics for this process
+METRICS = Metrics()
+
+
+def log_event(event: str, message: str | None = None, **fields):
+    """
+    Print a structured log line, as a single JSON object.
+
+    :param event: Short name for what happened, e.g. file_processed
+    :param message: Human readable description of what happened
+    :param fields: Any other details worth recording
+    """
+    print(json.dumps({"time": round(time.time(), 3), "event": event, "message": message, **fields}, default=str))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics on /metrics for Prometheus to scrape.
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # don't log every scrape
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Start serving the metrics over HTTP in a background thread.
+
+    :param port: Port to listen on
+    :param host: Address to listen on
+    :return: The running server
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_stats_file(path: str):
+    """
+    Write the metrics to a file, replacing it in one go so it's never read half written.
+
+    :param path: Where to write the metrics
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as stats_file:
+        stats_file.write(METRICS.render_prometheus())
+    os.replace(temp_path, path)
+
+
+def start_stats_file_writer(path: str, interval_seconds: float) -> threading.Thread:
+    """
+    Rewrite the stats file every few seconds in a background thread.
+
+    :param path: Where to write the metrics
+    :param interval_seconds: How often to rewrite the file
+    :return: The background thread
+    """
+    def _write_forever():
+        while True:
+            write_stats_file(path)
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=_write_forever, daemon=True)
+    thread.start()
+    return thread
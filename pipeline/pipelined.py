@@ -0,0 +1,435 @@
+"""
+Pipelined ingestion, where reading, transforming and writing run at the same time (see ASYNC_PIPELINE
+in constants.py).
+
+Normally each file is read, then validated and transformed, then written, one after the other, so the CPU
+sits idle while we wait on the database and the database sits idle while we validate. Here each of those
+is a separate asyncio stage, connected to the next by a bounded queue:
+
+    read -> [queue] -> transform -> [queue] -> write
+
+Each file is split into batches of BATCH_SIZE entries, so while one batch is being written the next is
+being transformed and the one after that read, both within a file and across consecutive files.
+When a queue is full the stage before it waits, so a slow database holds back reading rather than
+letting batches pile up in memory. With ADAPTIVE_BATCH_SIZE on, the batches also get smaller while the
+database is slow, and once it is falling behind the read stage waits for every batch already queued to be
+written before reading any more (see batching.py).
+
+None of the work itself is async (the parsing and validation are CPU bound, and psycopg2 isn't an async
+driver), so each stage hands its work to its own single thread executor. The gain comes from overlapping
+them: the database driver and file reads release the GIL while they wait. For parallel CPU use
+WORKERS instead.
+
+The write stage always runs on the same thread, so each file still gets one connection and one transaction
+(see db.transaction), which is committed once the file's last batch has been written, or rolled back if
+anything went wrong with the file. If CHECKPOINT_SIZE is set, the write stage commits a file that many entries
+at a time instead, along with a checkpoint, in the same way as start.process_file.
+"""
+
+import asyncio
+from collections import defaultdict
+from collections.abc import Awaitable, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+from os.path import basename, join
+import time
+from typing import Any
+
+from constants import (
+    RESOURCE_TYPES,
+    STREAMING,
+    BATCH_SIZE,
+    VALIDATION_MODE,
+    VALIDATION_SAMPLE_RATE,
+    MANIFEST_MODE,
+    ASYNC_QUEUE_SIZE,
+    QUARANTINE,
+    CHECKPOINT_SIZE,
+    ADAPTIVE_BATCH_SIZE,
+)
+from batching import shared_batch_size
+from loader import transform_entries
+from manifest import (
+    hash_file,
+    file_ingested,
+    filter_unchanged,
+    record_file,
+    record_resources,
+    load_checkpoint,
+    record_checkpoint,
+    clear_checkpoint,
+)
+from metrics import METRICS, log_event
+from reader import read_entries, stream_entries, batches
+from sinks import add_counts, write_batch_to_sinks, sinks_transaction
+
+
+class _Rollback(Exception):
+    """Raised into a file's transaction to roll it back"""
+
+
+def _new_result() -> dict[str, Any]:
+    """
+    Start keeping track of a file as it goes through the stages.
+
+    The error, rows, stages and quarantined resources are reported in the same way as start._run_file,
+    the rest is used along the way.
+    """
+    return {
+        "error": None,
+        "rows": {},
+        "stages": defaultdict(float),
+        "started": time.perf_counter(),
+        "unchanged": False,
+        "hashes": {},
+        "resources": 0,
+        "quarantined": [] if QUARANTINE else None,
+        # how many of the file's entries have been written, and how many had been committed at the last checkpoint
+        "entry_offset": 0,
+        "checkpointed_offset": 0,
+    }
+
+
+def _check_manifest(file_path: str, result: dict[str, Any]):
+    """
+    Hash a file (the first time) and check whether it has already been ingested (if the manifest is on).
+    Runs on the read stage's thread.
+
+    :param file_path: Path to the file
+    :param result: The file's result, updated in place
+    """
+    started = time.perf_counter()
+    if "file_hash" not in result:
+        result["file_hash"] = hash_file(file_path)
+    result["unchanged"] = MANIFEST_MODE != "off" and file_ingested(result["file_hash"])
+    result["stages"]["manifest"] += time.perf_counter() - started
+
+
+def _open_file(file_path: str, result: dict[str, Any]) -> Iterator[list[dict]]:
+    """
+    Start reading a file, from its last checkpoint if it has one. Runs on the read stage's thread.
+
+    :param file_path: Path to the file
+    :param result: The file's result, updated in place
+    :return: Iterator over the batches of entries in the file
+    """
+    checkpoint = None
+    if CHECKPOINT_SIZE:
+        started = time.perf_counter()
+        checkpoint = load_checkpoint(result["file_hash"])
+        result["stages"]["manifest"] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    entries = stream_entries(file_path) if STREAMING else read_entries(file_path)
+    result["stages"]["parse"] += time.perf_counter() - started
+
+    if checkpoint:
+        # carry on from where the file got to last time. Nothing for this file has reached the write stage yet
+        result["entry_offset"] = result["checkpointed_offset"] = checkpoint["entry_offset"]
+        result["resources"] = checkpoint["resources"]
+        if result["quarantined"] is not None:
+            result["quarantined"].extend(checkpoint["quarantined"])
+        entries = islice(entries, checkpoint["entry_offset"], None)
+        METRICS.inc("pipeline_checkpoint_resumed_total")
+        log_event(
+            "file_resumed",
+            f"Resuming file {basename(file_path)} from entry {checkpoint['entry_offset']}",
+            file=basename(file_path),
+            entry_offset=checkpoint["entry_offset"],
+        )
+    return batches(entries, shared_batch_size(BATCH_SIZE) if ADAPTIVE_BATCH_SIZE else BATCH_SIZE)
+
+
+def _next_batch(file_batches: Iterator[list[dict]], result: dict[str, Any]) -> list[dict] | None:
+    """
+    Read the next batch of entries from a file. Runs on the read stage's thread.
+
+    :param file_batches: Iterator from _open_file
+    :param result: The file's result, updated in place
+    :return: The next batch, or None once the whole file has been read
+    """
+    started = time.perf_counter()
+    batch = next(file_batches, None)
+    result["stages"]["parse"] += time.perf_counter() - started
+    return batch
+
+
+def _transform(batch: list[dict], result: dict[str, Any]) -> dict[str, Any]:
+    """
+    Validate and transform a batch of entries. Runs on the transform stage's thread.
+
+    This runs ahead of the write stage, so everything about the batch is handed on with it rather than
+    being added onto the file's result, which only covers what has been written (for the checkpoints).
+
+    :param batch: Entries from the file
+    :param result: The file's result, updated in place
+    :return: The transformed rows, the columns for the batched resource types, the number of entries and
+        resources in the batch, the manifest hashes of its new and changed resources, and its quarantined resources
+    """
+    stage_times = result["stages"]
+    entry_count = len(batch)
+    hashes = {}
+    if MANIFEST_MODE == "resources":
+        batch = list(filter_unchanged(batch, RESOURCE_TYPES, hashes, len(batch), stage_times))
+    quarantined = [] if result["quarantined"] is not None else None
+    fhir_objects, column_batches, resource_count = transform_entries(
+        batch, VALIDATION_MODE, VALIDATION_SAMPLE_RATE, stage_times, quarantined
+    )
+    # the quarantined resources haven't been ingested, so they mustn't be skipped when they're sent again
+    for record in quarantined or []:
+        hashes.pop((record["resource_type"], record["id"]), None)
+    return {
+        "rows": fhir_objects,
+        "columns": column_batches,
+        "entries": entry_count,
+        "resources": resource_count,
+        "hashes": hashes,
+        "quarantined": quarantined or [],
+    }
+
+
+class _FileWriter:
+    """
+    Writes one file's batches inside a single transaction on every sink.
+
+    Every method is called on the write stage's thread, as the transaction belongs to that thread.
+    """
+
+    def __init__(self, input_file: str, result: dict[str, Any]):
+        self.input_file = input_file
+        self.result = result
+        self._transaction = ExitStack()
+        self._transaction.enter_context(sinks_transaction())
+
+    def write(self, transformed: dict[str, Any]):
+        """
+        Write a transformed batch, and commit it with a checkpoint once enough entries have been written.
+
+        :param transformed: The transformed batch from _transform
+        """
+        started = time.perf_counter()
+        result = self.result
+        # the resources that got through the manifest have changed, so overwrite them (see start._write_batch)
+        add_counts(
+            result["rows"],
+            write_batch_to_sinks(transformed["rows"], transformed["columns"], MANIFEST_MODE == "resources"),
+        )
+        result["entry_offset"] += transformed["entries"]
+        result["resources"] += transformed["resources"]
+        result["hashes"].update(transformed["hashes"])
+        if result["quarantined"] is not None:
+            result["quarantined"].extend(transformed["quarantined"])
+
+        if CHECKPOINT_SIZE and result["entry_offset"] - result["checkpointed_offset"] >= CHECKPOINT_SIZE:
+            # commit everything so far along with how far we've got, then start the next chunk
+            record_resources(result["hashes"])
+            result["hashes"].clear()
+            record_checkpoint(
+                result["file_hash"], self.input_file, result["entry_offset"], result["resources"], result["quarantined"]
+            )
+            self._transaction.close()
+            self._transaction.enter_context(sinks_transaction())
+            result["checkpointed_offset"] = result["entry_offset"]
+            METRICS.inc("pipeline_checkpoints_total")
+        seconds = time.perf_counter() - started
+        if ADAPTIVE_BATCH_SIZE:
+            shared_batch_size(BATCH_SIZE).record(transformed["entries"], seconds)
+        result["stages"]["write"] += seconds
+
+    def commit(self):
+        """
+        Record the file in the manifest and commit everything written for it.
+        """
+        started = time.perf_counter()
+        if MANIFEST_MODE != "off":
+            record_resources(self.result["hashes"])
+            record_file(self.result["file_hash"], self.input_file, self.result["resources"])
+        if CHECKPOINT_SIZE:
+            clear_checkpoint(self.result["file_hash"])
+        self._transaction.close()
+        self.result["stages"]["write"] += time.perf_counter() - started
+
+    def rollback(self):
+        """
+        Throw away everything written for the file (since its last checkpoint).
+        """
+        error = _Rollback(self.input_file)
+        self._transaction.__exit__(_Rollback, error, None)
+
+
+async def _read_stage(
+    files: list[str],
+    file_dir: str,
+    output: asyncio.Queue,
+    executor: ThreadPoolExecutor,
+    wait_for_writes: Callable[[], Awaitable[None]] | None = None,
+):
+    """
+    Read each file in turn, putting its batches of entries onto the output queue followed by an "end" marker.
+    If given, wait_for_writes is awaited before reading each batch, to hold reading back while the database is behind.
+    """
+    loop = asyncio.get_running_loop()
+    # files earlier in this run, by hash, with an event that is set once they have been finished
+    earlier_files = {}
+    for input_file in files:
+        result = _new_result()
+        file_path = join(file_dir, input_file)
+        try:
+            if MANIFEST_MODE != "off" or CHECKPOINT_SIZE:
+                await loop.run_in_executor(executor, _check_manifest, file_path, result)
+                # reading runs ahead of writing, so a file with the same contents may not have been committed yet.
+                # wait for it to finish and check again, so the copy is only processed if the first one failed
+                if not result["unchanged"] and (earlier := earlier_files.get(result["file_hash"])):
+                    await earlier.wait()
+                    await loop.run_in_executor(executor, _check_manifest, file_path, result)
+                earlier_files[result["file_hash"]] = result["finished"] = asyncio.Event()
+
+            if not result["unchanged"]:
+                file_batches = await loop.run_in_executor(executor, _open_file, file_path, result)
+                while True:
+                    if wait_for_writes:
+                        await wait_for_writes()
+                    if not (batch := await loop.run_in_executor(executor, _next_batch, file_batches, result)):
+                        break
+                    await output.put(("batch", input_file, result, batch))
+        except Exception as exc:
+            result["error"] = str(exc)
+        await output.put(("end", input_file, result, None))
+    await output.put(None)
+
+
+async def _transform_stage(
+    source: asyncio.Queue,
+    output: asyncio.Queue,
+    executor: ThreadPoolExecutor,
+    written: asyncio.Event | None = None,
+):
+    """
+    Validate and transform each batch from the source queue, passing the results on to the output queue.
+
+    Batches for a file that has already failed are dropped. If given, written is set every time a batch is
+    dropped, as it won't reach the write stage to be written.
+    """
+    loop = asyncio.get_running_loop()
+    while (item := await source.get()) is not None:
+        kind, input_file, result, batch = item
+        if kind == "batch":
+            if result["error"] is None:
+                try:
+                    item = (kind, input_file, result, await loop.run_in_executor(executor, _transform, batch, result))
+                except Exception as exc:
+                    result["error"] = str(exc)
+            if result["error"] is not None:
+                if written:
+                    written.set()
+                continue
+        await output.put(item)
+    await output.put(None)
+
+
+async def _write_stage(
+    source: asyncio.Queue,
+    executor: ThreadPoolExecutor,
+    finish_file: Callable[[str, dict[str, Any]], None],
+    file_count: int,
+    written: asyncio.Event | None = None,
+):
+    """
+    Write each transformed batch from the source queue. Once a file's "end" marker arrives its transaction is
+    committed (or rolled back if it failed anywhere along the way) and finish_file is called with its result.
+    If given, written is set every time an item has been taken off the source queue and dealt with, whether the
+    batch was written or skipped because its file had failed.
+    """
+    loop = asyncio.get_running_loop()
+    writer = None
+    remaining = file_count
+    while (item := await source.get()) is not None:
+        kind, input_file, result, transformed = item
+        try:
+            if result["error"] is None and not result["unchanged"]:
+                if writer is None:
+                    writer = await loop.run_in_executor(executor, _FileWriter, input_file, result)
+                if kind == "batch":
+                    await loop.run_in_executor(executor, writer.write, transformed)
+                else:
+                    await loop.run_in_executor(executor, writer.commit)
+                    writer = None
+        except Exception as exc:
+            result["error"] = str(exc)
+        if written:
+            written.set()
+        if kind == "batch":
+            continue
+
+        if writer is not None:
+            await loop.run_in_executor(executor, writer.rollback)
+            writer = None
+        if result["unchanged"]:
+            METRICS.inc("pipeline_manifest_skipped_total", kind="file")
+            log_event("file_unchanged", f"File {input_file} has already been ingested, skipping it", file=input_file)
+
+        finish_file(input_file, {
+            "error": result["error"],
+            "rows": result["rows"],
+            "seconds": time.perf_counter() - result["started"],
+            "stages": dict(result["stages"]),
+            "quarantined": result["quarantined"] or [],
+        })
+        if "finished" in result:
+            result["finished"].set()
+        remaining -= 1
+        METRICS.set_gauge("pipeline_queue_depth", remaining)
+
+
+async def _run(files: list[str], file_dir: str, finish_file: Callable[[str, dict[str, Any]], None], queue_size: int):
+    """
+    Run the three stages until every file has been finished.
+    """
+    read_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    written = asyncio.Event()
+
+    async def _wait_for_writes():
+        """
+        While the database is falling behind, wait for the batches already queued to be written
+        (or dropped, if their file has failed).
+        """
+        batch_size = shared_batch_size(BATCH_SIZE)
+        started = time.perf_counter()
+        while batch_size.behind and read_queue.qsize() + write_queue.qsize():
+            written.clear()
+            await written.wait()
+        if (waited := time.perf_counter() - started) > 0.001:
+            METRICS.inc("pipeline_backpressure_seconds_total", waited)
+    with (
+        ThreadPoolExecutor(1, thread_name_prefix="read") as read_executor,
+        ThreadPoolExecutor(1, thread_name_prefix="transform") as transform_executor,
+        ThreadPoolExecutor(1, thread_name_prefix="write") as write_executor,
+    ):
+        await asyncio.gather(
+            _read_stage(
+                files, file_dir, read_queue, read_executor, _wait_for_writes if ADAPTIVE_BATCH_SIZE else None
+            ),
+            _transform_stage(read_queue, write_queue, transform_executor, written),
+            _write_stage(write_queue, write_executor, finish_file, len(files), written),
+        )
+
+
+def process_files_pipelined(
+    files: list[str],
+    file_dir: str,
+    finish_file: Callable[[str, dict[str, Any]], None],
+    queue_size: int = ASYNC_QUEUE_SIZE,
+):
+    """
+    Process a set of files with the reading, transforming and writing overlapping.
+
+    :param files: Names of the files inside file_dir, processed in this order
+    :param file_dir: The input directory
+    :param finish_file: Called with the name of each file and its result (see start._run_file) once it
+        has been committed or has failed, to move it and record how it went
+    :param queue_size: How many batches can be waiting between each pair of stages
+    """
+    METRICS.set_gauge("pipeline_queue_depth", len(files))
+    asyncio.run(_run(files, file_dir, finish_file, queue_size))
@@ -0,0 +1,259 @@
+"""
+Tools for measuring where the pipeline spends its time.
+
+startup_profile reports how long it takes to get the pipeline ready to process its first file:
+the import cost of each module (measured in a fresh interpreter with python -X importtime) plus
+the cost of loading each fhir.resources class, which happens lazily the first time it's used.
+
+FileProfiler profiles individual files as the pipeline processes them, e.g. to find out why one bundle is slow
+on real traffic. It can profile the next N files, a sampled fraction of them, or both, with cProfile ("cpu")
+and/or tracemalloc ("memory"). It starts from PROFILE, PROFILE_FILES and PROFILE_SAMPLE_RATE in constants.py,
+and can be changed without restarting by dropping a control file into the input directory (see
+FileProfiler.check_control_file). Each profiled file gets a .pstats file and/or a report of where the most
+memory was allocated (see profile_file). When nothing is to be profiled, each file costs a single attribute
+check, and neither cProfile nor tracemalloc is even imported.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from os import makedirs, remove
+from os.path import dirname, abspath, join
+import random
+import subprocess
+import sys
+import time
+
+from constants import RESOURCE_TYPES, PROFILE, PROFILE_FILES, PROFILE_SAMPLE_RATE
+from metrics import METRICS, log_event
+
+PROFILERS = ("cpu", "memory")
+
+# how many of the lines that allocated the most memory to list in each report
+TOP_ALLOCATIONS = 25
+
+
+def parse_importtime(importtime_output: str) -> list[tuple[str, int, int, int]]:
+    """
+    Parse the output of python -X importtime.
+
+    Each line looks like "import time:  self [us] | cumulative | imported package", and the
+    package name is indented by two spaces for every level of nesting.
+
+    :param importtime_output: What python -X importtime wrote to stderr
+    :return: (module name, nesting depth, self time in us, cumulative time in us) for each import
+    """
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((module.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def startup_profile(budget_ms: float, top: int = 15) -> bool:
+    """
+    Measure and print how long the pipeline takes to start up, and whether that is within budget.
+
+    :param budget_ms: How long startup is allowed to take, in milliseconds
+    :param top: How many of the most expensive packages to list
+    :return: True if startup was within the budget
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import start"],
+        cwd=dirname(abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = parse_importtime(result.stderr)
+
+    # importtime lists each module after everything it imported, so everything start.py pulled in
+    # is the run of nested lines just before it. Anything before that is the interpreter starting up.
+    start_index = next(index for index, (module, depth, _, _) in enumerate(imports) if module == "start" and depth == 0)
+    first_index = start_index
+    while first_index > 0 and imports[first_index - 1][1] > 0:
+        first_index -= 1
+    imports = imports[first_index:start_index + 1]
+
+    # the modules imported directly by start.py, including our own
+    print("Import cost of start.py and what it imports directly (cumulative):")
+    for module, depth, _, cumulative_us in imports:
+        if depth <= 1:
+            print(f"  {'  ' * depth}{module:<30} {cumulative_us / 1000:8.1f} ms")
+
+    # all imports grouped by top level package
+    package_times = defaultdict(int)
+    for module, _, self_us, _ in imports:
+        package_times[module.split(".")[0]] += self_us
+    print(f"Most expensive packages (self time of all their modules, top {top}):")
+    for package, self_us in sorted(package_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {package:<30} {self_us / 1000:8.1f} ms")
+
+    # the fhir.resources classes are loaded lazily, so time loading each of them too
+    from loader import IMPORT_MAP
+    print("Lazily loaded fhir.resources classes:")
+    class_load_ms = 0.0
+    for resource_type in RESOURCE_TYPES:
+        started = time.perf_counter()
+        IMPORT_MAP[resource_type]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        class_load_ms += elapsed_ms
+        print(f"  {resource_type:<30} {elapsed_ms:8.1f} ms")
+
+    import_ms = imports[-1][3] / 1000
+    print(f"Startup: {import_ms:.1f} ms importing + {class_load_ms:.1f} ms loading classes "
+          f"= {import_ms + class_load_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+
+    within_budget = import_ms + class_load_ms <= budget_ms
+    if not within_budget:
+        print("Startup is over budget!")
+    return within_budget
+
+
+class FileProfiler:
+    """
+    Decides which files to profile, and with what.
+    """
+
+    def __init__(self, profilers: str = "", files: int = 0, sample_rate: float = 1.0):
+        self.configure(profilers, files, sample_rate)
+
+    def configure(self, profilers: str, files: int = 0, sample_rate: float = 1.0):
+        """
+        Change what is profiled, replacing the settings from before.
+
+        :param profilers: Comma separated list of "cpu" and/or "memory", or "" (or "off") to stop profiling
+        :param files: How many more files to profile before stopping, 0 for no limit
+        :param sample_rate: The fraction of files to profile, between 0 and 1
+        :raises ValueError: If any of the settings aren't valid
+        """
+        chosen = tuple(name.strip() for name in profilers.split(",") if name.strip() and name.strip() != "off")
+        if unknown := set(chosen) - set(PROFILERS):
+            raise ValueError(f"Unknown profilers {sorted(unknown)}, the options are {list(PROFILERS)}")
+        if files < 0:
+            raise ValueError(f"The number of files to profile can't be negative, not {files}")
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"The fraction of files to profile must be between 0 and 1, not {sample_rate}")
+        self.profilers = chosen
+        self.remaining = files or None
+        self.sample_rate = sample_rate
+
+    @property
+    def active(self) -> bool:
+        return bool(self.profilers)
+
+    def select(self) -> tuple[str, ...]:
+        """
+        Decide whether to profile the next file.
+
+        :return: The profilers to run while processing it, empty if it isn't to be profiled
+        """
+        if not self.profilers:
+            return ()
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return ()
+        profilers = self.profilers
+        if self.remaining is not None:
+            self.remaining -= 1
+            if not self.remaining:
+                self.profilers = ()
+        return profilers
+
+    def check_control_file(self, path: str) -> bool:
+        """
+        Pick up new settings from a control file, if one has been put there, and remove it.
+
+        The file holds any of profilers=..., files=... and sample=..., separated by spaces or new lines,
+        e.g. "profilers=cpu,memory files=5". An empty file profiles the next file with both profilers,
+        and "profilers=off" stops profiling. Settings that aren't valid are logged and ignored.
+
+        :param path: Where the control file goes
+        :return: True if there was a control file
+        """
+        try:
+            with open(path) as control_file:
+                contents = control_file.read()
+            remove(path)
+        except FileNotFoundError:
+            return False
+
+        try:
+            settings = dict(setting.split("=", 1) for setting in contents.split())
+            if unknown := set(settings) - {"profilers", "files", "sample"}:
+                raise ValueError(f"Unknown settings {sorted(unknown)}")
+            # a file saying nothing else means profile just the next one
+            files = int(settings.get("files", 1 if not settings else 0))
+            self.configure(settings.get("profilers", ",".join(PROFILERS)), files, float(settings.get("sample", 1)))
+        except ValueError as exc:
+            log_event("profiling_control_invalid", f"Ignoring the profiling control file {path}: {exc}", path=path)
+            return True
+
+        log_event(
+            "profiling_configured",
+            f"Profiling {','.join(self.profilers) or 'off'} from {path}",
+            profilers=list(self.profilers),
+            files=self.remaining,
+            sample_rate=self.sample_rate,
+        )
+        return True
+
+
+@contextmanager
+def profile_file(profilers: tuple[str, ...], output_dir: str, input_file: str) -> Iterator[None]:
+    """
+    Profile whatever is run inside the block, and write out the results for the file it processed.
+
+    With "cpu" the cProfile stats are written to <input file>.<time>.pstats (see the pstats module, or e.g.
+    snakeviz, for reading them). With "memory" the lines that allocated the most memory that was still in use
+    at the end, and the peak memory traced, are written to <input file>.<time>.allocations.txt.
+    A report that can't be written is logged rather than failing the file.
+
+    :param profilers: Which profilers to run, see FileProfiler.select
+    :param output_dir: The directory to write the results to, made if it doesn't exist
+    :param input_file: Name of the file being processed
+    """
+    cpu_profile = None
+    if "memory" in profilers:
+        import tracemalloc
+        tracemalloc.start()
+    if "cpu" in profilers:
+        import cProfile
+        cpu_profile = cProfile.Profile()
+        cpu_profile.enable()
+    try:
+        yield
+    finally:
+        if cpu_profile:
+            cpu_profile.disable()
+        if "memory" in profilers:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        name = join(output_dir, f"{input_file}.{time.strftime('%Y%m%dT%H%M%S')}")
+        paths = []
+        try:
+            makedirs(output_dir, exist_ok=True)
+            if cpu_profile:
+                cpu_profile.dump_stats(f"{name}.pstats")
+                paths.append(f"{name}.pstats")
+            if "memory" in profilers:
+                statistics = snapshot.statistics("lineno")
+                with open(f"{name}.allocations.txt", "w") as report:
+                    report.write(f"Allocations while processing {input_file}\n")
+                    report.write(f"Peak traced memory: {peak_bytes / 1024 / 1024:.1f} MB\n")
+                    report.write(f"Still allocated at the end, top {TOP_ALLOCATIONS} lines:\n")
+                    for statistic in statistics[:TOP_ALLOCATIONS]:
+                        report.write(f"  {statistic}\n")
+                paths.append(f"{name}.allocations.txt")
+        except OSError as exc:
+            log_event("profile_not_written", f"Couldn't write the profile of {input_file}: {exc}", file=input_file)
+        METRICS.inc("pipeline_files_profiled_total")
+        log_event("file_profiled", f"Profiled {input_file}, see {', '.join(paths)}", file=input_file, paths=paths)
+
+
+# what to profile in this process
+PROFILER = FileProfiler(PROFILE, PROFILE_FILES, PROFILE_SAMPLE_RATE)
@@ -0,0 +1,142 @@
+"""
+Quarantine for the individual resources that fail to validate or transform (see QUARANTINE in constants.py).
+
+Rather than one bad resource failing its whole file, it is left out and the rest of the file is loaded as normal.
+Once the file has been committed, the resources that were left out are written to <input file>.ndjson in the
+quarantine directory, one JSON object per line with the resource itself, the error it failed with and when.
+Writing them after the commit means a file that fails for some other reason (e.g. the database going away)
+doesn't leave anything in quarantine, as the whole file will be processed again when it is retried.
+
+After fixing whatever was wrong (in the data, or in the pipeline), replay_quarantine loads just the quarantined
+resources again, rather than the whole of every file they came from. This is run with start.py --replay-quarantine.
+"""
+
+from collections import Counter
+import json
+from os import listdir, remove, replace
+from os.path import join
+import time
+from typing import Any
+
+from constants import MANIFEST_MODE
+from loader import transform_entries
+from manifest import hash_resource, record_resources
+from metrics import METRICS, log_event
+from sinks import add_counts, write_batch_to_sinks, sinks_transaction
+
+
+def quarantine_path(quarantine_dir: str, input_file: str) -> str:
+    """
+    Get the path of the quarantine file for an input file.
+
+    :param quarantine_dir: The quarantine directory
+    :param input_file: Name of the file inside the input directory
+    :return: Path to its quarantine file
+    """
+    return join(quarantine_dir, f"{input_file}.ndjson")
+
+
+def write_quarantine(quarantine_dir: str, input_file: str, quarantined: list[dict[str, Any]]) -> str:
+    """
+    Write the quarantined resources from a file, replacing anything already quarantined for a file of the same name.
+
+    :param quarantine_dir: The quarantine directory
+    :param input_file: Name of the file inside the input directory
+    :param quarantined: The resources that failed, as added by loader.transform_entries
+    :return: Path to the quarantine file
+    """
+    path = quarantine_path(quarantine_dir, input_file)
+    quarantined_at = round(time.time(), 3)
+    # write it under another name first, so a half written file is never left in its place
+    with open(f"{path}.tmp", "w") as quarantine_file:
+        for record in quarantined:
+            quarantine_file.write(json.dumps({"file": input_file, "quarantined_at": quarantined_at, **record}) + "\n")
+    replace(f"{path}.tmp", path)
+    return path
+
+
+def read_quarantine(path: str) -> list[dict[str, Any]]:
+    """
+    Read the quarantined resources from a quarantine file.
+
+    :param path: Path to the quarantine file
+    :return: The quarantined records, each with the resource under "resource"
+    """
+    with open(path) as quarantine_file:
+        return [json.loads(line) for line in quarantine_file if line.strip()]
+
+
+def _replay_file(quarantine_dir: str, input_file: str, path: str) -> dict[str, Any]:
+    """
+    Load the quarantined resources from one file again, in a single transaction.
+
+    :return: How many resources were loaded and how many are still quarantined, and the rows inserted and skipped
+    """
+    records = read_quarantine(path)
+    entries = [{"resource": record["resource"]} for record in records]
+    still_quarantined = []
+    counts = {}
+
+    with sinks_transaction():
+        # these are the resources we already know are suspect, so always validate them properly
+        fhir_objects, column_batches, loaded = transform_entries(entries, "full", quarantined=still_quarantined)
+        # with the resource manifest the hashes are recorded below, so the rows must be what they're recorded as
+        add_counts(counts, write_batch_to_sinks(fhir_objects, column_batches, MANIFEST_MODE == "resources"))
+        if MANIFEST_MODE == "resources":
+            failed = {(record["resource_type"], record["id"]) for record in still_quarantined}
+            record_resources({
+                (record["resource_type"], record["id"]): hash_resource(record["resource"])
+                for record in records
+                if record["id"] and (record["resource_type"], record["id"]) not in failed
+            })
+
+    # only touch the quarantine file once everything that loaded has been committed
+    if still_quarantined:
+        write_quarantine(quarantine_dir, input_file, still_quarantined)
+    else:
+        remove(path)
+    return {"loaded": loaded, "quarantined": len(still_quarantined), "rows": counts}
+
+
+def replay_quarantine(quarantine_dir: str) -> dict[str, dict[str, Any]]:
+    """
+    Load every quarantined resource again, one quarantine file at a time.
+
+    Resources that load are removed from quarantine, and any that still fail stay there with their new error.
+    A quarantine file that fails for any other reason is left as it was.
+
+    :param quarantine_dir: The quarantine directory
+    :return: How many resources were loaded and how many are still quarantined, and the rows inserted and skipped,
+        keyed by the name of the input file they came from
+    """
+    results = {}
+    for quarantine_name in sorted(listdir(quarantine_dir)):
+        if not quarantine_name.endswith(".ndjson"):
+            continue
+        input_file = quarantine_name.removesuffix(".ndjson")
+        path = join(quarantine_dir, quarantine_name)
+        try:
+            result = results[input_file] = _replay_file(quarantine_dir, input_file, path)
+        except Exception as exc:
+            log_event("quarantine_replay_failed", f"Replaying {path} failed: {exc}", file=input_file, error=str(exc))
+            continue
+
+        METRICS.inc("pipeline_quarantine_replayed_total", result["loaded"], result="loaded")
+        METRICS.inc("pipeline_quarantine_replayed_total", result["quarantined"], result="quarantined")
+        log_event(
+            "quarantine_replayed",
+            f"Loaded {result['loaded']} quarantined resources from {input_file}, {result['quarantined']} still failed",
+            file=input_file,
+            **result,
+        )
+    return results
+
+
+def count_by_type(quarantined: list[dict[str, Any]]) -> dict[str, int]:
+    """
+    Count quarantined resources by resource type, for the logs and metrics.
+
+    :param quarantined: The resources that failed, as added by loader.transform_entries
+    :return: Number of resources quarantined, keyed by resource type
+    """
+    return dict(Counter(record["resource_type"] for record in quarantined))
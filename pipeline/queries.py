@@ -0,0 +1,83 @@
+"""
+Helpers for reading the data back out of the database, for whatever uses it.
+
+A patient's timeline comes from the patient_timeline table (see timeline.py), which is indexed on
+(patient_id, event_time, id), so each of these is a single range scan of that index however much else is in there.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Select, select
+
+import db
+from rows import PatientTimelineRow
+from schema import TABLES
+from timeline import TIMELINE_TABLE
+
+
+def timeline_query(
+        patient_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        resource_types: list[str] | None = None,
+        limit: int | None = None,
+) -> Select:
+    """
+    Build the query for a patient's timeline, see patient_timeline.
+
+    :return: The query, e.g. to run with other options or to EXPLAIN
+    """
+    table = TABLES[TIMELINE_TABLE]
+    query = select(table).where(table.c.patient_id == patient_id)
+    if since is not None:
+        query = query.where(table.c.event_time >= since)
+    if until is not None:
+        query = query.where(table.c.event_time < until)
+    if resource_types:
+        query = query.where(table.c.resource_type.in_(resource_types))
+    query = query.order_by(table.c.event_time, table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def patient_timeline(
+        patient_id: str,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        resource_types: list[str] | None = None,
+        limit: int | None = None,
+) -> list[PatientTimelineRow]:
+    """
+    Get everything that has happened to a patient, in time order.
+
+    :param patient_id: The patient's id
+    :param since: Only events at or after this time
+    :param until: Only events before this time
+    :param resource_types: Only these kinds of event, e.g. ["Encounter", "Condition"]
+    :param limit: At most this many events, the earliest first
+    :return: The events, oldest first
+    """
+    query = timeline_query(patient_id, since, until, resource_types, limit)
+    with db.transaction() as connection:
+        return [PatientTimelineRow(*row) for row in connection.execute(query)]
+
+
+def latest_events(patient_id: str, count: int = 10) -> list[PatientTimelineRow]:
+    """
+    Get the most recent things to have happened to a patient, e.g. for a summary view.
+
+    :param patient_id: The patient's id
+    :param count: How many events to get
+    :return: The events, newest first
+    """
+    table = TABLES[TIMELINE_TABLE]
+    # the same index, scanned backwards
+    query = (
+        select(table)
+        .where(table.c.patient_id == patient_id, table.c.event_time.is_not(None))
+        .order_by(table.c.event_time.desc(), table.c.id.desc())
+        .limit(count)
+    )
+    with db.transaction() as connection:
+        return [PatientTimelineRow(*row) for row in connection.execute(query)]
@@ -0,0 +1,93 @@
+"""
+Read the entries out of a FHIR bundle file.
+
+Normally the whole file is loaded at once. It is memory mapped and parsed straight from its bytes
+with orjson, which is several times faster than the json module and doesn't need the bytes decoding
+into a str first (which would be a second copy of the whole file). If orjson isn't installed, or
+JSON_DECODER is set to "json", the json module is used instead.
+
+The largest bundles are tens of megabytes, so there is also a streaming mode which uses ijson to pull
+the items out of the "entry" list one at a time without ever holding the whole document in memory.
+"""
+
+from collections.abc import Callable, Iterable, Iterator
+import json
+import mmap
+import os
+from typing import Any
+
+import ijson
+
+from constants import JSON_DECODER
+
+# orjson is optional, fall back to the json module without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_DECODERS = ("orjson", "json")
+
+
+def read_entries(file_path: str, decoder: str = JSON_DECODER) -> list[dict[str, Any]]:
+    """
+    Load a whole bundle file and return its entries.
+
+    :param file_path: Path to the bundle file
+    :param decoder: "orjson" or "json", see the top of this file
+    :return: The list of entries in the bundle
+    """
+    if decoder not in JSON_DECODERS:
+        raise ValueError(f"Unknown JSON decoder {decoder}, expected one of {JSON_DECODERS}")
+
+    with open(file_path, "rb") as file_data:
+        # an empty file can't be mapped, let the decoder report it as invalid JSON
+        if decoder == "json" or orjson is None or not os.fstat(file_data.fileno()).st_size:
+            raw_json = json.load(file_data)
+        else:
+            with (
+                mmap.mmap(file_data.fileno(), 0, access=mmap.ACCESS_READ) as buffer,
+                memoryview(buffer) as view,
+            ):
+                raw_json = orjson.loads(view)
+
+    # each fhir file has all of the data under the "entry" key.
+    return raw_json["entry"]
+
+
+def stream_entries(file_path: str) -> Iterator[dict[str, Any]]:
+    """
+    Incrementally parse a bundle file, yielding each entry as soon as it has been read.
+
+    Only the entry currently being parsed is held in memory.
+    use_float keeps numbers the same type that json.load gives us, rather than Decimal.
+
+    :param file_path: Path to the bundle file
+    :return: Iterator over the entries in the bundle
+    """
+    with open(file_path, "rb") as file_data:
+        yield from ijson.items(file_data, "entry.item", use_float=True)
+
+
+def batches(
+    entries: Iterable[dict[str, Any]], batch_size: int | Callable[[], int]
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Group entries into lists of batch_size (the last one can be smaller).
+
+    :param entries: The entries in a bundle, from read_entries or stream_entries
+    :param batch_size: How many entries to put in each batch, or a function giving the size of the next batch
+        each time one is started (e.g. batching.AdaptiveBatchSize)
+    :return: Iterator over the batches
+    """
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    batch = []
+    size = next_size()
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+            size = next_size()
+    if batch:
+        yield batch
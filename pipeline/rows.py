@@ -0,0 +1,220 @@
+"""
+Row records for each table, as produced by the functions in extract.py.
+
+Each transformed resource is a NamedTuple rather than a dictionary, so a table's column names and
+their order are fixed and stored once on the class rather than in every row, and the rows can be
+handed to the database (or any other sink) as the tuples they already are.
+
+Observations and DiagnosticReports are extracted into columns rather than rows (see extract.py),
+but their column order is still taken from the records here, so every table is described in one place.
+
+The annotations are the declared type of each column: dates and times are datetimes (or a date,
+for a birth date), money is a Decimal with its currency in a column of its own, and so on.
+schema.py builds the database tables from them.
+
+Values that repeat across a lot of rows, such as statuses, codes, provider and location names and
+the ids of the patient and encounter a resource belongs to, are passed through intern() as they are
+extracted, so all of the rows for a file share one copy of each string rather than holding their own.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+import sys
+from typing import NamedTuple, get_args, get_type_hints
+
+
+def intern(value):
+    """
+    Intern a string that is likely to be repeated across many rows.
+
+    :param value: The extracted value
+    :return: The interned string, or the value unchanged if it isn't a string (e.g. None)
+    """
+    return sys.intern(value) if type(value) is str else value
+
+
+def column_types(row_type: type) -> dict[str, type]:
+    """
+    Get the declared type of each column of a row record, from its annotations.
+
+    :param row_type: One of the row records below
+    :return: The Python type of each column (without the None for columns that can be empty), keyed by column name
+    """
+    columns = {}
+    for column, annotation in get_type_hints(row_type).items():
+        columns[column] = next(
+            (python_type for python_type in get_args(annotation) if python_type is not type(None)), annotation
+        )
+    return columns
+
+
+class PatientRow(NamedTuple):
+    id: str
+    social_security_number: str | None
+    drivers_license: str | None
+    passport_number: str | None
+    given_name: str
+    family_name: str | None
+    house: str
+    city: str | None
+    state: str | None
+    country: str | None
+    birth_date: date
+    deceased_date: datetime | None
+    deceased: bool
+    gender: str | None
+    spoken_language: str | None
+    phone_number: str | None
+    marital_status: str | None
+
+
+class EncounterRow(NamedTuple):
+    id: str
+    patient_id: str
+    status: str
+    type: str | None
+    start_date: datetime | None
+    end_date: datetime | None
+    subject: str | None
+    participant: str | None
+    location: str | None
+    service_provider: str | None
+
+
+class ConditionRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str
+    clinical_status: str | None
+    verification_status: str | None
+    category: str | None
+    onset_date: datetime | None
+    abatement_date: datetime | None
+    condition_information: str | None
+
+
+class ClaimRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str
+    condition_id: str | None
+    status: str
+    billable_period_start: datetime | None
+    billable_period_end: datetime | None
+    provider: str | None
+    priority: str | None
+    insurance_coverage: str | None
+    total_cost: Decimal
+    currency: str | None
+
+
+class ProcedureRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str
+    status: str
+    procedure_name: str | None
+    performed_period_start: datetime | None
+    performed_period_end: datetime | None
+    location: str | None
+
+
+class ImmunizationRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str
+    vaccine_code: str | None
+    vaccine_type: str | None
+    occurrence_date: datetime | None
+    location: str | None
+
+
+class MedicationRequestRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str
+    condition_id: str | None
+    status: str
+    intent: str
+    authored_on: datetime | None
+    medication_code: str | None
+    medication_name: str | None
+    medication_reference_id: str | None
+    requester: str | None
+
+
+class MedicationRow(NamedTuple):
+    id: str
+    medication_status: str | None
+    medication_code: str | None
+    medication_name: str | None
+
+
+class ObservationRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str | None
+    status: str
+    category: str | None
+    code: str | None
+    code_display: str | None
+    value: float | None
+    unit: str | None
+    value_code: str | None
+    value_text: str | None
+    effective_date: datetime | None
+    issued_date: datetime | None
+
+
+class ObservationComponentRow(NamedTuple):
+    id: str
+    observation_id: str
+    patient_id: str
+    code: str | None
+    code_display: str | None
+    value: float | None
+    unit: str | None
+    value_code: str | None
+    value_text: str | None
+
+
+class DiagnosticReportRow(NamedTuple):
+    id: str
+    patient_id: str
+    encounter_id: str | None
+    status: str
+    category: str | None
+    code: str | None
+    code_display: str | None
+    effective_date: datetime | None
+    issued_date: datetime | None
+    performer: str | None
+    result_count: int
+
+
+class PatientTimelineRow(NamedTuple):
+    # <resource type>/<resource id>
+    id: str
+    patient_id: str
+    event_time: datetime | None
+    resource_type: str
+    resource_id: str
+    summary: str | None
+
+
+# the record for each table, keyed by table name
+ROW_TYPES = {
+    "Patient": PatientRow,
+    "Encounter": EncounterRow,
+    "Condition": ConditionRow,
+    "Claim": ClaimRow,
+    "Procedure": ProcedureRow,
+    "Immunization": ImmunizationRow,
+    "MedicationRequest": MedicationRequestRow,
+    "Medication": MedicationRow,
+    "Observation": ObservationRow,
+    "ObservationComponent": ObservationComponentRow,
+    "DiagnosticReport": DiagnosticReportRow,
+    # made from the other tables as they are written, see timeline.py
+    "patient_timeline": PatientTimelineRow,
+}
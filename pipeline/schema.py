@@ -0,0 +1,98 @@
+"""
+The declared schema of every table the pipeline writes to.
+
+Each table is built from its row record in rows.py, so the columns and their types are only written
+down once. Every table has a primary key on id (which is what lets the database skip rows that already
+exist with ON CONFLICT), and an index on each of the columns that are used to look up a patient's
+or an encounter's records, so those queries don't have to scan the whole table.
+
+The manifest tables, which keep track of what has already been ingested (see manifest.py), are declared here too.
+
+Tables that were created by older versions of the pipeline, before there was a declared schema,
+are brought up to date by db.migrate when the pipeline starts.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import (
+    MetaData, Table, Column, Index, BigInteger, Boolean, Date, DateTime, Float, Integer, Numeric, Text
+)
+
+from rows import ROW_TYPES, column_types
+
+
+# the database type for each Python type used in the row records
+SQL_TYPES = {
+    str: Text,
+    bool: Boolean,
+    int: BigInteger,
+    float: Float,
+    # money, which always has 2 decimal places
+    Decimal: Numeric(12, 2),
+    datetime: DateTime(timezone=True),
+    date: Date,
+}
+
+# columns that get an index wherever they appear
+INDEXED_COLUMNS = ("patient_id", "encounter_id", "observation_id")
+
+# the indexes of any table that needs something other than the ones from INDEXED_COLUMNS, each a tuple of columns
+TABLE_INDEXES = {
+    # a patient's timeline is read in time order (and then by id, for events at the same time),
+    # so that is a single range scan of this index
+    "patient_timeline": [("patient_id", "event_time", "id")],
+}
+
+METADATA = MetaData()
+
+
+def _declare_table(table_name: str, row_type: type) -> Table:
+    """
+    Declare the table for a row record.
+
+    :param table_name: Name of the table
+    :param row_type: The row record from rows.py
+    :return: The table, attached to METADATA
+    """
+    columns = [
+        Column(column, SQL_TYPES[python_type], primary_key=column == "id")
+        for column, python_type in column_types(row_type).items()
+    ]
+    index_columns = TABLE_INDEXES.get(
+        table_name, [(column,) for column in INDEXED_COLUMNS if column in row_type._fields]
+    )
+    indexes = [Index(f"ix_{table_name}_{'_'.join(columns)}", *columns) for columns in index_columns]
+    return Table(table_name, METADATA, *columns, *indexes)
+
+
+TABLES = {table_name: _declare_table(table_name, row_type) for table_name, row_type in ROW_TYPES.items()}
+
+# the tables that keep track of what has been ingested (see manifest.py), rather than holding the data itself.
+# The times are text as they were when these were first created with plain SQL
+MANIFEST_TABLES = {
+    table.name: table for table in [
+        Table(
+            "ingest_manifest", METADATA,
+            Column("file_hash", Text, primary_key=True),
+            Column("file_name", Text),
+            Column("resources", Integer),
+            Column("ingested_at", Text),
+        ),
+        Table(
+            "resource_manifest", METADATA,
+            Column("resource_type", Text, primary_key=True),
+            Column("id", Text, primary_key=True),
+            Column("content_hash", Text),
+        ),
+        Table(
+            "ingest_checkpoint", METADATA,
+            Column("file_hash", Text, primary_key=True),
+            Column("file_name", Text),
+            Column("entry_offset", Integer),
+            Column("resources", Integer),
+            Column("quarantined", Text),
+            Column("checkpointed_at", Text),
+        ),
+    ]
+}
@@ -0,0 +1,389 @@
+"""
+Places the transformed data can be written to.
+
+Every sink has the same interface:
+
+- write(fhir_objects, update) takes a list of {"table": ..., "data": ...} dictionaries (the same as
+  db.send_objects) and returns the counts of rows inserted and skipped, keyed by table. With update, rows that
+  are already there are overwritten rather than skipped, e.g. for resources that have changed (see manifest.py)
+- write_columns(column_batches, update) does the same for batches of columns, {table: {column: [values]}},
+  as produced for the high volume resource types by loader.transform_batch
+- transaction() is a context manager that every write for a file happens inside, so a sink that can
+  (the database) only keeps the file's rows if the whole file succeeded
+- close() finishes off anything still buffered
+
+The sinks to use are picked with SINKS in constants.py, so the data can go to Postgres, Parquet files or both.
+
+- postgres: the database, via db.send_objects. This also keeps the patient timeline up to date (see timeline.py)
+- parquet: columnar Parquet files, partitioned by table and ingest date. Each table's columns and their types come
+  from its row record in rows.py, the same as its table in the database. Rows are buffered per table and written
+  out a row group at a time, and each file is rolled over once it reaches a size limit. A file is written with an
+  .inprogress suffix and only renamed to .parquet once it has been closed, so anything reading the directory
+  never sees a half written file.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext, ExitStack
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+import os
+import time
+
+import db
+from constants import (
+    SINKS, PARQUET_DIR, PARQUET_ROW_GROUP_SIZE, PARQUET_MAX_FILE_MB, PARQUET_COMPRESSION, PATIENT_TIMELINE
+)
+from metrics import METRICS
+from rows import ROW_TYPES, column_types
+from timeline import timeline_objects
+
+
+class DatabaseSink:
+    """
+    Write rows to the database (Postgres, or whatever db.get_db_engine gives us).
+    """
+
+    name = "postgres"
+
+    def write(self, fhir_objects: list[dict], update: bool = False) -> dict[str, dict[str, int]]:
+        """
+        Write the rows to the database, skipping any that already exist, along with their events on the timeline.
+
+        :param fhir_objects: List of {"table": ..., "data": ...} dictionaries
+        :param update: Overwrite the rows (and events) that already exist instead of skipping them
+        :return: Counts of the rows inserted and skipped, keyed by table
+        """
+        if PATIENT_TIMELINE:
+            # in the same transaction, so the timeline always matches the tables it is made from
+            fhir_objects = fhir_objects + timeline_objects(fhir_objects)
+        return db.send_objects(fhir_objects, update)
+
+    def write_columns(
+        self, column_batches: dict[str, dict[str, list]], update: bool = False
+    ) -> dict[str, dict[str, int]]:
+        """
+        Write batches of columns to the database, skipping any rows that already exist.
+
+        :param column_batches: The columns for each table, keyed by table name
+        :param update: Overwrite the rows that already exist instead of skipping them
+        :return: Counts of the rows inserted and skipped, keyed by table
+        """
+        return db.send_column_batches(column_batches, update)
+
+    def transaction(self):
+        """
+        Write everything inside this block in one database transaction, committed only if the block succeeds.
+        """
+        return db.transaction()
+
+    def close(self):
+        """Nothing is buffered, so there's nothing to do"""
+
+
+def _arrow_type(python_type: type):
+    """
+    Get the Parquet column type for the Python type of a column in a row record, matching schema.SQL_TYPES.
+
+    :param python_type: The declared type of the column, see rows.column_types
+    :return: The pyarrow type to use
+    """
+    import pyarrow
+
+    return {
+        str: pyarrow.string(),
+        bool: pyarrow.bool_(),
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        # money, which always has 2 decimal places
+        Decimal: pyarrow.decimal128(12, 2),
+        datetime: pyarrow.timestamp("us", tz="UTC"),
+        date: pyarrow.date32(),
+    }[python_type]
+
+
+def _rows_to_columns(rows: list[tuple] | list[dict]) -> dict[str, list]:
+    """
+    Turn a table's rows into a list of values per column.
+
+    :param rows: Row records from extract.py (see rows.py), or dictionaries
+    :return: The values of each column, keyed by column name
+    """
+    if isinstance(rows[0], tuple):
+        return {column: list(values) for column, values in zip(rows[0]._fields, zip(*rows))}
+    return {
+        column: [row.get(column) for row in rows]
+        for column in dict.fromkeys(column for row in rows for column in row)
+    }
+
+
+class ParquetSink:
+    """
+    Write rows to Parquet files, one directory per table and ingest date:
+
+        <directory>/<table>/ingest_date=<YYYY-MM-DD>/part-<timestamp>-<pid>-<n>.parquet
+    """
+
+    name = "parquet"
+
+    def __init__(
+        self,
+        directory: str,
+        row_group_size: int = 100_000,
+        max_file_bytes: int = 256 * 1024 * 1024,
+        compression: str = "zstd",
+    ):
+        # only import pyarrow if the parquet sink is actually being used, it's a large import
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.max_file_bytes = max_file_bytes
+        self.compression = compression
+        # rows waiting to be written, per table, held as a list of values per column
+        self._buffers = defaultdict(dict)
+        self._buffered_rows = defaultdict(int)
+        # the schema of each table, from its row record
+        self._schemas = {}
+        # the open file for each table, as (writer, output stream, in progress path, ingest date)
+        self._open_files = {}
+        self._file_count = 0
+
+    def write(self, fhir_objects: list[dict], update: bool = False) -> dict[str, dict[str, int]]:
+        """
+        Buffer the rows, writing out a row group for any table which has a full one.
+
+        :param fhir_objects: List of {"table": ..., "data": ...} dictionaries
+        :param update: Ignored, the files are a log of everything written, so a changed row is just written again
+        :return: Counts of the rows written, keyed by table (nothing is ever skipped)
+        """
+        tables = defaultdict(list)
+        for fhir_object in fhir_objects:
+            if fhir_object["data"]:
+                tables[fhir_object["table"]].append(fhir_object["data"])
+
+        return self.write_columns({table: _rows_to_columns(rows) for table, rows in tables.items()})
+
+    def write_columns(
+        self, column_batches: dict[str, dict[str, list]], update: bool = False
+    ) -> dict[str, dict[str, int]]:
+        """
+        Buffer batches of columns, writing out a row group for any table which has a full one.
+
+        :param column_batches: The columns for each table, keyed by table name
+        :param update: Ignored, see write
+        :return: Counts of the rows written, keyed by table (nothing is ever skipped)
+        """
+        counts = {}
+        for table, columns in column_batches.items():
+            row_count = len(next(iter(columns.values()), []))
+            if not row_count:
+                continue
+
+            schema = self._schema(table)
+            if unknown := set(columns) - set(schema.names):
+                raise ValueError(f"Columns {sorted(unknown)} aren't declared for the {table} table in rows.py")
+            buffer = self._buffers[table]
+            for field in schema:
+                buffer.setdefault(field.name, []).extend(columns.get(field.name, [None] * row_count))
+            self._buffered_rows[table] += row_count
+
+            while self._buffered_rows[table] >= self.row_group_size:
+                self._write_row_group(table, self.row_group_size)
+
+            counts[table] = {"inserted": row_count, "skipped": 0}
+            METRICS.inc("pipeline_sink_rows_total", row_count, sink=self.name, table=table)
+        return counts
+
+    def _schema(self, table: str):
+        """
+        Get the schema for a table, from its row record in rows.py.
+
+        :param table: Name of the table
+        :return: pyarrow schema for the table
+        :raises ValueError: If the table isn't declared in rows.py
+        """
+        if table not in self._schemas:
+            if table not in ROW_TYPES:
+                raise ValueError(f"The {table} table isn't declared in rows.py, so it can't be written to Parquet")
+            self._schemas[table] = self._pyarrow.schema(
+                [(column, _arrow_type(python_type)) for column, python_type in column_types(ROW_TYPES[table]).items()]
+            )
+        return self._schemas[table]
+
+    def _write_row_group(self, table: str, row_count: int):
+        """
+        Write the first row_count buffered rows of a table to its current file as a row group,
+        rolling over to a new file if needed.
+
+        :param table: Name of the table
+        :param row_count: How many of the buffered rows to write
+        """
+        buffer = self._buffers[table]
+        columns = {column: values[:row_count] for column, values in buffer.items()}
+        for values in buffer.values():
+            del values[:row_count]
+        self._buffered_rows[table] -= row_count
+
+        ingest_date = date.today().isoformat()
+        if table in self._open_files and self._open_files[table][3] != ingest_date:
+            self._close_file(table)
+
+        schema = self._schema(table)
+        if table not in self._open_files:
+            partition_dir = os.path.join(self.directory, table, f"ingest_date={ingest_date}")
+            os.makedirs(partition_dir, exist_ok=True)
+            self._file_count += 1
+            path = os.path.join(
+                partition_dir, f"part-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self._file_count}.parquet.inprogress"
+            )
+            stream = self._pyarrow.OSFile(path, "wb")
+            writer = self._parquet.ParquetWriter(stream, schema, compression=self.compression)
+            self._open_files[table] = (writer, stream, path, ingest_date)
+
+        writer, stream, _, _ = self._open_files[table]
+        row_group = self._pyarrow.Table.from_pydict(columns, schema=schema)
+        writer.write_table(row_group, row_group_size=row_count)
+
+        if stream.tell() >= self.max_file_bytes:
+            self._close_file(table)
+
+    def _close_file(self, table: str):
+        """
+        Close the table's current file and give it its final name.
+
+        :param table: Name of the table
+        """
+        writer, stream, path, _ = self._open_files.pop(table)
+        writer.close()
+        stream.close()
+        os.replace(path, path.removesuffix(".inprogress"))
+
+    def transaction(self):
+        """
+        Parquet files can't be rolled back, so rows from a file that fails part way through may
+        still be written out. Nothing needs doing here.
+        """
+        return nullcontext()
+
+    def close(self):
+        """
+        Write out everything that's still buffered and close all of the open files.
+        """
+        for table, row_count in self._buffered_rows.items():
+            if row_count:
+                self._write_row_group(table, row_count)
+        self._buffers.clear()
+        self._buffered_rows.clear()
+        for table in list(self._open_files):
+            self._close_file(table)
+
+
+def create_sink(name: str):
+    """
+    Create a sink from its name.
+
+    :param name: "postgres" or "parquet"
+    :return: The sink
+    """
+    if name == "postgres":
+        return DatabaseSink()
+    if name == "parquet":
+        return ParquetSink(
+            PARQUET_DIR,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            max_file_bytes=int(PARQUET_MAX_FILE_MB * 1024 * 1024),
+            compression=PARQUET_COMPRESSION,
+        )
+    raise ValueError(f"Unknown sink {name}, expected postgres or parquet")
+
+
+# cached in the same way as db.get_db_engine, so each process makes its sinks once
+@lru_cache()
+def get_sinks() -> list:
+    """
+    Get the sinks picked in SINKS, creating them the first time.
+
+    :return: List of sinks to write to
+    """
+    return [create_sink(name.strip()) for name in SINKS.split(",") if name.strip()]
+
+
+def write_to_sinks(fhir_objects: list[dict], update: bool = False) -> dict[str, dict[str, int]]:
+    """
+    Write the rows to every sink.
+
+    :param fhir_objects: List of {"table": ..., "data": ...} dictionaries
+    :param update: Overwrite rows that are already there instead of skipping them
+    :return: Counts of rows inserted and skipped from the first sink, keyed by table
+    """
+    counts = [sink.write(fhir_objects, update) for sink in get_sinks()]
+    return counts[0] if counts else {}
+
+
+def write_columns_to_sinks(
+    column_batches: dict[str, dict[str, list]], update: bool = False
+) -> dict[str, dict[str, int]]:
+    """
+    Write batches of columns to every sink.
+
+    :param column_batches: The columns for each table, keyed by table name
+    :param update: Overwrite rows that are already there instead of skipping them
+    :return: Counts of rows inserted and skipped from the first sink, keyed by table
+    """
+    counts = [sink.write_columns(column_batches, update) for sink in get_sinks()]
+    return counts[0] if counts else {}
+
+
+def add_counts(total_counts: dict[str, dict[str, int]], counts: dict[str, dict[str, int]]):
+    """
+    Add the inserted/skipped counts from one write onto the running totals, e.g. for a file.
+
+    :param total_counts: Running totals, keyed by table. Updated in place.
+    :param counts: Counts returned by one of the write functions
+    """
+    for table, table_counts in counts.items():
+        table_totals = total_counts.setdefault(table, {"inserted": 0, "skipped": 0})
+        for key, value in table_counts.items():
+            table_totals[key] += value
+
+
+def write_batch_to_sinks(
+    fhir_objects: list[dict], column_batches: dict[str, dict[str, list]], update: bool = False
+) -> dict[str, dict[str, int]]:
+    """
+    Write transformed rows, and the columns for the batched resource types, to every sink.
+
+    :param fhir_objects: List of {"table": ..., "data": ...} dictionaries
+    :param column_batches: The columns for each table, keyed by table name
+    :param update: Overwrite rows that are already there instead of skipping them
+    :return: Counts of rows inserted and skipped from the first sink, keyed by table
+    """
+    counts = write_to_sinks(fhir_objects, update)
+    if column_batches:
+        add_counts(counts, write_columns_to_sinks(column_batches, update))
+    return counts
+
+
+@contextmanager
+def sinks_transaction() -> Iterator[None]:
+    """
+    Run every write inside this block inside a transaction on every sink, e.g. for the whole of one file.
+    """
+    with ExitStack() as stack:
+        for sink in get_sinks():
+            stack.enter_context(sink.transaction())
+        yield
+
+
+def close_sinks():
+    """
+    Close every sink that has been created, e.g. when the pipeline goes idle or shuts down.
+    """
+    if get_sinks.cache_info().currsize:
+        for sink in get_sinks():
+            sink.close()
@@ -8,24 +8,459 @@ Main processing file for the data pipeline:
 - move each processed file to the finished folder
 
 If processing fails then move the file to the failed folder and continue to the next file.
+A resource that fails on its own is quarantined instead, and the rest of its file is still loaded
+(see QUARANTINE in constants.py, and quarantine.py).
 
 Once all currently found files have been processed, wait until more files have been added.
-Repeat the process if more arrive.
+Repeat the process if more arrive. New files are noticed with inotify where possible, or by polling
+the directory otherwise (see watcher.py).
+
+Files can optionally be processed in parallel by a pool of worker processes (see WORKERS in
+constants.py). Each worker loads, validates, transforms and writes a whole file, and the main
+process moves the file once the worker reports back.
+
+Several instances of the pipeline (e.g. on different nodes) can also share one input directory, claiming
+each file before processing it so that no file is processed by two of them at once (see SHARED_INBOX
+in constants.py, and claims.py).
+
+For very large files there is also a streaming mode (see STREAMING in constants.py) which reads
+entries incrementally and writes them in batches, rather than holding the whole file in memory.
+The size of the batches can adapt to how quickly the database is writing them (see batching.py).
+
+Alternatively the reading, transforming and writing can overlap with each other as stages of an asyncio
+pipeline (see ASYNC_PIPELINE in constants.py, and pipelined.py).
+
+Any file can also be profiled as it is processed, to find out where the time or memory goes on real traffic
+(see PROFILE in constants.py, and profiling.py).
+
+Before any files are processed, the database tables are brought up to the schema declared in schema.py
+(see db.migrate).
 """
-import json
-from os import listdir, makedirs
-from os.path import join, dirname, abspath
+import argparse
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+from functools import partial
+from itertools import islice
+from multiprocessing.util import Finalize
+from os import listdir, makedirs, cpu_count
+from os.path import join, dirname, abspath, exists
 from shutil import move
+import sys
 import time
+from typing import Any
 
-from constants import RESOURCE_TYPES
-from extract import transform_json
-from db import send_object
-from loader import load_json
+from batching import shared_batch_size
+from claims import SharedInbox
+from constants import (
+    RESOURCE_TYPES,
+    WORKERS,
+    STREAMING,
+    BATCH_SIZE,
+    VALIDATION_MODE,
+    VALIDATION_SAMPLE_RATE,
+    STARTUP_BUDGET_MS,
+    WATCH_MODE,
+    WATCH_DEBOUNCE_MS,
+    WATCH_RESCAN_SECONDS,
+    METRICS_PORT,
+    METRICS_FILE,
+    METRICS_FILE_INTERVAL,
+    MANIFEST_MODE,
+    ASYNC_PIPELINE,
+    QUARANTINE,
+    CHECKPOINT_SIZE,
+    ADAPTIVE_BATCH_SIZE,
+    SHARED_INBOX,
+    INSTANCE_ID,
+    LEASE_SECONDS,
+    HEARTBEAT_SECONDS,
+    CLAIM_FILES,
+    KNOWN_ID_INDEX,
+)
+from db import dispose_inherited_engine, migrate, prewarm_known_ids
+from loader import transform_entries
+from manifest import (
+    hash_file,
+    file_ingested,
+    filter_unchanged,
+    record_file,
+    record_resources,
+    load_checkpoint,
+    record_checkpoint,
+    clear_checkpoint,
+)
+from metrics import METRICS, log_event, start_metrics_server, start_stats_file_writer
+from pipelined import process_files_pipelined
+from profiling import PROFILER, profile_file, startup_profile
+from quarantine import write_quarantine, replay_quarantine, count_by_type
+from reader import read_entries, stream_entries, batches
+from sinks import get_sinks, add_counts, write_batch_to_sinks, sinks_transaction, close_sinks
+from watcher import create_watcher
 
 FILE_DIR = f"{dirname(abspath(__file__))}/files"
 PROCESSED_FILE_DIR = f"{FILE_DIR}/finished"
 FAILED_FILE_DIR = f"{FILE_DIR}/failed"
+QUARANTINE_FILE_DIR = f"{FILE_DIR}/quarantine"
+PROFILE_FILE_DIR = f"{FILE_DIR}/profiles"
+# put a file here to change what is profiled while the pipeline is running (see profiling.py)
+PROFILE_CONTROL_FILE = f"{FILE_DIR}/.profile"
+
+
+def _timed(entries: Iterable[dict], stage_times: dict[str, float]) -> Iterator[dict]:
+    """
+    Iterate over the entries in a file, adding the time spent reading them onto the "parse" stage.
+
+    When streaming, the file is parsed bit by bit as we go, so this is the only way to time it.
+
+    :param entries: The entries in the file
+    :param stage_times: Seconds spent in each stage, updated in place
+    :return: Iterator over the same entries
+    """
+    entries = iter(entries)
+    while True:
+        started = time.perf_counter()
+        entry = next(entries, None)
+        stage_times["parse"] += time.perf_counter() - started
+        if entry is None:
+            return
+        yield entry
+
+
+def _write_batch(
+    fhir_objects: list[dict],
+    column_batches: dict[str, dict[str, list]],
+    stage_times: dict[str, float],
+) -> dict[str, dict[str, int]]:
+    """
+    Write transformed rows and columns to the sinks, timing it.
+
+    When only the new and changed resources are being processed, whatever is already in the database for them
+    is out of date, so it is overwritten rather than skipped (see manifest.filter_unchanged).
+
+    :param fhir_objects: List of {"table": ..., "data": ...} dictionaries
+    :param column_batches: The columns for each table from the batched resource types
+    :param stage_times: Seconds spent in each stage, updated in place
+    :return: Counts of the rows inserted and skipped, keyed by table
+    """
+    started = time.perf_counter()
+    counts = write_batch_to_sinks(fhir_objects, column_batches, MANIFEST_MODE == "resources")
+    stage_times["write"] += time.perf_counter() - started
+    return counts
+
+
+def process_file(
+    input_file: str,
+    stage_times: dict[str, float] | None = None,
+    quarantined: list[dict] | None = None,
+    file_dir: str | None = None,
+) -> dict[str, dict[str, int]]:
+    """
+    Load, validate, transform and send all of the data in a single file to the database.
+
+    Errors are not caught here, the caller decides where the file goes if this fails.
+
+    A file that has already been ingested is skipped without being parsed, and optionally so are
+    the resources in it that haven't changed (see MANIFEST_MODE in constants.py).
+
+    Every write for the file happens in one transaction, which is only committed once the whole file
+    has been processed, so a file that fails leaves nothing behind in the database and can safely be retried.
+    In streaming mode rows are sent in batches as the file is read, but they are still only committed at the end.
+
+    If CHECKPOINT_SIZE is set, the file is committed that many entries at a time instead, each time along
+    with a checkpoint of how far it has got, and a file that was interrupted carries on from its last checkpoint.
+
+    :param input_file: Name of the file inside the input directory
+    :param stage_times: If given, the seconds spent in each stage (manifest, parse, validate, transform, write)
+        are added onto it
+    :param quarantined: If given, resources that fail to validate or transform are added onto it and the rest
+        of the file is still loaded (see loader.transform_entries), rather than the whole file failing
+    :param file_dir: The directory the file is in, if it isn't the input directory (e.g. a claimed file, see claims.py)
+    :return: Counts of the rows inserted and skipped, keyed by table
+    """
+    if stage_times is None:
+        stage_times = defaultdict(float)
+
+    file_path = join(file_dir or FILE_DIR, input_file)
+
+    file_hash = None
+    if MANIFEST_MODE != "off" or CHECKPOINT_SIZE:
+        started = time.perf_counter()
+        file_hash = hash_file(file_path)
+        already_ingested = MANIFEST_MODE != "off" and file_ingested(file_hash)
+        checkpoint = load_checkpoint(file_hash) if CHECKPOINT_SIZE and not already_ingested else None
+        stage_times["manifest"] += time.perf_counter() - started
+        if already_ingested:
+            METRICS.inc("pipeline_manifest_skipped_total", kind="file")
+            log_event("file_unchanged", f"File {input_file} has already been ingested, skipping it", file=input_file)
+            return {}
+    else:
+        checkpoint = None
+
+    started = time.perf_counter()
+    entries = stream_entries(file_path) if STREAMING else read_entries(file_path)
+    stage_times["parse"] += time.perf_counter() - started
+
+    counts = {}
+    # hashes of the new and changed resources, to go in the manifest
+    resource_hashes = {}
+    resource_count = 0
+    # how many entries have been read, and how many had been committed at the last checkpoint
+    entry_offset = checkpointed_offset = 0
+    entries = _timed(entries, stage_times)
+
+    if checkpoint:
+        # carry on from where the file got to last time
+        entry_offset = checkpointed_offset = checkpoint["entry_offset"]
+        resource_count = checkpoint["resources"]
+        if quarantined is not None:
+            quarantined.extend(checkpoint["quarantined"])
+        entries = islice(entries, entry_offset, None)
+        METRICS.inc("pipeline_checkpoint_resumed_total")
+        log_event(
+            "file_resumed",
+            f"Resuming file {input_file} from entry {entry_offset}",
+            file=input_file,
+            entry_offset=entry_offset,
+        )
+
+    # when streaming, the batch size can adapt to how long each batch takes to write (see batching.py)
+    batch_size = shared_batch_size(BATCH_SIZE) if ADAPTIVE_BATCH_SIZE and STREAMING else None
+    if STREAMING:
+        file_batches = batches(entries, batch_size or BATCH_SIZE)
+    elif CHECKPOINT_SIZE:
+        file_batches = batches(entries, CHECKPOINT_SIZE)
+    else:
+        # the whole file in bulk
+        file_batches = [list(entries)]
+
+    # everything for the file is committed together at the end, or not at all if anything fails,
+    # unless it is being committed a chunk at a time
+    with ExitStack() as transaction:
+        transaction.enter_context(sinks_transaction())
+
+        for batch in file_batches:
+            batch_entries = len(batch)
+            entry_offset += batch_entries
+            if MANIFEST_MODE == "resources":
+                batch = filter_unchanged(batch, RESOURCE_TYPES, resource_hashes, BATCH_SIZE, stage_times)
+
+            already_quarantined = len(quarantined) if quarantined is not None else 0
+            fhir_objects, column_batches, batch_resources = transform_entries(
+                batch, VALIDATION_MODE, VALIDATION_SAMPLE_RATE, stage_times, quarantined
+            )
+            resource_count += batch_resources
+            # the quarantined resources haven't been ingested, so they mustn't be skipped when they're sent again
+            for record in quarantined[already_quarantined:] if quarantined is not None else []:
+                resource_hashes.pop((record["resource_type"], record["id"]), None)
+            written = time.perf_counter()
+            add_counts(counts, _write_batch(fhir_objects, column_batches, stage_times))
+
+            if CHECKPOINT_SIZE and entry_offset - checkpointed_offset >= CHECKPOINT_SIZE:
+                # commit everything so far along with how far we've got, then start the next chunk
+                started = time.perf_counter()
+                record_resources(resource_hashes)
+                resource_hashes.clear()
+                record_checkpoint(file_hash, input_file, entry_offset, resource_count, quarantined)
+                transaction.close()
+                transaction.enter_context(sinks_transaction())
+                stage_times["write"] += time.perf_counter() - started
+                checkpointed_offset = entry_offset
+                METRICS.inc("pipeline_checkpoints_total")
+
+            if batch_size:
+                # how long the batch took to write (and commit, if it finished a chunk)
+                batch_size.record(batch_entries, time.perf_counter() - written)
+
+        if MANIFEST_MODE != "off":
+            record_resources(resource_hashes)
+            record_file(file_hash, input_file, resource_count)
+        if CHECKPOINT_SIZE:
+            clear_checkpoint(file_hash)
+
+        # the commit happens as the block exits, which counts as part of writing
+        started = time.perf_counter()
+    stage_times["write"] += time.perf_counter() - started
+
+    return counts
+
+
+def _run_file(input_file: str, file_dir: str | None = None, profilers: tuple[str, ...] = ()) -> dict[str, Any]:
+    """
+    Process a file and report back how it went.
+
+    Exceptions are turned into a message here rather than raised, as this is also run in worker
+    processes and not every exception (e.g. pydantic's ValidationError) can be pickled.
+
+    :param input_file: Name of the file inside the input directory
+    :param file_dir: The directory the file is in, if it isn't the input directory
+    :param profilers: The profilers to run while processing the file, if it has been picked to be profiled
+    :return: The error message (None if it was successful), the time taken overall and in each stage,
+        the counts of rows inserted and skipped, and the resources that were quarantined
+    """
+    stage_times = defaultdict(float)
+    result = {"error": None, "rows": {}, "quarantined": []}
+    started = time.perf_counter()
+    try:
+        with profile_file(profilers, PROFILE_FILE_DIR, input_file) if profilers else nullcontext():
+            result["rows"] = process_file(
+                input_file, stage_times, result["quarantined"] if QUARANTINE else None, file_dir
+            )
+    except Exception as exc:
+        result["error"] = str(exc)
+    result["seconds"] = time.perf_counter() - started
+    result["stages"] = dict(stage_times)
+    return result
+
+
+def _worker_init():
+    """
+    Set up a freshly started worker process, so that it uses its own database connections,
+    and closes its sinks (e.g. finishes off its Parquet files) when the pool shuts down.
+    """
+    dispose_inherited_engine()
+    # atexit doesn't run in pool workers, but multiprocessing's own finalizers do
+    Finalize(None, close_sinks, exitpriority=10)
+
+
+def _worker_run_file(
+        input_file: str, file_dir: str | None = None, profilers: tuple[str, ...] = ()
+) -> dict[str, Any]:
+    """
+    Process a file inside a worker process and report back how it went.
+
+    The worker's metrics are sent back with the result, to be merged into the main process's metrics.
+
+    :param input_file: Name of the file inside the input directory
+    :param file_dir: The directory the file is in, if it isn't the input directory
+    :param profilers: The profilers to run while processing the file, see _run_file
+    :return: The result from _run_file, plus the worker's metrics
+    """
+    result = _run_file(input_file, file_dir, profilers)
+    result["metrics"] = METRICS.drain()
+    return result
+
+
+def _finish_file(input_file: str, result: dict[str, Any], file_dir: str | None = None):
+    """
+    Move a file to the finished or failed folder depending on how processing went, and record how it went.
+
+    :param input_file: Name of the file inside the input directory
+    :param result: The result from _run_file
+    :param file_dir: The directory the file is in, if it isn't the input directory
+    """
+    source_path = join(file_dir or FILE_DIR, input_file)
+    if not exists(source_path):
+        # another instance decided we had died and took the file back (see claims.py), so it's being processed
+        # again there. Anything we committed is skipped by the manifest or the database when it is
+        log_event("file_claim_lost", f"File {input_file} was taken back while it was being processed", file=input_file)
+        return
+
+    for stage, seconds in result["stages"].items():
+        METRICS.inc("pipeline_stage_seconds_total", seconds, stage=stage)
+    METRICS.observe("pipeline_file_seconds", result["seconds"])
+    details = {
+        "file": input_file,
+        "seconds": round(result["seconds"], 4),
+        "stages": {stage: round(seconds, 4) for stage, seconds in result["stages"].items()},
+        "rows": result["rows"],
+    }
+
+    if result["error"] is None:
+        if quarantined := result.get("quarantined"):
+            # only written now the rest of the file has been committed, as a file that fails is retried in full
+            path = write_quarantine(QUARANTINE_FILE_DIR, input_file, quarantined)
+            quarantined_types = count_by_type(quarantined)
+            for resource_type, count in quarantined_types.items():
+                METRICS.inc("pipeline_quarantined_total", count, type=resource_type)
+            details["quarantined"] = quarantined_types
+            log_event(
+                "resources_quarantined",
+                f"Quarantined {len(quarantined)} resources from {input_file} in {path}",
+                file=input_file,
+                path=path,
+                quarantined=quarantined_types,
+                errors=sorted({record["error"].split("\n")[0] for record in quarantined})[:10],
+            )
+        move(source_path, join(PROCESSED_FILE_DIR, input_file))
+        METRICS.inc("pipeline_files_total", status="ok")
+        log_event("file_processed", f"Successfully processed file {input_file}!", **details)
+    else:
+        move(source_path, join(FAILED_FILE_DIR, input_file))
+        METRICS.inc("pipeline_files_total", status="failed")
+        log_event("file_failed", f"Processing error: {result['error']}", error=result["error"], **details)
+
+
+def _process_files(found_files: list[str], pool: ProcessPoolExecutor | None, file_dir: str | None = None):
+    """
+    Process a set of files, either one at a time or in parallel using the worker pool.
+
+    :param found_files: Names of the files inside the input directory
+    :param pool: The worker pool, or None to process everything in this process
+    :param file_dir: The directory the files are in, if it isn't the input directory
+    """
+    METRICS.set_gauge("pipeline_queue_depth", len(found_files))
+    if pool:
+        # hand every file to the pool, and move each one as soon as its worker is done.
+        # wait for all of them before looking for more, so no file gets picked up twice.
+        # which files to profile is decided here, the workers only have the settings from when they started
+        futures = {
+            pool.submit(_worker_run_file, input_file, file_dir, PROFILER.select()): input_file
+            for input_file in found_files
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                METRICS.merge(result.pop("metrics"))
+            except Exception as exc:
+                # e.g. the worker process died part way through
+                result = {"error": str(exc), "rows": {}, "seconds": 0.0, "stages": {}}
+            _finish_file(futures[future], result, file_dir)
+            METRICS.set_gauge("pipeline_queue_depth", sum(not future.done() for future in futures))
+    else:
+        # go through each file
+        for index, input_file in enumerate(found_files):
+            _finish_file(input_file, _run_file(input_file, file_dir, PROFILER.select()), file_dir)
+            METRICS.set_gauge("pipeline_queue_depth", len(found_files) - index - 1)
+
+
+def _check_profiling():
+    """
+    Pick up any new profiling settings from the control file (see profiling.py).
+    """
+    PROFILER.check_control_file(PROFILE_CONTROL_FILE)
+    if ASYNC_PIPELINE and PROFILER.active:
+        PROFILER.configure("")
+        log_event(
+            "profiling_unavailable", "Files can't be profiled with the async pipeline, as it works on several at once"
+        )
+
+
+def _migrate_sinks():
+    """
+    Bring the tables up to the declared schema (see schema.py) before anything is written to them,
+    and fill the index of ids already in them if it is on (see known_ids.py).
+    """
+    if any(sink.name == "postgres" for sink in get_sinks()):
+        migrate()
+        if KNOWN_ID_INDEX:
+            # this is done before the worker pool is started, so each worker starts with a copy of it
+            prewarm_known_ids()
+
+
+def replay() -> dict[str, dict[str, Any]]:
+    """
+    Load the quarantined resources again (see quarantine.py), e.g. once whatever was wrong with them has been fixed.
+
+    :return: The results from quarantine.replay_quarantine, keyed by the name of the input file
+    """
+    makedirs(QUARANTINE_FILE_DIR, exist_ok=True)
+    _migrate_sinks()
+    try:
+        return replay_quarantine(QUARANTINE_FILE_DIR)
+    finally:
+        close_sinks()
 
 
 def start(test=False):
@@ -33,7 +468,7 @@ def start(test=False):
     Main function for running the pipeline.
 
     Continually read files from the input directory, load them in, transform them to usable data and send
-    them to the Postgres database.
+    them to the Postgres database. New files are picked up by watching the directory (see watcher.py).
 
     Once a file has been ingested, move then to a subfolder within the input directory called "finished".
     If it fails move it to a subfolder called "failed".
@@ -42,44 +477,102 @@ def start(test=False):
     makedirs(FILE_DIR, exist_ok=True)
     makedirs(PROCESSED_FILE_DIR, exist_ok=True)
     makedirs(FAILED_FILE_DIR, exist_ok=True)
+    makedirs(QUARANTINE_FILE_DIR, exist_ok=True)
 
-    print(f"{FILE_DIR=}")
-    print(f"{PROCESSED_FILE_DIR=}")
-    print(f"{FAILED_FILE_DIR=}")
+    _migrate_sinks()
 
-    # continue to loop forever so we can pick up any new files
-    while True:
-        if found_files := [f for f in listdir(FILE_DIR) if f.endswith('.json')]:
-            # go through each file
-            for input_file in found_files:
-                try:
-                    with open(join(FILE_DIR, input_file), "r") as file_data:
-                        raw_json = json.load(file_data)
-
-                    # represents the objects for this fhir file
-                    fhir_objects = []
-
-                    # each fhir file has all of the data under the "entry" key.
-                    for patient_data_entry in raw_json["entry"]:
-                        if patient_data_entry["resource"]["resourceType"] in RESOURCE_TYPES:
-                            loaded_data = load_json(patient_data_entry["resource"])
-                            transformed_data = transform_json(patient_data_entry["resource"]["resourceType"], loaded_data)
-                            fhir_objects.append({
-                                "table": patient_data_entry["resource"]["resourceType"],
-                                "data": transformed_data
-                            })
-                    for fhir_object in fhir_objects:
-                        send_object(fhir_object)
-                    move(join(FILE_DIR, input_file), join(PROCESSED_FILE_DIR, input_file))
-                    print(f"Successfully processed file {input_file}!")
-                except Exception as exc:
-                    move(join(FILE_DIR, input_file), join(FAILED_FILE_DIR, input_file))
-                    print(f"Processing error: {exc}")
-        if test:
-            break
-        time.sleep(1)
+    # the async pipeline overlaps the stages within this process instead of using a pool
+    workers = 1 if ASYNC_PIPELINE else WORKERS if WORKERS > 0 else cpu_count()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_worker_init) if workers > 1 else None
+
+    log_event(
+        "started",
+        "Pipeline started",
+        file_dir=FILE_DIR,
+        processed_file_dir=PROCESSED_FILE_DIR,
+        failed_file_dir=FAILED_FILE_DIR,
+        quarantine_file_dir=QUARANTINE_FILE_DIR if QUARANTINE else None,
+        workers=workers,
+        pipelined=ASYNC_PIPELINE,
+        instance_id=INSTANCE_ID if SHARED_INBOX else None,
+    )
+
+    if METRICS_PORT and not test:
+        start_metrics_server(METRICS_PORT)
+    if METRICS_FILE and not test:
+        start_stats_file_writer(METRICS_FILE, METRICS_FILE_INTERVAL)
+
+    # when the input directory is shared, files are claimed and then processed from our own directory
+    inbox = SharedInbox(
+        FILE_DIR, INSTANCE_ID, LEASE_SECONDS, HEARTBEAT_SECONDS, CLAIM_FILES or workers
+    ) if SHARED_INBOX else None
+    if inbox:
+        inbox.start()
+    file_dir = inbox.claim_dir if inbox else FILE_DIR
+
+    # start watching before looking at what's already there, so nothing can arrive in between unnoticed
+    watcher = None if test else create_watcher(FILE_DIR, WATCH_MODE, WATCH_DEBOUNCE_MS / 1000, WATCH_RESCAN_SECONDS)
+
+    try:
+        # anything that was already waiting before we started
+        found_files = [f for f in listdir(FILE_DIR) if f.endswith('.json')]
+
+        # continue to loop forever so we can pick up any new files
+        while True:
+            _check_profiling()
+            if inbox:
+                # take back the files of any instances that have died, then claim our share of what's waiting.
+                # anything else we already had claimed (e.g. from before a restart) is processed too
+                inbox.claim(found_files + inbox.reclaim_expired())
+                found_files = inbox.claimed_files()
+            # the watcher can report a file we already found in the initial listing, skip it if it's gone
+            if (found_files := [f for f in found_files if exists(join(file_dir, f))]) and ASYNC_PIPELINE:
+                process_files_pipelined(found_files, file_dir, partial(_finish_file, file_dir=file_dir))
+            elif found_files:
+                _process_files(found_files, pool, file_dir)
+            if inbox and (found_files := inbox.unclaimed_files()):
+                # there were more files waiting than we claimed, and the watcher won't tell us about them again,
+                # so go straight round for the next share of them (the other instances are taking theirs)
+                continue
+            if test:
+                break
+            # this blocks until new files turn up, the timeout just stops it waiting forever
+            # (or for longer than a lease, so the files of an instance that has died are taken back)
+            timeout = min(60, LEASE_SECONDS) if inbox else 60
+            if not (found_files := watcher.get_files(timeout=timeout)):
+                # nothing has turned up for a while, so finish off any buffered output (e.g. Parquet files)
+                close_sinks()
+    finally:
+        if watcher:
+            watcher.close()
+        if inbox:
+            inbox.close()
+        if pool:
+            pool.shutdown()
+        close_sinks()
 
 
 if __name__ =="__main__":
 
-    start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ingest FHIR files into the database")
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="report how long each module takes to import, compared to PIPELINE_STARTUP_BUDGET_MS, then exit",
+    )
+    parser.add_argument(
+        "--replay-quarantine",
+        action="store_true",
+        help="load the quarantined resources again (once whatever was wrong with them has been fixed), then exit",
+    )
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        sys.exit(0 if startup_profile(STARTUP_BUDGET_MS) else 1)
+
+    if args.replay_quarantine:
+        results = replay()
+        # anything still quarantined is an error, so it can be noticed by whatever ran this
+        sys.exit(1 if any(result["quarantined"] for result in results.values()) else 0)
+
+    start()
@@ -0,0 +1,82 @@
+"""
+The patient timeline (see PATIENT_TIMELINE in constants.py).
+
+Most questions asked of the data are "everything for this patient, in time order", which otherwise means a UNION
+over the Encounter, Condition, Claim, Procedure, Immunization and MedicationRequest tables. So as well as those
+tables, every event in them gets a row in the patient_timeline table: the patient, when it happened, what it is
+and a short summary, indexed on (patient_id, event_time, id) so a patient's timeline is a single range scan
+(see queries.py).
+
+The timeline is kept up to date as each batch of rows is written to the database (see sinks.DatabaseSink), in the
+same transaction as the rows it is made from, rather than rebuilt. The id of each event is
+<resource type>/<resource id>, so an event that is already there is skipped in the same way as the row it was
+made from. When the table is first created, db.migrate fills it from whatever is already in the other tables.
+"""
+
+from collections.abc import Iterable
+
+from rows import PatientTimelineRow
+
+TIMELINE_TABLE = "patient_timeline"
+
+# summaries longer than this are cut short, the full details are in the event's own table
+SUMMARY_LENGTH = 200
+
+
+def _claim_summary(row) -> str | None:
+    if row.total_cost is None:
+        return row.provider
+    cost = f"{row.total_cost} {row.currency or ''}".strip()
+    return f"{row.provider}: {cost}" if row.provider is not None else cost
+
+
+# for each table on the timeline, the column with the time of the event and how to summarise it
+TIMELINE_SOURCES = {
+    "Encounter": ("start_date", lambda row: row.type),
+    "Condition": ("onset_date", lambda row: row.condition_information),
+    "Claim": ("billable_period_start", _claim_summary),
+    "Procedure": ("performed_period_start", lambda row: row.procedure_name),
+    "Immunization": ("occurrence_date", lambda row: row.vaccine_type),
+    "MedicationRequest": ("authored_on", lambda row: row.medication_name),
+}
+
+
+def timeline_rows(table_name: str, rows: Iterable) -> list[PatientTimelineRow]:
+    """
+    Make the timeline events for rows written to one of the tables on the timeline.
+
+    :param table_name: Name of the table the rows are for
+    :param rows: Row records from extract.py (see rows.py), or rows read back from the table
+    :return: A timeline row for each row, or nothing if the table isn't on the timeline
+    """
+    if table_name not in TIMELINE_SOURCES:
+        return []
+    time_column, summarise = TIMELINE_SOURCES[table_name]
+    events = []
+    for row in rows:
+        summary = summarise(row)
+        events.append(PatientTimelineRow(
+            id=f"{table_name}/{row.id}",
+            patient_id=row.patient_id,
+            event_time=getattr(row, time_column),
+            resource_type=table_name,
+            resource_id=row.id,
+            summary=summary[:SUMMARY_LENGTH] if summary else None,
+        ))
+    return events
+
+
+def timeline_objects(fhir_objects: list[dict]) -> list[dict]:
+    """
+    Make the timeline events for a batch of transformed FHIR objects.
+
+    :param fhir_objects: List of {"table": ..., "data": ...} dictionaries, where data is a row record
+    :return: The events, as {"table": ..., "data": ...} dictionaries for the timeline table
+    """
+    return [
+        {"table": TIMELINE_TABLE, "data": event}
+        for fhir_object in fhir_objects
+        # plain dictionaries (rather than row records) aren't from extract.py, so aren't on the timeline
+        if fhir_object["table"] in TIMELINE_SOURCES and isinstance(fhir_object["data"], tuple)
+        for event in timeline_rows(fhir_object["table"], [fhir_object["data"]])
+    ]
@@ -0,0 +1,262 @@
+"""
+Watch the input directory for new files to process.
+
+On Linux this uses inotify, so a new file is picked up as soon as it has been closed after writing
+(IN_CLOSE_WRITE) or moved into the directory (IN_MOVED_TO), and no CPU is used while nothing is happening.
+inotify isn't in the standard library, so it is called through ctypes. Events can be lost if the kernel's queue
+overflows (IN_Q_OVERFLOW), so then, and every so often when nothing has turned up, the directory is listed as well.
+
+Anywhere inotify isn't available it falls back to polling the directory, only picking up a file once its
+size and modification time have stopped changing between two scans.
+
+Both watchers have the same interface: get_files(timeout) waits for up to timeout seconds and returns the
+names of any files that are ready to process, and close() stops watching.
+"""
+
+from collections import deque
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from metrics import log_event
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    """
+    Load libc if it has the inotify functions in it.
+
+    :return: The libc library, or None if inotify isn't available
+    """
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Watch a directory with inotify, keeping a queue of files that are ready to process.
+
+    A file is only queued once there have been no events for it for debounce_seconds, so a file
+    that is written in several goes is not picked up half way through.
+
+    If the event queue overflows, or get_files times out and the directory hasn't been listed for
+    rescan_seconds, the directory is listed to find any files whose events were lost.
+    """
+
+    def __init__(
+        self, directory: str, suffix: str = ".json", debounce_seconds: float = 0.05, rescan_seconds: float = 60
+    ):
+        self.directory = directory
+        self.suffix = suffix
+        self.debounce_seconds = debounce_seconds
+        self.rescan_seconds = rescan_seconds
+        self._last_rescan = time.monotonic()
+        # files that are ready to process, in the order they finished being written
+        self.queue = deque()
+        # files that have had an event but haven't been quiet for long enough yet
+        self._last_event = {}
+
+        libc = _load_libc()
+        if libc is None:
+            raise OSError("inotify is not available on this system")
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+
+    def _read_events(self):
+        """
+        Read all of the events that are waiting, and note the time for each file they are about.
+        """
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        self._handle_events(data, time.monotonic())
+
+    def _handle_events(self, data: bytes, now: float):
+        """
+        Note the time for each file the events are about, listing the directory if some events were lost.
+
+        :param data: The inotify_event structs read from the inotify file descriptor
+        :param now: The current time.monotonic()
+        """
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                log_event("watch_overflow", f"Missed some inotify events, listing {self.directory}")
+                self._rescan(now)
+            elif name.endswith(self.suffix):
+                self._last_event[name] = now
+
+    def _rescan(self, now: float):
+        """
+        List the directory, treating each file as if its last event was when it was last modified,
+        so files that were finished a while ago are queued straight away.
+
+        :param now: The current time.monotonic()
+        """
+        self._last_rescan = now
+        wall_now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix) or name in self.queue:
+                continue
+            try:
+                modified = os.stat(os.path.join(self.directory, name)).st_mtime
+            except FileNotFoundError:
+                # moved away between listing the directory and looking at it
+                continue
+            last_event = now - max(wall_now - modified, 0)
+            self._last_event[name] = max(last_event, self._last_event.get(name, last_event))
+
+    def _queue_settled_files(self, now: float):
+        """
+        Move any files that have been quiet for long enough onto the queue.
+
+        :param now: The current time.monotonic()
+        """
+        for name, last_event in list(self._last_event.items()):
+            if now - last_event >= self.debounce_seconds:
+                del self._last_event[name]
+                if name not in self.queue:
+                    self.queue.append(name)
+
+    def get_files(self, timeout: float) -> list[str]:
+        """
+        Wait until there is at least one file ready to process, or until the timeout.
+
+        :param timeout: The longest time to wait, in seconds
+        :return: Names of the files that are ready, which are removed from the queue
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            self._queue_settled_files(now)
+            if not self.queue and now >= deadline and now - self._last_rescan >= self.rescan_seconds:
+                # nothing has turned up for a while, make sure that isn't because some events were lost
+                self._rescan(now)
+                self._queue_settled_files(now)
+            if self.queue or now >= deadline:
+                break
+
+            # sleep until either something happens, or the next file has been quiet for long enough
+            wait = deadline - now
+            if self._last_event:
+                wait = min(wait, min(self._last_event.values()) + self.debounce_seconds - now)
+            readable, _, _ = select.select([self._fd], [], [], max(wait, 0))
+            if readable:
+                self._read_events()
+
+        files = list(self.queue)
+        self.queue.clear()
+        return files
+
+    def close(self):
+        """Stop watching the directory"""
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Watch a directory by listing it every so often.
+
+    A file is only returned once its size and modification time are the same as they were on the previous
+    scan, so a file that is still being copied in is not picked up half way through.
+    """
+
+    def __init__(self, directory: str, suffix: str = ".json"):
+        self.directory = directory
+        self.suffix = suffix
+        # files that are ready to process, in the order they were found
+        self.queue = deque()
+        # (size, modification time) of each file the last time we looked at it
+        self._last_seen = {}
+
+    def _scan(self):
+        """
+        List the directory, and queue any files that haven't changed since the last scan.
+        """
+        current = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # moved away between listing the directory and looking at it
+                continue
+            current[name] = (stat.st_size, stat.st_mtime_ns)
+            if self._last_seen.get(name) == current[name] and name not in self.queue:
+                self.queue.append(name)
+        self._last_seen = current
+
+    def get_files(self, timeout: float) -> list[str]:
+        """
+        Scan the directory until there is at least one file ready to process, or until the timeout.
+
+        :param timeout: The longest time to wait, in seconds. The directory is scanned once a second.
+        :return: Names of the files that are ready, which are removed from the queue
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self._scan()
+            now = time.monotonic()
+            if self.queue or now >= deadline:
+                break
+            time.sleep(min(1, deadline - now))
+
+        files = list(self.queue)
+        self.queue.clear()
+        # forget about the files we've handed over, they will be moved away once processed
+        for name in files:
+            self._last_seen.pop(name, None)
+        return files
+
+    def close(self):
+        """Stop watching the directory (nothing to do when polling)"""
+
+
+def create_watcher(directory: str, mode: str = "inotify", debounce_seconds: float = 0.05, rescan_seconds: float = 60):
+    """
+    Create a watcher for a directory.
+
+    :param directory: The directory to watch for new files
+    :param mode: "inotify" to use inotify if possible (falling back to polling if not), or "poll" to always poll
+    :param debounce_seconds: How long a file must be quiet for before it's picked up, when using inotify
+    :param rescan_seconds: How often to list the directory when nothing has turned up, when using inotify
+    :return: InotifyWatcher or PollingWatcher instance
+    """
+    if mode == "inotify":
+        try:
+            return InotifyWatcher(directory, debounce_seconds=debounce_seconds, rescan_seconds=rescan_seconds)
+        except OSError as exc:
+            log_event("watch_fallback", f"Can't use inotify ({exc}), falling back to polling {directory}")
+    elif mode != "poll":
+        raise ValueError(f"Unknown watch mode {mode}, expected inotify or poll")
+    return PollingWatcher(directory)
@@ -0,0 +1,126 @@
+"""
+Tests for adapting the batch size to how long each batch takes to write
+"""
+
+import asyncio
+import time
+
+from sqlalchemy import create_engine, text
+
+# pipelined.py imports the other pipeline modules by their plain names (see conftest.py)
+import batching
+import db
+from metrics import METRICS
+import pipelined
+from pipeline.batching import AdaptiveBatchSize
+from pipeline.reader import batches
+
+
+def test_batch_size_follows_write_time():
+    """
+    Test that the batch size grows while batches are quick to write and shrinks when they slow down,
+    by at most double or half at a time and always within its bounds
+    """
+    batch_size = AdaptiveBatchSize(1000, minimum=100, maximum=5000, target_seconds=1)
+
+    # 1ms per entry, so 1000 entries is the right size
+    batch_size.record(1000, 1)
+    assert batch_size() == 1000
+
+    # the database gets quicker, which is smoothed out over several batches
+    batch_size.record(1000, 0.1)
+    assert 1000 < batch_size() < 2000
+    for _ in range(10):
+        batch_size.record(batch_size(), batch_size() / 100_000)
+    assert batch_size() == 5000
+    assert not batch_size.behind
+
+    # then much slower
+    batch_size.record(5000, 50)
+    assert batch_size() == 2500
+    assert batch_size.behind
+    for _ in range(10):
+        batch_size.record(batch_size(), batch_size() / 10)
+    assert batch_size() == 100
+
+
+def test_batches_with_changing_size():
+    """
+    Test that the size of each batch is looked up as it is started
+    """
+    sizes = iter([1, 2, 3])
+    assert list(batches(range(7), lambda: next(sizes, 10))) == [[0], [1, 2], [3, 4, 5], [6]]
+
+
+def test_pipelined_backpressure(tmp_path, monkeypatch):
+    """
+    Test that in the async pipeline a slow database shrinks the batches and holds back reading,
+    without losing anything along the way
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    monkeypatch.setattr("pipelined.ADAPTIVE_BATCH_SIZE", True)
+    batch_size = AdaptiveBatchSize(50, minimum=5, maximum=1000, target_seconds=0.005)
+    monkeypatch.setattr(batching, "_shared_batch_size", batch_size)
+
+    write_batch_to_sinks = pipelined.write_batch_to_sinks
+
+    def _slow_write(*args):
+        time.sleep(0.02)
+        return write_batch_to_sinks(*args)
+
+    monkeypatch.setattr("pipelined.write_batch_to_sinks", _slow_write)
+    backpressure = METRICS.get("pipeline_backpressure_seconds_total")
+    results = {}
+    with open("test/test_files/e2e/full_file.json", "rb") as source:
+        (tmp_path / "slow.json").write_bytes(source.read())
+
+    pipelined.process_files_pipelined(["slow.json"], str(tmp_path), results.__setitem__)
+
+    assert results["slow.json"]["error"] is None
+    assert batch_size() == 5
+    assert METRICS.get("pipeline_backpressure_seconds_total") > backpressure
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT count(*) FROM "Observation"')).scalar() == 95
+
+
+def test_pipelined_backpressure_with_failed_file(tmp_path, monkeypatch):
+    """
+    Test that while the database is behind, a file that fails part way through doesn't hold back reading forever,
+    as its remaining batches are dropped rather than written
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    monkeypatch.setattr("pipelined.ADAPTIVE_BATCH_SIZE", True)
+    # every batch takes far longer than the target, so the database stays behind
+    batch_size = AdaptiveBatchSize(5, minimum=5, maximum=5, target_seconds=1e-9)
+    batch_size.last_seconds = 1
+    monkeypatch.setattr(batching, "_shared_batch_size", batch_size)
+
+    transform = pipelined._transform
+    transform_calls = []
+
+    def _fails_first_batch(batch, result):
+        transform_calls.append(len(batch))
+        if len(transform_calls) == 1:
+            raise ValueError("bad batch")
+        return transform(batch, result)
+
+    monkeypatch.setattr("pipelined._transform", _fails_first_batch)
+    with open("test/test_files/e2e/full_file.json", "rb") as source:
+        contents = source.read()
+    (tmp_path / "bad.json").write_bytes(contents)
+    # not byte for byte the same, so it isn't held back until the first file has finished
+    (tmp_path / "good.json").write_bytes(contents + b"\n")
+    results = {}
+
+    asyncio.run(asyncio.wait_for(
+        pipelined._run(["bad.json", "good.json"], str(tmp_path), results.__setitem__, queue_size=2), 60
+    ))
+
+    assert results["bad.json"]["error"] == "bad batch"
+    assert results["good.json"]["error"] is None
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT count(*) FROM "Observation"')).scalar() == 95
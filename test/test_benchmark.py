@@ -0,0 +1,118 @@
+"""
+Tests for the benchmark runner, the corpus generator and the soak test
+"""
+
+import json
+
+from fhir.resources.R4B.bundle import Bundle
+
+from benchmarks.generate import IDENTIFIER_REFERENCE_PATTERN, generate_corpus, rekey
+from benchmarks.run import find_regressions, main, run_benchmark
+from benchmarks.soak import find_problems, run_soak
+
+
+def test_run_benchmark():
+    """
+    Test that the benchmark runs every stage over a directory of files and reports on all of them
+    """
+    results = run_benchmark("test/test_files/e2e", decoder="json")
+
+    assert results["files"] == 1
+    assert results["decoder"] == "json"
+    assert results["resources"] > 0
+    assert set(results["stages"]) == {"parse", "load", "transform", "write"}
+    assert "Patient" in results["transform_by_type"]
+    assert results["file_latency_ms"]["p50"] > 0
+
+
+def test_find_regressions():
+    """
+    Test that only stages whose throughput dropped by more than the threshold are reported
+    """
+    baseline = {
+        "stages": {"parse": {"resources_per_second": 100.0}, "load": {"resources_per_second": 100.0}},
+        "transform_by_type": {"Patient": {"resources_per_second": 100.0}},
+        "total": {"resources_per_second": 100.0},
+    }
+    results = {
+        "stages": {"parse": {"resources_per_second": 95.0}, "load": {"resources_per_second": 50.0}},
+        "transform_by_type": {"Patient": {"resources_per_second": 200.0}},
+        "total": {"resources_per_second": 80.0},
+    }
+
+    regressions = find_regressions(results, baseline, threshold=0.1)
+
+    assert len(regressions) == 2
+    assert regressions[0].startswith("stage load")
+    assert regressions[1].startswith("total")
+
+
+def test_main_writes_results(tmp_path):
+    """
+    Test that the command line runner writes its results out, and passes when compared against itself
+    """
+    output = tmp_path / "results.json"
+    assert main(["--data-dir", "test/test_files/e2e", "--output", str(output)]) == 0
+    assert json.loads(output.read_text())["files"] == 1
+    # generous threshold, as the same run can vary a lot on a busy machine
+    assert main([
+        "--data-dir", "test/test_files/e2e", "--output", str(tmp_path / "again.json"),
+        "--baseline", str(output), "--threshold", "0.99"
+    ]) == 0
+
+
+def test_rekey():
+    """
+    Test that re-keying gives every copy of a bundle its own ids, with the references still pointing at them
+    """
+    with open("test/test_files/e2e/full_file.json", "r") as bundle_file:
+        text = bundle_file.read()
+
+    first = json.loads(rekey(text, 1))
+    second = json.loads(rekey(text, 2))
+    assert rekey(text, 1) == rekey(text, 1)
+
+    ids = {entry["resource"]["id"] for entry in first["entry"]}
+    assert len(ids) == len(first["entry"])
+    assert not ids & {entry["resource"]["id"] for entry in second["entry"]}
+    assert not ids & {entry["resource"]["id"] for entry in json.loads(text)["entry"]}
+    patient = next(entry for entry in first["entry"] if entry["resource"]["resourceType"] == "Patient")
+    assert patient["fullUrl"] == f"urn:uuid:{patient['resource']['id']}"
+    encounter = next(entry for entry in first["entry"] if entry["resource"]["resourceType"] == "Encounter")
+    assert encounter["resource"]["subject"]["reference"] == patient["fullUrl"]
+    # the shared reference data isn't in the bundle, so what points at it by identifier is left alone
+    identifier_references = IDENTIFIER_REFERENCE_PATTERN.findall(text)
+    assert any("Location?identifier=" in reference for reference in identifier_references)
+    assert IDENTIFIER_REFERENCE_PATTERN.findall(rekey(text, 1)) == identifier_references
+    # still a valid bundle
+    Bundle.model_validate(first)
+
+
+def test_generate_corpus(tmp_path):
+    """
+    Test that bundles are generated until the first limit is reached, combining templates into bigger bundles
+    """
+    results = generate_corpus("test/test_files/e2e", str(tmp_path), resources=1500, patients_per_bundle=2)
+
+    assert results["bundles"] == 2
+    assert results["resources"] == 4 * 695
+    bundles = [json.loads((tmp_path / name).read_text()) for name in sorted(p.name for p in tmp_path.iterdir())]
+    assert [len(bundle["entry"]) for bundle in bundles] == [2 * 695, 2 * 695]
+    ids = [entry["resource"]["id"] for bundle in bundles for entry in bundle["entry"]]
+    assert len(set(ids)) == len(ids)
+
+
+def test_run_soak():
+    """
+    Test that the soak test keeps processing the corpus, re-keyed, and reports on every round
+    """
+    results = run_soak("test/test_files/e2e", duration=0, round_size=2)
+
+    assert results["rounds"] == 1
+    assert results["files"] == 2
+    assert results["failed"] == 0
+    assert results["resources"] == 2 * 695
+    assert results["file_latency_ms"]["p99"] > 0
+    assert results["rss_mb"]["end"] > 0
+    assert find_problems(results, max_rss_growth=1000, min_throughput_ratio=0.1) == []
+    assert len(find_problems({**results, "failed": 1}, None, None)) == 1
@@ -0,0 +1,122 @@
+"""
+Tests for claiming files from an input directory shared by several pipeline instances
+"""
+
+import os
+from os.path import exists
+from shutil import copyfile
+
+from sqlalchemy import create_engine
+
+from pipeline.claims import SharedInbox, HEARTBEAT_FILE
+from pipeline.start import start
+
+
+def test_each_file_claimed_once(tmp_path):
+    """
+    Test that when two instances try to claim the same files, each file is only claimed by one of them.
+    """
+    for index in range(4):
+        (tmp_path / f"{index}.json").write_text("{}")
+    first = SharedInbox(str(tmp_path), "first", max_claimed=4)
+    second = SharedInbox(str(tmp_path), "second", max_claimed=4)
+    first.start()
+    second.start()
+    try:
+        files = sorted(f for f in os.listdir(tmp_path) if f.endswith(".json"))
+        claimed_by_first = first.claim(files[:3])
+        claimed_by_second = second.claim(files)
+
+        assert claimed_by_first == ["0.json", "1.json", "2.json"]
+        assert claimed_by_second == ["3.json"]
+        assert first.claimed_files() == claimed_by_first
+        assert not [f for f in os.listdir(tmp_path) if f.endswith(".json")]
+    finally:
+        first.close()
+        second.close()
+
+
+def test_claims_bounded(tmp_path):
+    """
+    Test that an instance only claims up to its limit, leaving the rest of the files for the other instances,
+    and claims more once it has finished with the ones it has.
+    """
+    for index in range(5):
+        (tmp_path / f"{index}.json").write_text("{}")
+    first = SharedInbox(str(tmp_path), "first", max_claimed=2)
+    second = SharedInbox(str(tmp_path), "second", max_claimed=2)
+    first.start()
+    second.start()
+    try:
+        assert first.claim(first.unclaimed_files()) == ["0.json", "1.json"]
+        # already has as many as it can take
+        assert first.claim(first.unclaimed_files()) == []
+        assert second.claim(second.unclaimed_files()) == ["2.json", "3.json"]
+
+        os.remove(os.path.join(first.claim_dir, "0.json"))
+        assert first.claim(first.unclaimed_files()) == ["4.json"]
+        assert first.unclaimed_files() == []
+    finally:
+        first.close()
+        second.close()
+
+
+def test_expired_lease_reclaimed(tmp_path):
+    """
+    Test that the files claimed by an instance whose heartbeat has stopped are moved back once its lease expires,
+    and that an instance which was only stalled takes out its lease again.
+    """
+    (tmp_path / "claimed.json").write_text("{}")
+    stalled = SharedInbox(str(tmp_path), "stalled", lease_seconds=30, heartbeat_seconds=0.01)
+    other = SharedInbox(str(tmp_path), "other", lease_seconds=30)
+    stalled._heartbeat()
+    other.start()
+    try:
+        assert stalled.claim(["claimed.json"]) == ["claimed.json"]
+        # still within the lease
+        assert other.reclaim_expired() == []
+
+        heartbeat_path = os.path.join(stalled.claim_dir, HEARTBEAT_FILE)
+        os.utime(heartbeat_path, (0, 0))
+        assert other.reclaim_expired() == ["claimed.json"]
+        assert exists(tmp_path / "claimed.json")
+        assert not exists(stalled.claim_dir)
+
+        # its next heartbeat brings its directory back
+        stalled.start()
+        assert exists(heartbeat_path)
+    finally:
+        stalled.close()
+        other.close()
+
+
+def test_start_with_shared_inbox(tmp_path, monkeypatch):
+    """
+    Test that with a shared input directory the pipeline claims files, processes them from its own directory,
+    moves them to finished as usual, and gives up its lease when it stops.
+    """
+    # its own database, so the rows from the test file don't affect the other tests
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    monkeypatch.setattr("pipeline.start.SHARED_INBOX", True)
+    monkeypatch.setattr("pipeline.start.INSTANCE_ID", "test-instance")
+    # one file at a time, so the pipeline has to go back for the rest
+    monkeypatch.setattr("pipeline.start.CLAIM_FILES", 1)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.PROCESSED_FILE_DIR", f"{tmp_path}/finished")
+    monkeypatch.setattr("pipeline.start.FAILED_FILE_DIR", f"{tmp_path}/failed")
+    monkeypatch.setattr("pipeline.start.QUARANTINE_FILE_DIR", f"{tmp_path}/quarantine")
+
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "new.json")
+    # left claimed by an instance that died a while ago
+    dead_dir = tmp_path / "processing" / "dead-instance"
+    dead_dir.mkdir(parents=True)
+    copyfile("test/test_files/e2e/full_file.json", dead_dir / "abandoned.json")
+    (dead_dir / HEARTBEAT_FILE).touch()
+    os.utime(dead_dir / HEARTBEAT_FILE, (0, 0))
+
+    start(test=True)
+
+    assert exists(tmp_path / "finished" / "new.json")
+    assert exists(tmp_path / "finished" / "abandoned.json")
+    assert os.listdir(tmp_path / "processing") == []
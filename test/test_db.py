@@ -3,7 +3,9 @@ Tests for database connectivity
 """
 
 import pytest
-from pipeline.db import send_object
+from sqlalchemy import create_engine, event, inspect, text
+
+from pipeline.db import send_object, send_objects, send_column_batches, transaction, migrate, _copy_value
 
 
 @pytest.fixture(autouse=True)
@@ -16,12 +18,12 @@ def setup(monkeypatch, test_db_engine):
     monkeypatch.setattr("pipeline.db.get_db_engine", test_db_engine)
 
 
-def test_send_to_database_new_item_new_table(load_json_fixture, check_table_exists, check_item_exists_in_table):
+def test_send_to_database_new_item_new_table(load_transformed_fixture, check_table_exists, check_item_exists_in_table):
     """
     Test that a new item can be sent to the database, and a new table is created for it.
     """
     # send new item
-    transformed_data = load_json_fixture("transformed_json/medication.json")
+    transformed_data = load_transformed_fixture("medication.json")
     data_to_send ={
         "table": "Medication",
         "data": transformed_data
@@ -35,12 +37,12 @@ def test_send_to_database_new_item_new_table(load_json_fixture, check_table_exis
     assert check_item_exists_in_table("Medication", transformed_data["id"]) == True
 
 
-def test_send_two_to_database(load_json_fixture, check_item_exists_in_table):
+def test_send_two_to_database(load_transformed_fixture, check_item_exists_in_table):
     """
     Test that when two items are sent to an empty database, two items exist in the resulting table.
     """
     # send one item
-    transformed_data = load_json_fixture("transformed_json/medication.json")
+    transformed_data = load_transformed_fixture("medication.json")
     data_to_send = {
         "table": "Medication",
         "data": transformed_data
@@ -58,12 +60,12 @@ def test_send_two_to_database(load_json_fixture, check_item_exists_in_table):
     assert check_item_exists_in_table("Medication", "new_id") == True
 
 
-def test_already_exists(load_json_fixture, capsys):
+def test_already_exists(load_transformed_fixture, capsys):
     """
     Test that if an item already exists (based on id value), it is not added to the table
     """
     # send one item
-    transformed_data = load_json_fixture("transformed_json/medication.json")
+    transformed_data = load_transformed_fixture("medication.json")
     data_to_send = {
         "table": "Medication",
         "data": transformed_data
@@ -72,9 +74,146 @@ def test_already_exists(load_json_fixture, capsys):
     send_object(data_to_send)
 
     # send the same item again
-    send_object(data_to_send)
+    counts = send_object(data_to_send)
 
-    # check response has correct string
-    expected_message = "ID foobar already exists in table Medication, skipping."
+    # check it was skipped and the response has the correct string
+    assert counts == {"Medication": {"inserted": 0, "skipped": 1}}
+    expected_message = "Table Medication: 0 inserted, 1 skipped (already exist)."
     captured_output = capsys.readouterr()
     assert expected_message in captured_output.out
+
+
+def test_send_objects_grouped_by_table(load_transformed_fixture, check_item_exists_in_table):
+    """
+    Test that a batch of objects for several tables are all written, including
+    an id that turns up twice in the same batch.
+    """
+    medication = load_transformed_fixture("medication.json")
+    procedure = load_transformed_fixture("procedure.json")
+    second_medication = dict(medication, id="batch_id")
+
+    counts = send_objects([
+        {"table": "Medication", "data": medication},
+        {"table": "Procedure", "data": procedure},
+        {"table": "Medication", "data": second_medication},
+        {"table": "Medication", "data": second_medication},
+    ])
+
+    assert counts["Medication"]["skipped"] >= 1
+    assert counts["Procedure"] == {"inserted": 1, "skipped": 0}
+
+    assert check_item_exists_in_table("Medication", medication["id"]) == True
+    assert check_item_exists_in_table("Medication", "batch_id") == True
+    assert check_item_exists_in_table("Procedure", procedure["id"]) == True
+
+
+def test_send_column_batches(load_transformed_fixture, test_db_engine, check_item_exists_in_table):
+    """
+    Test that batches of columns are written to their tables with numeric columns kept as numbers,
+    and that sending the same batch again skips every row.
+    """
+    columns = load_transformed_fixture("observation.json")
+
+    counts = send_column_batches(columns)
+    assert counts == {
+        "Observation": {"inserted": 1, "skipped": 0},
+        "ObservationComponent": {"inserted": 2, "skipped": 0},
+    }
+    assert check_item_exists_in_table("Observation", columns["Observation"]["id"][0]) == True
+
+    with test_db_engine().connect() as connection:
+        values = connection.execute(text(
+            'SELECT value FROM "ObservationComponent" WHERE observation_id = :id ORDER BY value'
+        ), {"id": columns["Observation"]["id"][0]}).scalars().all()
+    assert values == [86.0, 125.0]
+
+    assert send_column_batches(columns)["ObservationComponent"] == {"inserted": 0, "skipped": 2}
+
+
+def test_transaction(load_transformed_fixture, check_item_exists_in_table):
+    """
+    Test that writes inside a transaction are only kept if the whole block succeeds
+    """
+    medication = load_transformed_fixture("medication.json")
+
+    with pytest.raises(RuntimeError):
+        with transaction():
+            send_objects([{"table": "Medication", "data": dict(medication, id="transaction_id")}])
+            raise RuntimeError("failed part way through")
+    assert check_item_exists_in_table("Medication", "transaction_id") == False
+
+    with transaction() as connection:
+        send_objects([{"table": "Medication", "data": dict(medication, id="transaction_id")}])
+        # nested transactions carry on using the outer one
+        with transaction() as nested_connection:
+            assert nested_connection is connection
+    assert check_item_exists_in_table("Medication", "transaction_id") == True
+
+
+def test_tables_only_checked_once(monkeypatch, tmp_path, load_transformed_fixture):
+    """
+    Test that once the tables have been made (or found) and committed, sending rows to them is just the insert,
+    and that a table whose creation was rolled back is made again
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("pipeline.db.get_db_engine", lambda: engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    medication = load_transformed_fixture("medication.json")
+
+    with pytest.raises(RuntimeError):
+        with transaction():
+            send_objects([{"table": "Thing", "data": {"id": "rolled-back"}}])
+            raise RuntimeError("failed part way through")
+    assert send_objects([{"table": "Thing", "data": {"id": "thing"}}]) == {"Thing": {"inserted": 1, "skipped": 0}}
+
+    migrate()
+    statements.clear()
+    send_objects([{"table": "Medication", "data": medication}, {"table": "Thing", "data": {"id": "other"}}])
+    assert len(statements) == 2
+    assert all(statement.startswith("INSERT") for statement in statements)
+
+
+def test_copy_value_escaping():
+    """
+    Test that values are escaped correctly for the Postgres COPY text format
+    """
+    assert _copy_value(None) == "\\N"
+    assert _copy_value(True) == "True"
+    assert _copy_value("tab\there") == "tab\\there"
+    assert _copy_value("new\nline") == "new\\nline"
+    assert _copy_value("back\\slash") == "back\\\\slash"
+
+
+def test_migrate(monkeypatch, tmp_path, load_transformed_fixture, capsys):
+    """
+    Test that a table made before there was a declared schema gets the new columns and indexes,
+    that the other tables are created with their primary keys, and that migrating again changes nothing
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    monkeypatch.setattr("pipeline.db.get_db_engine", lambda: engine)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE "Claim" (id TEXT, patient_id TEXT, encounter_id TEXT, total_cost TEXT)'))
+        connection.execute(text("""INSERT INTO "Claim" VALUES ('legacy_claim', 'patient', 'encounter', '1.00USD')"""))
+
+    migrate()
+
+    inspector = inspect(engine)
+    assert "currency" in {column["name"] for column in inspector.get_columns("Claim")}
+    assert {"Claim_id_key", "ix_Claim_patient_id", "ix_Claim_encounter_id"} <= {
+        index["name"] for index in inspector.get_indexes("Claim")
+    }
+    assert inspector.get_pk_constraint("Patient")["constrained_columns"] == ["id"]
+    assert "ix_ObservationComponent_observation_id" in {
+        index["name"] for index in inspector.get_indexes("ObservationComponent")
+    }
+    assert "table_migrated" in capsys.readouterr().out
+
+    # the old rows are kept, and new ones can go in alongside them
+    claim = load_transformed_fixture("claim.json")
+    assert send_objects([{"table": "Claim", "data": claim}]) == {"Claim": {"inserted": 1, "skipped": 0}}
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT count(*) FROM "Claim"')).scalar() == 2
+
+    migrate()
+    assert "table_migrated" not in capsys.readouterr().out
@@ -1,7 +1,22 @@
 """
 End to end test of processing one file
 """
-from pipeline.start import start
+import json
+from os.path import exists
+from shutil import copyfile
+
+from pydantic import ValidationError
+import pytest
+
+from sqlalchemy import create_engine, text
+
+# start.py imports the other pipeline modules by their plain names (see conftest.py)
+import db
+from manifest import hash_file, load_checkpoint
+from metrics import METRICS
+import pipelined
+from pipeline.quarantine import read_quarantine
+from pipeline.start import start, process_file, replay
 
 
 def test_e2e(capsys, monkeypatch, test_db_engine, check_item_exists_in_table):
@@ -27,8 +42,227 @@ def test_e2e(capsys, monkeypatch, test_db_engine, check_item_exists_in_table):
 
     # verify that at least the Patient table was created, and the expected value exists inside it
     assert check_item_exists_in_table("Patient", "0f978b87-8054-e6d3-aa03-20e101ea37c0") == True
+    # the high volume types go through the batched column extraction
+    assert check_item_exists_in_table("Observation", "6a4b0f7c-beaa-98e3-5842-375390922835") == True
+    assert check_item_exists_in_table("ObservationComponent", "6a4b0f7c-beaa-98e3-5842-375390922835-1") == True
+    assert check_item_exists_in_table("DiagnosticReport", "014b8236-7ae1-cbcd-cbfe-a41df31e4d88") == True
 
     # verify that logs show the processing was successful
     expected_message = "Successfully processed file test/test_files/e2e/full_file.json!"
     captured_output = capsys.readouterr()
     assert expected_message in captured_output.out
+
+    # verify the metrics were recorded for every stage
+    assert METRICS.get("pipeline_files_total", status="ok") >= 1
+    assert METRICS.get("pipeline_resources_total", type="Patient") >= 1
+    assert METRICS.get("pipeline_db_round_trips_total") > 0
+    for stage in ("parse", "validate", "transform", "write"):
+        assert METRICS.get("pipeline_stage_seconds_total", stage=stage) > 0
+
+
+def test_e2e_worker_pool(tmp_path, monkeypatch):
+    """
+    Test that files are processed and moved correctly when they are handed to a pool of worker processes.
+    """
+    # the workers can't see the in-memory db, so use an sqlite file they can all open
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    monkeypatch.setattr("pipeline.start.WORKERS", 2)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.PROCESSED_FILE_DIR", f"{tmp_path}/finished")
+    monkeypatch.setattr("pipeline.start.FAILED_FILE_DIR", f"{tmp_path}/failed")
+    monkeypatch.setattr("pipeline.start.QUARANTINE_FILE_DIR", f"{tmp_path}/quarantine")
+
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "good.json")
+    # a bad resource would only be quarantined, so break the file itself
+    (tmp_path / "bad.json").write_text('{"entry": [{"resource": {"resourceType": "Patient"}')
+
+    start(test=True)
+
+    assert exists(tmp_path / "finished" / "good.json")
+    assert exists(tmp_path / "failed" / "bad.json")
+    # the workers' metrics are sent back to the main process
+    assert METRICS.get("pipeline_files_total", status="failed") >= 1
+    assert METRICS.get("pipeline_rows_total", table="Patient", result="inserted") >= 1
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('SELECT id FROM "Patient" WHERE id = :id'),
+            {"id": "0f978b87-8054-e6d3-aa03-20e101ea37c0"}
+        ).scalar()
+
+
+def test_e2e_streaming(monkeypatch, test_db_engine, check_item_exists_in_table):
+    """
+    Test that a file can be processed in streaming mode, with rows sent in several small batches.
+    """
+    monkeypatch.setattr("db.get_db_engine", test_db_engine)
+    monkeypatch.setattr("pipeline.start.STREAMING", True)
+    monkeypatch.setattr("pipeline.start.BATCH_SIZE", 5)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", "test/test_files/e2e")
+    # the same file has already been ingested by test_e2e
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "off")
+
+    counts = process_file("full_file.json")
+
+    assert check_item_exists_in_table("Patient", "0f978b87-8054-e6d3-aa03-20e101ea37c0") == True
+    assert sum(table["inserted"] + table["skipped"] for table in counts.values()) > 5
+
+
+def test_e2e_failed_file_rolled_back(
+    tmp_path, monkeypatch, load_json_fixture, test_db_engine, check_table_exists, check_item_exists_in_table
+):
+    """
+    Test that when a file fails part way through, nothing from it is left in the database,
+    even if some batches had already been written.
+    """
+    monkeypatch.setattr("db.get_db_engine", test_db_engine)
+    monkeypatch.setattr("pipeline.start.STREAMING", True)
+    monkeypatch.setattr("pipeline.start.BATCH_SIZE", 1)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "off")
+
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="rolled-back-id")
+    (tmp_path / "partial.json").write_text(json.dumps({"entry": [
+        {"resource": medication},
+        {"resource": {"resourceType": "Patient", "anotherValue": "baz"}},
+    ]}))
+
+    with pytest.raises(ValidationError, match="Patient"):
+        process_file("partial.json")
+
+    # if this is the first Medication written, creating the table is rolled back too
+    assert not (check_table_exists("Medication") and check_item_exists_in_table("Medication", "rolled-back-id"))
+
+
+def test_e2e_pipelined(tmp_path, monkeypatch, load_json_fixture):
+    """
+    Test that files are processed, committed and moved correctly by the async pipeline, with each file split into
+    several batches, that a file which fails after some of its batches were written leaves nothing behind,
+    and that a bad resource is quarantined without failing its file.
+    """
+    # the write stage runs on its own thread, which can't see the in-memory db, so use an sqlite file
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    monkeypatch.setattr("pipeline.start.ASYNC_PIPELINE", True)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.PROCESSED_FILE_DIR", f"{tmp_path}/finished")
+    monkeypatch.setattr("pipeline.start.FAILED_FILE_DIR", f"{tmp_path}/failed")
+    monkeypatch.setattr("pipeline.start.QUARANTINE_FILE_DIR", f"{tmp_path}/quarantine")
+    # pipelined.py imports the constants by its plain name (see conftest.py)
+    monkeypatch.setattr("pipelined.BATCH_SIZE", 50)
+    monkeypatch.setattr("pipelined.STREAMING", True)
+
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "a_good.json")
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="pipelined-rolled-back")
+    # cut off part way through, so reading fails once the first batches have gone through
+    (tmp_path / "b_bad.json").write_text(json.dumps({"entry": (
+        [{"resource": medication}] + [{"resource": {"resourceType": "Basic"}}] * 100
+        + [{"resource": {"resourceType": "Patient", "anotherValue": "baz"}}]
+    )})[:-20])
+    # the same contents as the first file, so it's skipped by the manifest once the first one has been committed
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "c_resent.json")
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="pipelined-quarantine")
+    (tmp_path / "d_quarantine.json").write_text(json.dumps({"entry": [
+        {"resource": medication}, {"resource": {"resourceType": "Patient", "id": "bad-patient", "anotherValue": "baz"}}
+    ]}))
+
+    start(test=True)
+
+    assert exists(tmp_path / "finished" / "a_good.json")
+    assert exists(tmp_path / "failed" / "b_bad.json")
+    assert exists(tmp_path / "finished" / "c_resent.json")
+    assert exists(tmp_path / "finished" / "d_quarantine.json")
+    assert METRICS.get("pipeline_manifest_skipped_total", kind="file") >= 1
+    assert [record["id"] for record in read_quarantine(tmp_path / "quarantine" / "d_quarantine.json.ndjson")] == [
+        "bad-patient"
+    ]
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('SELECT count(*) FROM "Observation"')
+        ).scalar() == 95
+        assert connection.execute(
+            text('SELECT id FROM "Medication" WHERE id = :id'), {"id": "pipelined-rolled-back"}
+        ).first() is None
+        assert connection.execute(
+            text('SELECT id FROM "Medication" WHERE id = :id'), {"id": "pipelined-quarantine"}
+        ).first()
+
+
+def test_e2e_pipelined_checkpoint_resume(tmp_path, monkeypatch, load_json_fixture):
+    """
+    Test that the async pipeline commits a file in chunks with checkpoints, and carries on from the last one
+    after the file fails part way through.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    monkeypatch.setattr("pipelined.BATCH_SIZE", 1)
+    monkeypatch.setattr("pipelined.CHECKPOINT_SIZE", 2)
+    medication = load_json_fixture("fhir_json/medication.json")
+    (tmp_path / "big.json").write_text(json.dumps({"entry": [
+        {"resource": dict(medication, id=f"pipelined-checkpoint-{index}")} for index in range(5)
+    ]}))
+
+    write_batch_to_sinks = pipelined.write_batch_to_sinks
+    writes = []
+
+    def _fails_on_third_write(*args):
+        writes.append(args)
+        if len(writes) == 3:
+            raise RuntimeError("connection lost")
+        return write_batch_to_sinks(*args)
+
+    results = {}
+    monkeypatch.setattr("pipelined.write_batch_to_sinks", _fails_on_third_write)
+    pipelined.process_files_pipelined(["big.json"], str(tmp_path), results.__setitem__)
+    assert results["big.json"]["error"] == "connection lost"
+    assert load_checkpoint(hash_file(str(tmp_path / "big.json")))["entry_offset"] == 2
+
+    monkeypatch.setattr("pipelined.write_batch_to_sinks", write_batch_to_sinks)
+    pipelined.process_files_pipelined(["big.json"], str(tmp_path), results.__setitem__)
+    assert results["big.json"]["error"] is None
+    assert results["big.json"]["rows"] == {"Medication": {"inserted": 3, "skipped": 0}}
+    assert load_checkpoint(hash_file(str(tmp_path / "big.json"))) is None
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT count(*) FROM "Medication"')).scalar() == 5
+
+
+def test_e2e_quarantine_replay(tmp_path, monkeypatch, load_json_fixture, test_db_engine, check_item_exists_in_table):
+    """
+    Test that a bad resource is quarantined while the rest of its file is loaded, and that once it has been
+    fixed, replaying the quarantine loads just that resource.
+    """
+    monkeypatch.setattr("db.get_db_engine", test_db_engine)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.PROCESSED_FILE_DIR", f"{tmp_path}/finished")
+    monkeypatch.setattr("pipeline.start.FAILED_FILE_DIR", f"{tmp_path}/failed")
+    monkeypatch.setattr("pipeline.start.QUARANTINE_FILE_DIR", f"{tmp_path}/quarantine")
+
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="quarantine-medication")
+    # without its identifiers the patient's row is keyed on its id
+    patient = dict(load_json_fixture("fhir_json/patient.json"), id="quarantine-patient", identifier=[])
+    (tmp_path / "partial.json").write_text(json.dumps({"entry": [
+        {"resource": medication}, {"resource": dict(patient, gender=["not", "a", "gender"])}
+    ]}))
+
+    start(test=True)
+
+    assert exists(tmp_path / "finished" / "partial.json")
+    assert check_item_exists_in_table("Medication", "quarantine-medication") == True
+    assert not check_item_exists_in_table("Patient", "quarantine-patient")
+    assert METRICS.get("pipeline_quarantined_total", type="Patient") >= 1
+    quarantine_file = tmp_path / "quarantine" / "partial.json.ndjson"
+    [record] = read_quarantine(quarantine_file)
+    assert (record["file"], record["resource_type"], record["id"]) == ("partial.json", "Patient", "quarantine-patient")
+    assert "gender" in record["error"]
+
+    # nothing has been fixed yet, so it stays in quarantine
+    assert replay()["partial.json"]["quarantined"] == 1
+    assert exists(quarantine_file)
+
+    # fix the resource, then replay it
+    record["resource"] = patient
+    quarantine_file.write_text(json.dumps(record) + "\n")
+    assert replay()["partial.json"] == {"loaded": 1, "quarantined": 0, "rows": {"Patient": {"inserted": 1, "skipped": 0}}}
+    assert check_item_exists_in_table("Patient", "quarantine-patient") == True
+    assert not exists(quarantine_file)
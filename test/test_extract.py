@@ -6,6 +6,10 @@ is transformed into the expected JSON output. Further validation
 of the incoming data is handled in test_loader.py
 """
 
+import json
+
+import pytest
+
 from fhir.resources.R4B.patient import Patient
 from fhir.resources.R4B.encounter import Encounter
 from fhir.resources.R4B.condition import Condition
@@ -23,69 +27,160 @@ from pipeline.extract import (
     procedure,
     immunization,
     medicationrequest,
-    medication
+    medication,
+    transform_json,
+    transform_raw,
+    transform_columns,
 )
+from pipeline.loader import load_json
+from pipeline.reader import read_entries
+from pipeline.rows import ROW_TYPES
+from pipeline.constants import RESOURCE_TYPES, BATCHED_RESOURCE_TYPES
 
 
-def test_load_patient(load_json_fixture):
+def test_load_patient(load_json_fixture, load_transformed_fixture):
     """Test that data for a Patient can be loaded"""
     test_patient = Patient.model_validate(load_json_fixture("fhir_json/patient.json"))
-    expected_patient = load_json_fixture("transformed_json/patient.json")
+    expected_patient = load_transformed_fixture("patient.json")
     
-    assert expected_patient == patient(test_patient)
+    assert expected_patient == patient(test_patient)._asdict()
 
 
-def test_load_encounter(load_json_fixture):
+def test_load_encounter(load_json_fixture, load_transformed_fixture):
     """Test that data for an Encounter can be loaded"""
     test_encounter = Encounter.model_validate(load_json_fixture("fhir_json/encounter.json"))
-    expected_encounter = load_json_fixture("transformed_json/encounter.json")
+    expected_encounter = load_transformed_fixture("encounter.json")
     
-    assert expected_encounter == encounter(test_encounter)
+    assert expected_encounter == encounter(test_encounter)._asdict()
 
 
-def test_load_condition(load_json_fixture):
+def test_load_condition(load_json_fixture, load_transformed_fixture):
     """Test that data for a Condition can be loaded"""
     test_condition = Condition.model_validate(load_json_fixture("fhir_json/condition.json"))
-    expected_condition = load_json_fixture("transformed_json/condition.json")
+    expected_condition = load_transformed_fixture("condition.json")
     
-    assert expected_condition == condition(test_condition)
+    assert expected_condition == condition(test_condition)._asdict()
 
 
-def test_load_claim(load_json_fixture):
+def test_load_claim(load_json_fixture, load_transformed_fixture):
     """Test that data for a Claim can be loaded"""
     test_claim = Claim.model_validate(load_json_fixture("fhir_json/claim.json"))
-    expected_claim = load_json_fixture("transformed_json/claim.json")
+    expected_claim = load_transformed_fixture("claim.json")
     
-    assert expected_claim == claim(test_claim)
+    assert expected_claim == claim(test_claim)._asdict()
 
 
-def test_load_procedure(load_json_fixture):
+def test_load_procedure(load_json_fixture, load_transformed_fixture):
     """Test that data for a Procedure can be loaded"""
     test_procedure = Procedure.model_validate(load_json_fixture("fhir_json/procedure.json"))
-    expected_procedure = load_json_fixture("transformed_json/procedure.json")
+    expected_procedure = load_transformed_fixture("procedure.json")
     
-    assert expected_procedure == procedure(test_procedure)
+    assert expected_procedure == procedure(test_procedure)._asdict()
 
 
-def test_load_immunization(load_json_fixture):
+def test_load_immunization(load_json_fixture, load_transformed_fixture):
     """Test that data for an Immunization can be loaded"""
     test_immunization = Immunization.model_validate(load_json_fixture("fhir_json/immunization.json"))
-    expected_immunization = load_json_fixture("transformed_json/immunization.json")
+    expected_immunization = load_transformed_fixture("immunization.json")
     
-    assert expected_immunization == immunization(test_immunization)
+    assert expected_immunization == immunization(test_immunization)._asdict()
 
 
-def test_load_medicationrequest(load_json_fixture):
+def test_load_medicationrequest(load_json_fixture, load_transformed_fixture):
     """Test that data for a MedicationRequest can be loaded"""
     test_medicationrequest = MedicationRequest.model_validate(load_json_fixture("fhir_json/medicationrequest.json"))
-    expected_medicationrequest = load_json_fixture("transformed_json/medicationrequest.json")
+    expected_medicationrequest = load_transformed_fixture("medicationrequest.json")
     
-    assert expected_medicationrequest == medicationrequest(test_medicationrequest)
+    assert expected_medicationrequest == medicationrequest(test_medicationrequest)._asdict()
 
 
-def test_load_medication(load_json_fixture):
+def test_load_medication(load_json_fixture, load_transformed_fixture):
     """Test that data for a Medication can be loaded"""
     test_medication = Medication.model_validate(load_json_fixture("fhir_json/medication.json"))
-    expected_medication = load_json_fixture("transformed_json/medication.json")
+    expected_medication = load_transformed_fixture("medication.json")
     
-    assert expected_medication == medication(test_medication)
+    assert expected_medication == medication(test_medication)._asdict()
+
+
+@pytest.mark.parametrize("file_name", [
+    "patient", "encounter", "condition", "claim", "procedure", "immunization", "medicationrequest", "medication"
+])
+def test_raw_matches_model(load_json_fixture, load_transformed_fixture, file_name):
+    """Test that extracting from the raw JSON gives exactly the same data as extracting from the model"""
+    test_data = load_json_fixture(f"fhir_json/{file_name}.json")
+    expected_data = load_transformed_fixture(f"{file_name}.json")
+
+    assert expected_data == transform_raw(test_data["resourceType"], test_data)._asdict()
+
+
+def test_raw_matches_model_full_file():
+    """Test that the raw and model extraction agree for every supported resource in a full bundle"""
+    resources = [
+        entry["resource"] for entry in read_entries("test/test_files/e2e/full_file.json")
+        if entry["resource"]["resourceType"] in RESOURCE_TYPES
+        and entry["resource"]["resourceType"] not in BATCHED_RESOURCE_TYPES
+    ]
+
+    for resource in resources:
+        model_data = transform_json(resource["resourceType"], load_json(resource))
+        assert model_data == transform_raw(resource["resourceType"], resource)
+
+
+def test_rows_share_repeated_values():
+    """Test that each resource becomes its table's row record, with repeated values interned"""
+    resources = [
+        entry["resource"] for entry in read_entries("test/test_files/e2e/full_file.json")
+        if entry["resource"]["resourceType"] == "Encounter"
+    ]
+    # copy the strings, as the parser may already share them
+    first, second = (
+        transform_raw("Encounter", json.loads(json.dumps(resource))) for resource in resources[:2]
+    )
+
+    assert isinstance(first, tuple) and first._fields == ROW_TYPES["Encounter"]._fields
+    assert first.patient_id == second.patient_id and first.patient_id is second.patient_id
+    assert first.status is second.status
+
+
+@pytest.mark.parametrize("file_name, resource_type", [
+    ("observation", "Observation"), ("diagnosticreport", "DiagnosticReport")
+])
+def test_transform_columns(load_json_fixture, load_transformed_fixture, file_name, resource_type):
+    """Test that a batch of high volume resources is extracted into columns, with components in their own table"""
+    test_data = load_json_fixture(f"fhir_json/{file_name}.json")
+    expected_data = load_transformed_fixture(f"{file_name}.json")
+
+    assert expected_data == transform_columns(resource_type, [test_data])
+
+
+def test_transform_columns_value_types(load_json_fixture):
+    """Test that each kind of Observation value ends up in the right column"""
+    quantity = dict(load_json_fixture("fhir_json/observation.json"), valueQuantity={"value": 5.4, "unit": "%"})
+    concept = dict(
+        load_json_fixture("fhir_json/observation.json"),
+        valueCodeableConcept={"coding": [{"code": "266919005", "display": "Never smoker"}]},
+    )
+    del quantity["component"], concept["component"]
+
+    columns = transform_columns("Observation", [quantity, concept])
+
+    assert columns["Observation"]["value"] == [5.4, None]
+    assert columns["Observation"]["unit"] == ["%", None]
+    assert columns["Observation"]["value_code"] == [None, "266919005"]
+    assert columns["Observation"]["value_text"] == [None, "Never smoker"]
+    assert all(values == [] for values in columns["ObservationComponent"].values())
+
+
+def test_transform_columns_full_file():
+    """Test that every Observation and DiagnosticReport in a full bundle is valid and can be extracted"""
+    for resource_type in BATCHED_RESOURCE_TYPES:
+        resources = [
+            entry["resource"] for entry in read_entries("test/test_files/e2e/full_file.json")
+            if entry["resource"]["resourceType"] == resource_type
+        ]
+        for resource in resources:
+            load_json(resource)
+
+        columns = transform_columns(resource_type, resources)
+        assert columns[resource_type]["id"] == [resource["id"] for resource in resources]
+        assert all(len(values) == len(resources) for values in columns[resource_type].values())
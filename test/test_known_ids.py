@@ -0,0 +1,95 @@
+"""
+Tests for the in-memory index of the ids already committed to each table
+"""
+
+import pytest
+from sqlalchemy import create_engine, text
+
+# db.py imports the other pipeline modules by their plain names (see conftest.py)
+import db
+from metrics import METRICS
+from pipeline.known_ids import KnownIds
+
+
+@pytest.fixture
+def known_ids(tmp_path, monkeypatch) -> KnownIds:
+    """
+    Turn the index on, with an empty index and a database of its own
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    monkeypatch.setattr("db.KNOWN_ID_INDEX", True)
+    index = KnownIds(1024 * 1024)
+    monkeypatch.setattr("db.KNOWN_IDS", index)
+    return index
+
+
+def _count_rows(table_name: str) -> int:
+    with db.get_db_engine().connect() as connection:
+        return connection.execute(text(f'SELECT count(*) FROM "{table_name}"')).scalar()
+
+
+def test_known_rows_not_sent(known_ids):
+    """
+    Test that once rows have been committed, sending them again doesn't go to the database at all,
+    and only the new rows are sent when they are mixed in with known ones
+    """
+    rows = [{"id": f"med-{index}", "name": "paracetamol"} for index in range(5)]
+    assert db.send_rows("Thing", rows) == {"inserted": 5, "skipped": 0}
+    assert len(known_ids) == 5
+
+    round_trips = METRICS.get("pipeline_db_round_trips_total")
+    hits = METRICS.get("pipeline_known_id_hits_total", table="Thing")
+    assert db.send_rows("Thing", rows) == {"inserted": 0, "skipped": 5}
+    assert METRICS.get("pipeline_db_round_trips_total") == round_trips
+    assert METRICS.get("pipeline_known_id_hits_total", table="Thing") == hits + 5
+
+    assert db.send_rows("Thing", rows + [{"id": "med-new", "name": "ibuprofen"}]) == {"inserted": 1, "skipped": 5}
+    assert _count_rows("Thing") == 6
+    assert METRICS.get("pipeline_known_ids", table="Thing") == 6
+
+
+def test_rolled_back_ids_not_known(known_ids):
+    """
+    Test that the ids written in a transaction which is rolled back aren't added to the index,
+    so the rows are written again the next time
+    """
+    rows = [{"id": "rolled-back", "name": "paracetamol"}]
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.send_rows("Thing", rows)
+            # still only pending until the commit
+            assert len(known_ids) == 0
+            raise RuntimeError("file failed")
+
+    assert len(known_ids) == 0
+    assert db.send_rows("Thing", rows) == {"inserted": 1, "skipped": 0}
+
+
+def test_prewarm_bounded(known_ids, monkeypatch):
+    """
+    Test that the index is filled from the database, the smaller tables first, and stops growing at its limit
+    """
+    db.send_rows("Medication", [{"id": f"med-{index}"} for index in range(10)])
+    db.send_rows("Observation", [{"id": f"obs-{index}"} for index in range(5000)])
+
+    index = KnownIds(1024 * 1024)
+    with db.transaction() as connection:
+        index.prewarm(connection, ["Observation", "Medication", "Missing"])
+    assert len(index) == 5010
+    assert not index.full
+
+    small_index = KnownIds(50 * 1024)
+    with db.transaction() as connection:
+        small_index.prewarm(connection, ["Observation", "Medication"])
+    assert small_index.full
+    # it stops as soon as it gets to the limit, which the last id (or the set growing to fit it) can take it over
+    assert 50 * 1024 <= small_index.size_bytes < 100 * 1024
+    assert 10 < len(small_index) < 5010
+    # Medication was read before Observation filled it up
+    assert small_index.unknown_rows("Medication", [("med-1",)], 0) == []
+
+    # anything that didn't fit is sent, and skipped by the database as before
+    monkeypatch.setattr("db.KNOWN_IDS", small_index)
+    assert db.send_rows("Observation", [{"id": "obs-4999"}]) == {"inserted": 0, "skipped": 1}
+    assert METRICS.get("pipeline_known_ids_bytes") == small_index.size_bytes
@@ -2,11 +2,15 @@
 Tests for loading raw FHIR data into fhir.resources objects
 """
 
+from collections import Counter
+
 import pytest
 from fhir.resources.R4B.patient import Patient
 from pydantic import ValidationError
 
-from pipeline.loader import load_json
+import pipeline.loader
+from pipeline.loader import load_json, transform_entry, transform_batch, transform_entries, IMPORT_MAP
+from pipeline.constants import RESOURCE_TYPES
 
 
 def test_good_data(load_json_fixture):
@@ -53,3 +57,145 @@ def test_invalid_fhir_data(load_json_fixture):
 
     with pytest.raises(ValidationError):
         load_json(test_data)
+
+
+def test_transform_entry_modes(load_json_fixture, load_transformed_fixture):
+    """
+    Test that every validation mode gives the same transformed data for valid FHIR data
+    """
+    test_data = load_json_fixture("fhir_json/claim.json")
+    expected_data = load_transformed_fixture("claim.json")
+
+    for validation_mode in ("full", "sampled", "raw"):
+        assert expected_data == transform_entry(test_data, validation_mode, sample_rate=2)._asdict()
+
+
+def test_transform_entry_raw_skips_validation(load_json_fixture):
+    """
+    Test that raw mode doesn't validate the data, and sampled mode only validates some of it
+    """
+    test_data = load_json_fixture("fhir_json/medication.json")
+    test_data["anotherValue"] = "baz"
+
+    transform_entry(test_data, "raw")
+
+    # with a very large sample rate at most one of these is validated, and it raises
+    errors = 0
+    for _ in range(3):
+        try:
+            transform_entry(test_data, "sampled", sample_rate=1000)
+        except ValidationError:
+            errors += 1
+    assert errors <= 1
+
+
+def test_transform_entry_sampled_falls_back_to_model(load_json_fixture):
+    """
+    Test that in sampled mode, a resource the raw extraction can't handle is validated with the model
+    """
+    test_data = load_json_fixture("fhir_json/procedure.json")
+    del test_data["status"]
+
+    # the model requires a status, so the fallback validation must catch this
+    for _ in range(3):
+        with pytest.raises(ValidationError):
+            transform_entry(test_data, "sampled", sample_rate=1000)
+
+
+def test_transform_entry_unknown_mode(load_json_fixture):
+    """
+    Test that an unknown validation mode raises an error
+    """
+    with pytest.raises(ValueError):
+        transform_entry(load_json_fixture("fhir_json/patient.json"), "foo")
+
+
+def test_transform_batch_modes(load_json_fixture, load_transformed_fixture):
+    """
+    Test that every validation mode gives the same columns for a valid batch, and raw mode skips validation
+    """
+    test_data = load_json_fixture("fhir_json/observation.json")
+    expected_data = load_transformed_fixture("observation.json")
+
+    for validation_mode in ("full", "sampled", "raw"):
+        assert expected_data == transform_batch("Observation", [test_data], validation_mode, sample_rate=2)
+
+    test_data["anotherValue"] = "baz"
+    transform_batch("Observation", [test_data], "raw")
+    with pytest.raises(ValidationError):
+        transform_batch("Observation", [test_data], "full")
+
+
+def test_transform_batch_sampled_falls_back_to_model(load_json_fixture):
+    """
+    Test that in sampled mode, a batch the raw extraction can't handle is validated with the model
+    """
+    test_data = load_json_fixture("fhir_json/diagnosticreport.json")
+    del test_data["status"]
+
+    for _ in range(3):
+        with pytest.raises(ValidationError):
+            transform_batch("DiagnosticReport", [load_json_fixture("fhir_json/diagnosticreport.json"), test_data],
+                            "sampled", sample_rate=1000)
+
+
+def test_transform_entries_quarantine(load_json_fixture):
+    """
+    Test that resources which fail are quarantined with their error while the rest are still transformed,
+    including when one resource fails a whole batch of the batched types
+    """
+    bad_patient = {"resourceType": "Patient", "id": "bad-patient", "anotherValue": "baz"}
+    bad_observation = dict(load_json_fixture("fhir_json/observation.json"), id="bad-observation")
+    del bad_observation["status"]
+    entries = [
+        {"resource": load_json_fixture("fhir_json/patient.json")},
+        {"resource": bad_patient},
+        {"resource": load_json_fixture("fhir_json/observation.json")},
+        {"resource": bad_observation},
+    ]
+
+    for validation_mode in ("full", "raw"):
+        quarantined = []
+        fhir_objects, column_batches, resource_count = transform_entries(
+            entries, validation_mode, quarantined=quarantined
+        )
+
+        assert [fhir_object["table"] for fhir_object in fhir_objects] == ["Patient"]
+        assert column_batches["Observation"]["id"] == [load_json_fixture("fhir_json/observation.json")["id"]]
+        assert resource_count == 2
+        assert [(record["resource_type"], record["id"]) for record in quarantined] == [
+            ("Patient", "bad-patient"), ("Observation", "bad-observation")
+        ]
+        assert quarantined[1]["resource"] == bad_observation
+        assert "status" in quarantined[1]["error"]
+
+    # without a quarantine, the first failure is raised as before
+    with pytest.raises(ValidationError):
+        transform_entries(entries)
+
+
+def test_transform_entries_quarantine_sampled_counts_once(monkeypatch, load_json_fixture):
+    """
+    Test that in sampled mode, when a batch is retried one resource at a time to find the one that fails,
+    its resources aren't counted towards the sample a second time
+    """
+    monkeypatch.setattr(pipeline.loader, "_sample_counts", Counter())
+    bad_observation = dict(load_json_fixture("fhir_json/observation.json"), id="bad-observation")
+    del bad_observation["status"]
+    entries = [{"resource": load_json_fixture("fhir_json/observation.json")}, {"resource": bad_observation}]
+
+    quarantined = []
+    _, column_batches, _ = transform_entries(entries, "sampled", sample_rate=1000, quarantined=quarantined)
+
+    assert column_batches["Observation"]["id"] == [load_json_fixture("fhir_json/observation.json")["id"]]
+    assert [record["id"] for record in quarantined] == ["bad-observation"]
+    assert pipeline.loader._sample_counts["Observation"] == 2
+
+
+def test_import_map():
+    """
+    Test that the lazily loaded import map gives the right classes, and only has our resource types in it
+    """
+    assert IMPORT_MAP["Patient"] is Patient
+    assert list(IMPORT_MAP) == RESOURCE_TYPES
+    assert "bar" not in IMPORT_MAP
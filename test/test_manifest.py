@@ -0,0 +1,225 @@
+"""
+Tests for skipping files and resources that have already been ingested
+"""
+
+import json
+
+import pytest
+from sqlalchemy import create_engine, event, text
+
+# start.py imports the other pipeline modules by their plain names (see conftest.py)
+import db
+from metrics import METRICS
+from manifest import _known_hashes, file_ingested, hash_file, hash_resource, load_checkpoint
+import pipeline.start
+from pipeline.start import process_file
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch, tmp_path, test_db_engine):
+    """
+    Setup function that runs before each manifest test, to read files from a temporary directory
+    """
+    monkeypatch.setattr("db.get_db_engine", test_db_engine)
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    # the manifest tables are made along with the others
+    db.migrate()
+
+
+def _write_bundle(path, resources):
+    path.write_text(json.dumps({"entry": [{"resource": resource} for resource in resources]}))
+
+
+def test_hash_resource_ignores_key_order():
+    """
+    Test that the same resource hashes the same however its keys are ordered, but not if a value changes
+    """
+    assert hash_resource({"id": "1", "status": "active"}) == hash_resource({"status": "active", "id": "1"})
+    assert hash_resource({"id": "1", "status": "active"}) != hash_resource({"id": "1", "status": "inactive"})
+
+
+def test_manifest_tables_made_by_migrate(tmp_path, monkeypatch):
+    """
+    Test that the manifest tables are made when the database is migrated, so looking a file up is a single query
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    with engine.connect() as connection:
+        assert {"ingest_manifest", "resource_manifest", "ingest_checkpoint"} <= set(
+            connection.dialect.get_table_names(connection)
+        )
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert not file_ingested("not-a-real-hash")
+    assert len(statements) == 1 and statements[0].startswith("SELECT")
+
+
+def test_known_hashes_use_primary_key(tmp_path, monkeypatch):
+    """
+    Test that looking up the hashes of resources searches the resource manifest's primary key,
+    rather than scanning the whole table
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO resource_manifest (resource_type, id, content_hash) "
+            "VALUES ('Condition', 'shared-id', 'condition-hash'), ('Medication', 'shared-id', 'medication-hash')"
+        ))
+
+    statements = []
+
+    def _record(*args):
+        statements.append((args[2], args[3]))
+
+    event.listen(engine, "before_cursor_execute", _record)
+    assert _known_hashes([("Condition", "shared-id"), ("Procedure", "other-id")]) == {
+        ("Condition", "shared-id"): "condition-hash"
+    }
+    event.remove(engine, "before_cursor_execute", _record)
+
+    # one query for each resource type
+    assert len(statements) == 2
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = " ".join(
+                row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            )
+            assert "(resource_type=? AND id=?)" in plan
+
+
+def test_unchanged_file_skipped(monkeypatch, tmp_path, load_json_fixture):
+    """
+    Test that a file that is byte for byte the same as one already ingested is skipped before it's parsed
+    """
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "files")
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="manifest-file")
+    _write_bundle(tmp_path / "first.json", [medication])
+    (tmp_path / "resent.json").write_bytes((tmp_path / "first.json").read_bytes())
+    skipped = METRICS.get("pipeline_manifest_skipped_total", kind="file")
+
+    assert process_file("first.json") == {"Medication": {"inserted": 1, "skipped": 0}}
+    stage_times = {"manifest": 0.0}
+    assert process_file("resent.json", stage_times) == {}
+
+    assert METRICS.get("pipeline_manifest_skipped_total", kind="file") == skipped + 1
+    assert "parse" not in stage_times
+
+
+def test_unchanged_resources_skipped(monkeypatch, tmp_path, load_json_fixture):
+    """
+    Test that only the new and changed resources in a changed file are processed
+    """
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "resources")
+    medication = load_json_fixture("fhir_json/medication.json")
+    first = dict(medication, id="manifest-first")
+    second = dict(medication, id="manifest-second")
+    _write_bundle(tmp_path / "day1.json", [first, second])
+
+    assert process_file("day1.json") == {"Medication": {"inserted": 2, "skipped": 0}}
+
+    # one resource is the same, one has changed and one is new
+    changed = dict(second, status="inactive")
+    new = dict(medication, id="manifest-third")
+    _write_bundle(tmp_path / "day2.json", [first, changed, new])
+    skipped = METRICS.get("pipeline_manifest_skipped_total", kind="resource")
+
+    # the changed one is written over the old one
+    assert process_file("day2.json") == {"Medication": {"inserted": 2, "skipped": 0}}
+    assert METRICS.get("pipeline_manifest_skipped_total", kind="resource") == skipped + 1
+
+    # now that they've all been recorded, a reordered copy of the file has nothing new in it
+    _write_bundle(tmp_path / "day2_again.json", [new, changed, first])
+    assert process_file("day2_again.json") == {}
+
+
+def test_changed_resource_overwritten(monkeypatch, tmp_path, load_json_fixture):
+    """
+    Test that a resource which has changed is written over the old rows for it, and its timeline event,
+    even when its id is in the index of known ids
+    """
+    # its own database, so the rows can be read back without the other tests' rows
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    db.migrate()
+    monkeypatch.setattr("db.KNOWN_ID_INDEX", True)
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "resources")
+    condition = load_json_fixture("fhir_json/condition.json")
+    _write_bundle(tmp_path / "day1.json", [condition])
+    assert process_file("day1.json")["Condition"] == {"inserted": 1, "skipped": 0}
+
+    edited = dict(condition, code=dict(condition["code"], text="Sinusitis"))
+    _write_bundle(tmp_path / "day2.json", [edited])
+    assert process_file("day2.json") == {
+        "Condition": {"inserted": 1, "skipped": 0}, "patient_timeline": {"inserted": 1, "skipped": 0}
+    }
+
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('SELECT condition_information FROM "Condition" WHERE id = :id'), {"id": condition["id"]}
+        ).scalar_one() == "Sinusitis"
+        assert connection.execute(
+            text("SELECT summary FROM patient_timeline WHERE resource_id = :id"), {"id": condition["id"]}
+        ).scalar_one() == "Sinusitis"
+
+    # recorded as it now is in the table, so the same again is skipped, but changing it back isn't
+    _write_bundle(tmp_path / "day2_again.json", [edited, load_json_fixture("fhir_json/medication.json")])
+    assert list(process_file("day2_again.json")) == ["Medication"]
+    new_medication = dict(load_json_fixture("fhir_json/medication.json"), id="manifest-day3")
+    _write_bundle(tmp_path / "day3.json", [condition, new_medication])
+    assert process_file("day3.json")["Condition"] == {"inserted": 1, "skipped": 0}
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('SELECT condition_information FROM "Condition" WHERE id = :id'), {"id": condition["id"]}
+        ).scalar_one() == condition["code"]["text"]
+
+
+def test_failed_file_not_recorded(monkeypatch, tmp_path, load_json_fixture):
+    """
+    Test that a file which fails isn't recorded in the manifest, so it is processed again when it's retried
+    """
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "files")
+    medication = dict(load_json_fixture("fhir_json/medication.json"), id="manifest-failed")
+    _write_bundle(tmp_path / "bad.json", [medication, {"resourceType": "Patient", "anotherValue": "baz"}])
+
+    for _ in range(2):
+        with pytest.raises(Exception, match="Patient"):
+            process_file("bad.json")
+
+
+def test_checkpoint_resume(monkeypatch, tmp_path, load_json_fixture):
+    """
+    Test that a file committed in chunks carries on from its last checkpoint after being interrupted,
+    rather than processing everything again
+    """
+    monkeypatch.setattr("pipeline.start.MANIFEST_MODE", "files")
+    monkeypatch.setattr("pipeline.start.CHECKPOINT_SIZE", 2)
+    medication = load_json_fixture("fhir_json/medication.json")
+    _write_bundle(tmp_path / "big.json", [dict(medication, id=f"checkpoint-{index}") for index in range(5)])
+
+    # the third chunk never gets written, as if the container was killed part way through the file
+    write_batch_to_sinks = pipeline.start.write_batch_to_sinks
+    writes = []
+
+    def _killed_on_third_write(*args):
+        writes.append(args)
+        if len(writes) == 3:
+            raise SystemExit("killed")
+        return write_batch_to_sinks(*args)
+
+    monkeypatch.setattr("pipeline.start.write_batch_to_sinks", _killed_on_third_write)
+    with pytest.raises(SystemExit):
+        process_file("big.json")
+    file_hash = hash_file(str(tmp_path / "big.json"))
+    assert load_checkpoint(file_hash)["entry_offset"] == 4
+
+    # only the last chunk is processed again, and the checkpoint is gone once the file has been recorded
+    monkeypatch.setattr("pipeline.start.write_batch_to_sinks", write_batch_to_sinks)
+    resumed = METRICS.get("pipeline_checkpoint_resumed_total")
+    assert process_file("big.json") == {"Medication": {"inserted": 1, "skipped": 0}}
+    assert METRICS.get("pipeline_checkpoint_resumed_total") == resumed + 1
+    assert load_checkpoint(file_hash) is None
+    assert process_file("big.json") == {}
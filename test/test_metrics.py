@@ -0,0 +1,97 @@
+"""
+Tests for the metrics and structured logging
+"""
+
+from glob import glob
+import json
+from os.path import dirname
+import re
+from urllib.request import urlopen
+
+from pipeline import metrics
+from pipeline.metrics import Metrics, METRICS, METRIC_HELP, log_event, start_metrics_server, write_stats_file
+
+
+def test_render_prometheus():
+    """
+    Test that counters, summaries and gauges are rendered in the Prometheus text format
+    """
+    metrics = Metrics()
+    metrics.inc("pipeline_rows_total", 3, table="Patient", result="inserted")
+    metrics.inc("pipeline_rows_total", 2, table="Patient", result="inserted")
+    metrics.observe("pipeline_file_seconds", 1.5)
+    metrics.set_gauge("pipeline_queue_depth", 4)
+
+    rendered = metrics.render_prometheus()
+
+    assert "# TYPE pipeline_rows_total counter" in rendered
+    assert 'pipeline_rows_total{result="inserted",table="Patient"} 5' in rendered
+    assert "# TYPE pipeline_file_seconds summary" in rendered
+    assert "pipeline_file_seconds_sum 1.5" in rendered
+    assert "pipeline_file_seconds_count 1" in rendered
+    assert "pipeline_queue_depth 4" in rendered
+
+
+def test_drain_and_merge():
+    """
+    Test that counters, summaries and gauges drained from one set of metrics (e.g. in a worker process)
+    can be merged into another
+    """
+    worker_metrics = Metrics()
+    worker_metrics.inc("pipeline_resources_total", 2, type="Claim")
+    worker_metrics.observe("pipeline_batch_write_seconds", 0.5)
+    worker_metrics.set_gauge("pipeline_batch_size", 250)
+    main_metrics = Metrics()
+    main_metrics.inc("pipeline_resources_total", 1, type="Claim")
+    main_metrics.set_gauge("pipeline_batch_size", 1000)
+
+    main_metrics.merge(worker_metrics.drain())
+
+    assert main_metrics.get("pipeline_resources_total", type="Claim") == 3
+    assert main_metrics.get("pipeline_batch_write_seconds_count") == 1
+    assert main_metrics.get("pipeline_batch_size") == 250
+    assert worker_metrics.get("pipeline_resources_total", type="Claim") == 0
+    assert worker_metrics.get("pipeline_batch_size") == 0
+
+
+def test_metrics_server_and_stats_file(tmp_path):
+    """
+    Test that the metrics can be scraped over HTTP and written to a stats file
+    """
+    METRICS.inc("pipeline_files_total", status="ok")
+
+    server = start_metrics_server(0, host="127.0.0.1")
+    try:
+        with urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert 'pipeline_files_total{status="ok"}' in response.read().decode()
+    finally:
+        server.shutdown()
+
+    write_stats_file(str(tmp_path / "stats.prom"))
+    assert 'pipeline_files_total{status="ok"}' in (tmp_path / "stats.prom").read_text()
+
+
+def test_log_event(capsys):
+    """
+    Test that log lines are written as a single JSON object
+    """
+    log_event("file_processed", "Processed!", file="foo.json", rows={"Patient": {"inserted": 1}})
+
+    logged = json.loads(capsys.readouterr().out)
+    assert logged["event"] == "file_processed"
+    assert logged["message"] == "Processed!"
+    assert logged["file"] == "foo.json"
+    assert logged["rows"] == {"Patient": {"inserted": 1}}
+
+
+def test_every_metric_described():
+    """
+    Test that every metric the pipeline records has a type and description for Prometheus
+    """
+    recorded = set()
+    for path in glob(f"{dirname(metrics.__file__)}/*.py"):
+        with open(path) as source:
+            recorded.update(re.findall(r"METRICS\.\w+\(\s*\"(pipeline_\w+)\"", source.read()))
+
+    assert recorded
+    assert recorded - set(METRIC_HELP) == set()
@@ -0,0 +1,120 @@
+"""
+Tests for the profiling tools
+"""
+
+from os import listdir
+from os.path import exists
+import pstats
+from shutil import copyfile
+
+import pytest
+from sqlalchemy import create_engine
+
+from pipeline.profiling import FileProfiler, parse_importtime, profile_file
+from pipeline.start import start
+
+
+def test_parse_importtime():
+    """
+    Test that the output of python -X importtime is parsed into module, depth and timings
+    """
+    importtime_output = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       100 |        100 |   constants",
+        "import time:       250 |        300 |     sqlalchemy.util",
+        "import time:       400 |        700 |   db",
+        "import time:        50 |        850 | start",
+    ])
+
+    assert parse_importtime(importtime_output) == [
+        ("constants", 1, 100, 100),
+        ("sqlalchemy.util", 2, 250, 300),
+        ("db", 1, 400, 700),
+        ("start", 0, 50, 850),
+    ]
+
+
+def test_file_profiler_selection(tmp_path):
+    """
+    Test that the profiler picks the next N files, or a fraction of them, and takes new settings from a control file
+    """
+    profiler = FileProfiler()
+    assert not profiler.active
+    assert profiler.select() == ()
+
+    profiler.configure("cpu", files=2)
+    assert [profiler.select() for _ in range(3)] == [("cpu",), ("cpu",), ()]
+    assert not profiler.active
+
+    profiler.configure("cpu,memory", sample_rate=0.0)
+    assert all(profiler.select() == () for _ in range(100))
+    with pytest.raises(ValueError):
+        profiler.configure("gpu")
+
+    control_path = tmp_path / ".profile"
+    assert not profiler.check_control_file(str(control_path))
+    # an empty file profiles the next file with everything
+    control_path.touch()
+    assert profiler.check_control_file(str(control_path))
+    assert not exists(control_path)
+    assert [profiler.select() for _ in range(2)] == [("cpu", "memory"), ()]
+
+    control_path.write_text("profilers=memory\nfiles=3 sample=0.5")
+    profiler.check_control_file(str(control_path))
+    assert (profiler.profilers, profiler.remaining, profiler.sample_rate) == (("memory",), 3, 0.5)
+    # settings that don't make sense are ignored
+    control_path.write_text("files=lots")
+    assert profiler.check_control_file(str(control_path))
+    assert (profiler.profilers, profiler.remaining) == (("memory",), 3)
+    control_path.write_text("profilers=off")
+    profiler.check_control_file(str(control_path))
+    assert not profiler.active
+
+
+def test_profile_file(tmp_path):
+    """
+    Test that profiling a block writes the cProfile stats and a report of the top allocations
+    """
+    with profile_file(("cpu", "memory"), str(tmp_path / "profiles"), "bundle.json"):
+        numbers = [str(number) for number in range(10000)]
+    assert numbers
+
+    pstats_file, = [name for name in listdir(tmp_path / "profiles") if name.endswith(".pstats")]
+    assert pstats_file.startswith("bundle.json.")
+    stats = pstats.Stats(str(tmp_path / "profiles" / pstats_file))
+    assert stats.total_calls > 0
+
+    report_file, = [name for name in listdir(tmp_path / "profiles") if name.endswith(".allocations.txt")]
+    report = (tmp_path / "profiles" / report_file).read_text()
+    assert "Peak traced memory" in report
+    assert "test_profiling.py" in report
+
+
+def test_start_profiles_next_files(tmp_path, monkeypatch):
+    """
+    Test that a control file dropped into the input directory makes the pipeline profile just the next file,
+    with the time spent loading and extracting the resources in the profile
+    """
+    # its own database, so the rows from the test files don't affect the other tests
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    monkeypatch.setattr("pipeline.start.PROFILER", FileProfiler())
+    monkeypatch.setattr("pipeline.start.FILE_DIR", str(tmp_path))
+    monkeypatch.setattr("pipeline.start.PROCESSED_FILE_DIR", f"{tmp_path}/finished")
+    monkeypatch.setattr("pipeline.start.FAILED_FILE_DIR", f"{tmp_path}/failed")
+    monkeypatch.setattr("pipeline.start.QUARANTINE_FILE_DIR", f"{tmp_path}/quarantine")
+    monkeypatch.setattr("pipeline.start.PROFILE_FILE_DIR", f"{tmp_path}/profiles")
+    monkeypatch.setattr("pipeline.start.PROFILE_CONTROL_FILE", f"{tmp_path}/.profile")
+
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "first.json")
+    copyfile("test/test_files/e2e/full_file.json", tmp_path / "second.json")
+    (tmp_path / ".profile").write_text("profilers=cpu files=1")
+
+    start(test=True)
+
+    assert sorted(listdir(tmp_path / "finished")) == ["first.json", "second.json"]
+    profiles = listdir(tmp_path / "profiles")
+    assert len(profiles) == 1 and profiles[0].endswith(".pstats")
+    stats = pstats.Stats(str(tmp_path / "profiles" / profiles[0]))
+    profiled_functions = {function for _, _, function in stats.stats}
+    assert {"transform_entries", "process_file"} <= profiled_functions
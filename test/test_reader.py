@@ -0,0 +1,45 @@
+"""
+Tests for reading entries out of bundle files
+"""
+
+import pytest
+
+from pipeline.reader import read_entries, stream_entries
+
+FULL_FILE = "test/test_files/e2e/full_file.json"
+
+
+def test_read_entries():
+    """
+    Test that all of the entries are read from a bundle file
+    """
+    entries = read_entries(FULL_FILE)
+
+    assert len(entries) > 0
+    assert all("resource" in entry for entry in entries)
+
+
+def test_stream_entries_matches_read_entries():
+    """
+    Test that streaming a bundle file gives exactly the same entries as loading it all at once
+    """
+    assert list(stream_entries(FULL_FILE)) == read_entries(FULL_FILE)
+
+
+def test_read_entries_decoders(monkeypatch, tmp_path):
+    """
+    Test that orjson and the json module give exactly the same entries, including when orjson isn't installed,
+    and that an empty file is rejected as invalid JSON
+    """
+    assert read_entries(FULL_FILE, "orjson") == read_entries(FULL_FILE, "json")
+
+    monkeypatch.setattr("pipeline.reader.orjson", None)
+    assert read_entries(FULL_FILE, "orjson") == read_entries(FULL_FILE, "json")
+
+    with pytest.raises(ValueError):
+        read_entries(FULL_FILE, "foo")
+
+    empty_file = tmp_path / "empty.json"
+    empty_file.write_bytes(b"")
+    with pytest.raises(ValueError):
+        read_entries(str(empty_file))
@@ -0,0 +1,112 @@
+"""
+Tests for the sinks the transformed data can be written to
+"""
+
+from datetime import datetime, timezone
+from glob import glob
+
+import pyarrow.parquet
+import pytest
+
+from pipeline.rows import PatientRow
+from pipeline.sinks import DatabaseSink, ParquetSink, create_sink
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch, test_db_engine):
+    """
+    Setup function that runs before each sink test, to use the in-memory db for the database sink
+    """
+    # sinks.py imports db by its plain name (see conftest.py)
+    monkeypatch.setattr("db.get_db_engine", test_db_engine)
+
+
+def test_database_sink(load_transformed_fixture, check_item_exists_in_table):
+    """
+    Test that the database sink writes rows to the database
+    """
+    procedure = load_transformed_fixture("procedure.json")
+    procedure["id"] = "database_sink_id"
+
+    counts = DatabaseSink().write([{"table": "Procedure", "data": procedure}])
+
+    assert counts == {"Procedure": {"inserted": 1, "skipped": 0}}
+    assert check_item_exists_in_table("Procedure", "database_sink_id") == True
+
+
+def test_parquet_sink(tmp_path, load_transformed_fixture):
+    """
+    Test that the parquet sink buffers rows into row groups, rolls over to new files, and keeps the column types
+    and order of the row records
+    """
+    patient = load_transformed_fixture("patient.json")
+    sink = ParquetSink(str(tmp_path), row_group_size=2, max_file_bytes=1)
+
+    counts = sink.write([{"table": "Patient", "data": PatientRow(**dict(patient, id=str(i)))} for i in range(5)])
+    assert counts == {"Patient": {"inserted": 5, "skipped": 0}}
+
+    # two full row groups have been written, each rolling over to a new file as they're over the size limit
+    assert len(glob(f"{tmp_path}/Patient/ingest_date=*/*.parquet")) == 2
+    assert glob(f"{tmp_path}/Patient/ingest_date=*/*.inprogress") == []
+
+    # the last row is only written out once the sink is closed
+    sink.close()
+    files = sorted(glob(f"{tmp_path}/Patient/ingest_date=*/*.parquet"))
+    assert len(files) == 3
+
+    table = pyarrow.parquet.read_table(files)
+    assert sorted(table.column("id").to_pylist()) == ["0", "1", "2", "3", "4"]
+    assert table.schema.field("deceased").type == pyarrow.bool_()
+    assert table.schema.field("given_name").type == pyarrow.string()
+    assert pyarrow.parquet.read_schema(files[0]).names == list(PatientRow._fields)
+
+
+def test_parquet_sink_declared_types(tmp_path, load_transformed_fixture):
+    """
+    Test that the column types come from the row records, rather than from whatever is in the first row group,
+    and that a column which isn't declared is an error rather than being dropped
+    """
+    patient = load_transformed_fixture("patient.json")
+    sink = ParquetSink(str(tmp_path), row_group_size=1)
+
+    # the first row group has no deceased date at all
+    sink.write([{"table": "Patient", "data": PatientRow(**dict(patient, id="alive", deceased_date=None))}])
+    sink.write([{"table": "Patient", "data": PatientRow(
+        **dict(patient, id="deceased", deceased=True, deceased_date=datetime(2020, 1, 2, tzinfo=timezone.utc))
+    )}])
+    with pytest.raises(ValueError, match="nickname"):
+        sink.write([{"table": "Patient", "data": dict(patient, id="extra", nickname="Bob")}])
+    with pytest.raises(ValueError, match="Thing"):
+        sink.write([{"table": "Thing", "data": {"id": "thing"}}])
+    sink.close()
+
+    table = pyarrow.parquet.read_table(glob(f"{tmp_path}/Patient/ingest_date=*/*.parquet"))
+    assert table.schema.field("deceased_date").type == pyarrow.timestamp("us", tz="UTC")
+    assert sorted(table.column("id").to_pylist()) == ["alive", "deceased"]
+
+
+def test_parquet_sink_columns(tmp_path, load_transformed_fixture):
+    """
+    Test that the parquet sink writes batches of columns, including numeric columns
+    """
+    columns = load_transformed_fixture("observation.json")
+    sink = ParquetSink(str(tmp_path), row_group_size=100)
+
+    counts = sink.write_columns(columns)
+    assert counts == {
+        "Observation": {"inserted": 1, "skipped": 0},
+        "ObservationComponent": {"inserted": 2, "skipped": 0},
+    }
+    sink.close()
+
+    table = pyarrow.parquet.read_table(glob(f"{tmp_path}/ObservationComponent/ingest_date=*/*.parquet"))
+    assert table.column("value").to_pylist() == [86.0, 125.0]
+    assert table.schema.field("value").type == pyarrow.float64()
+
+
+def test_create_sink_unknown():
+    """
+    Test that an unknown sink name raises an error
+    """
+    with pytest.raises(ValueError):
+        create_sink("foo")
@@ -0,0 +1,126 @@
+"""
+Tests for the patient timeline, and reading it back
+"""
+
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, text
+
+# the pipeline modules import each other by their plain names (see conftest.py)
+import db
+from pipeline.queries import latest_events, patient_timeline, timeline_query
+from pipeline.rows import ClaimRow, EncounterRow, ConditionRow
+from pipeline.start import process_file
+from pipeline.timeline import timeline_rows
+
+PATIENT_ID = "0f978b87-8054-e6d3-aa03-20e101ea37c0"
+
+# the events for the patient in the e2e file, by resource type
+FULL_FILE_EVENTS = {
+    "Encounter": 69, "Claim": 79, "MedicationRequest": 10, "Condition": 21, "Procedure": 180, "Immunization": 4
+}
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """
+    A database of its own, so the rows from the test file don't affect the other tests
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pipeline.db")
+    monkeypatch.setattr("db.get_db_engine", lambda: engine)
+    return engine
+
+
+@pytest.fixture
+def migrated(engine):
+    """
+    The database with every table made, as it is when the pipeline starts
+    """
+    db.migrate()
+    return engine
+
+
+def test_timeline_kept_up_to_date(migrated):
+    """
+    Test that the timeline gets an event for everything in a file as it is loaded, which come back in time order,
+    and that loading the file again doesn't add them twice
+    """
+    counts = process_file("full_file.json", file_dir="test/test_files/e2e")
+    assert counts["patient_timeline"] == {"inserted": sum(FULL_FILE_EVENTS.values()), "skipped": 0}
+
+    events = patient_timeline(PATIENT_ID)
+    assert len(events) == sum(FULL_FILE_EVENTS.values())
+    assert {event.resource_type for event in events} == set(FULL_FILE_EVENTS)
+    in_order = [(event.event_time, event.id) for event in events]
+    assert in_order == sorted(in_order)
+    encounter = next(event for event in events if event.resource_type == "Encounter")
+    assert encounter.id == f"Encounter/{encounter.resource_id}"
+    assert encounter.summary
+
+    # sqlite gives the times back without their timezone
+    since = datetime(2015, 1, 1)
+    recent_conditions = patient_timeline(PATIENT_ID, since=since, resource_types=["Condition"])
+    assert recent_conditions
+    assert all(event.resource_type == "Condition" and event.event_time >= since for event in recent_conditions)
+    assert patient_timeline(PATIENT_ID, limit=3) == events[:3]
+    assert latest_events(PATIENT_ID, 2) == events[:-3:-1]
+    assert patient_timeline("someone-else") == []
+
+    # the manifest would skip the whole file, so this goes through the rows being skipped
+    process_file("full_file.json", file_dir="test/test_files/e2e")
+    assert len(patient_timeline(PATIENT_ID)) == sum(FULL_FILE_EVENTS.values())
+
+
+def test_timeline_is_index_range_scan(engine):
+    """
+    Test that reading a patient's timeline only has to look at that patient's part of the index
+    """
+    db.migrate()
+    query = timeline_query(PATIENT_ID, since=datetime(2015, 1, 1)).compile(
+        engine, compile_kwargs={"literal_binds": True}
+    )
+    with engine.connect() as connection:
+        plan = " ".join(row[-1] for row in connection.execute(text(f"EXPLAIN QUERY PLAN {query}")))
+
+    assert "USING INDEX ix_patient_timeline_patient_id_event_time_id (patient_id=? AND event_time>?)" in plan
+    # already in order, so no sort needed
+    assert "ORDER BY" not in plan
+
+
+def test_timeline_backfilled(engine):
+    """
+    Test that when the timeline table is first made, it is filled with what was already loaded
+    """
+    onset = datetime(2020, 5, 1, 9, 30)
+    db.send_objects([
+        {"table": "Encounter", "data": EncounterRow(
+            "encounter-1", "patient-1", "finished", "Check up", datetime(2020, 5, 1, 9), None, None, None, None, None
+        )},
+        {"table": "Condition", "data": ConditionRow(
+            "condition-1", "patient-1", "encounter-1", "active", "confirmed", None, onset, None, "Sinusitis"
+        )},
+    ])
+    with engine.connect() as connection:
+        assert not engine.dialect.has_table(connection, "patient_timeline")
+
+    db.migrate()
+
+    assert [(event.resource_type, event.summary) for event in patient_timeline("patient-1")] == [
+        ("Encounter", "Check up"), ("Condition", "Sinusitis")
+    ]
+
+
+def test_claim_summary_without_provider():
+    """
+    Test that a claim's summary only names the provider when there is one
+    """
+    billed = datetime(2020, 5, 1, 9)
+    claims = [
+        ClaimRow("claim-1", "patient-1", "encounter-1", None, "active", billed, None, "Clinic", None, None,
+                 Decimal("12.50"), "USD"),
+        ClaimRow("claim-2", "patient-1", "encounter-1", None, "active", billed, None, None, None, None,
+                 Decimal("12.50"), "USD"),
+    ]
+    assert [row.summary for row in timeline_rows("Claim", claims)] == ["Clinic: 12.50 USD", "12.50 USD"]
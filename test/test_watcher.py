@@ -0,0 +1,95 @@
+"""
+Tests for watching the input directory for new files
+"""
+
+import os
+import time
+
+import pytest
+
+from pipeline.watcher import _EVENT_HEADER, IN_Q_OVERFLOW, InotifyWatcher, PollingWatcher, create_watcher
+
+
+def test_inotify_watcher_picks_up_closed_file(tmp_path):
+    """
+    Test that a file is only picked up by the inotify watcher once it has been closed,
+    and that files with other extensions are ignored.
+    """
+    watcher = InotifyWatcher(str(tmp_path), debounce_seconds=0.01)
+    try:
+        partial_file = open(tmp_path / "new.json", "w")
+        partial_file.write("{")
+        partial_file.flush()
+        (tmp_path / "ignored.txt").write_text("foo")
+
+        # still being written, so nothing is ready yet
+        assert watcher.get_files(timeout=0.1) == []
+
+        partial_file.write("}")
+        partial_file.close()
+        assert watcher.get_files(timeout=2) == ["new.json"]
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_picks_up_moved_file(tmp_path):
+    """
+    Test that a file moved into the directory is picked up by the inotify watcher.
+    """
+    watched_dir = tmp_path / "watched"
+    watched_dir.mkdir()
+    (tmp_path / "moved.json").write_text("{}")
+
+    watcher = InotifyWatcher(str(watched_dir), debounce_seconds=0.01)
+    try:
+        os.rename(tmp_path / "moved.json", watched_dir / "moved.json")
+        assert watcher.get_files(timeout=2) == ["moved.json"]
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_rescans_after_lost_events(tmp_path):
+    """
+    Test that the inotify watcher lists the directory when the event queue overflows, and when
+    it times out having not listed the directory for rescan_seconds.
+    """
+    # these were already there before the watcher started, so there are no events for them
+    (tmp_path / "old.json").write_text("{}")
+    (tmp_path / "lost.json").write_text("{}")
+    past = time.time() - 10
+    os.utime(tmp_path / "old.json", (past, past))
+    os.utime(tmp_path / "lost.json", (past, past))
+
+    watcher = InotifyWatcher(str(tmp_path), debounce_seconds=0.01, rescan_seconds=3600)
+    try:
+        assert watcher.get_files(timeout=0.1) == []
+
+        watcher._handle_events(_EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0), time.monotonic())
+        assert sorted(watcher.get_files(timeout=0.1)) == ["lost.json", "old.json"]
+
+        os.remove(tmp_path / "lost.json")
+        watcher.rescan_seconds = 0
+        assert watcher.get_files(timeout=0.1) == ["old.json"]
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher_waits_for_stable_file(tmp_path):
+    """
+    Test that the polling watcher only returns a file once it has stopped changing between scans.
+    """
+    watcher = PollingWatcher(str(tmp_path))
+    (tmp_path / "new.json").write_text("{}")
+
+    # first scan only sees the file for the first time
+    assert watcher.get_files(timeout=0) == []
+    # second scan sees it unchanged
+    assert watcher.get_files(timeout=0) == ["new.json"]
+
+
+def test_create_watcher_unknown_mode(tmp_path):
+    """
+    Test that an unknown watch mode raises an error
+    """
+    with pytest.raises(ValueError):
+        create_watcher(str(tmp_path), "foo")